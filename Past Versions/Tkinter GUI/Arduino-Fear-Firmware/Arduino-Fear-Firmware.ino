@@ -21,6 +21,8 @@ struct smallTime {
 smallTime startATime; //Send time to PC at end of exp to ensure fast entry of loop
 smallTime endATime;
 int i = 0; //print end message once
+byte closedLoopState = B0; //D register pins driven by closed loop triggers from the computer
+byte outState = B0; //D register pins driven by the schedule
 //##############################################################################
 
 //##############################################################################
@@ -40,66 +42,63 @@ struct setupData {
   byte pinsD;
   byte pinsB;
   unsigned long total_time;
-  unsigned int num_tones;
-  unsigned int num_outd07;
-  unsigned int num_pwmb813;
+  unsigned int num_events;
 };
 union pcsetup {
   setupData data;
-  byte pcsetupData[12];
+  byte pcsetupData[8];
 };
 pcsetup pcSetupData;
-byte setupDataStore[12];
+byte setupDataStore[8];
 //#######################################
 
 //#######################################
-//This manages tone instructions
-struct toneData {
-  unsigned long tone_on;
-  unsigned long tone_off;
+//This manages the schedule: one time sorted list of events, compiled by the computer (ArdSchedule.py)
+//Each event is applied once when due, so a loop only ever checks the next event
+//Events are held in a ring buffer; the computer streams them in blocks whenever a block fits
+#define EVT_PORTD 0   //mask: new state of the D register outputs
+#define EVT_TONE 1    //freq: new tone on pin 10, 0 turns it off
+#define EVT_PWM_ON 2  //mask: B register pin; cycle times and phase shift in micros
+#define EVT_PWM_OFF 3 //mask: B register pin
+#define MAX_EVENTS 32   //power of 2, so buffer slots are picked with EVENT_MASK
+#define EVENT_MASK 31
+#define EVENT_BLOCK 8   //events per request
+#define FILL_TIMEOUT 3000
+struct eventData {
+  unsigned long time_ms;
+  byte kind;
+  byte mask;
   unsigned int freq;
+  unsigned long cycleTimeOn;
+  unsigned long cycleTimeOff;
+  unsigned long timePhaseShift;
 };
-union pcTone {
-  toneData data;
-  byte pctoneData[10];
+union pcevent {
+  eventData data;
+  byte pceventData[20];
 };
-pcTone pcToneData[12];
-byte toneDataStore[10];
+pcevent events[MAX_EVENTS];
+unsigned int numEvents = 0; //in the whole schedule
+unsigned int received = 0; //events received so far
+unsigned int cursor = 0; //next event to apply
+byte blockLeft = 0; //events of the current block not yet received
+byte eventByte = 0; //bytes of the current event received
+boolean eventsRequested = false;
 //#######################################
 
 //#######################################
-//This manages simple output instructions
-struct outData {
-  unsigned long time_to_trigger;
+//This manages pwm/frequency output on the B register; at most one channel per pin is running
+#define MAX_PWM 6
+struct pwmChannel {
   byte pins;
-};
-union pcout {
-  outData data;
-  byte pcoutData[5];
-};
-pcout out_d07[30];
-byte pcoutd07[5];
-byte nowState[30];
-//#######################################
-
-//#######################################
-//This manages pwm/frequency output instructions
-struct pwmData {
-  unsigned long startMillis;
-  unsigned long time_on;
-  unsigned long time_off;
+  byte cycleCheck; //0: waiting out the phase shift, 1: high, 2: low
+  unsigned long lastMicros;
   unsigned long cycleTimeOn;
   unsigned long cycleTimeOff;
-  byte pins;
   unsigned long timePhaseShift;
 };
-union pcpwm {
-  pwmData data;
-  byte pcpwmData[25];
-};
-pcpwm pwm_b813[33];
-byte pcpwmb813[25];
-byte cycleCheck[33] = {0};
+pwmChannel pwm[MAX_PWM];
+byte numPwm = 0;
 //#######################################
 //##############################################################################
 
@@ -137,72 +136,24 @@ void setup(){
   requestData();
   delay(150); //Allow small delay for data to arrive
     //RECEIVE AND STORE IN DATA STRUCT
-      if (Serial.available() < 12) {
+      if (Serial.available() < 8) {
          return;
       }
-      for (byte n = 0; n < 12; n++) {
+      for (byte n = 0; n < 8; n++) {
          setupDataStore[n] = Serial.read();
       }
-      for (byte n = 0; n < 12; n++) {
+      for (byte n = 0; n < 8; n++) {
          pcSetupData.pcsetupData[n] = setupDataStore[n];
       }
    askForData = true;
+   numEvents = pcSetupData.data.num_events;
    //#######################################
    
    //#######################################
-   //TONE DATA
-   for (int i=0; i<pcSetupData.data.num_tones;i++){
-     requestData();
-     delay(150);
-         if (Serial.available() < 10) {
-             return;
-         }
-         for (byte n = 0; n < 10; n++) {
-             toneDataStore[n] = Serial.read();
-         }
-         for (byte n = 0; n < 10; n++) {
-             pcToneData[i].pctoneData[n] = toneDataStore[n];
-         } 
-     askForData = true;
-   }
-   //#######################################
-   
-   //#######################################
-   //OUTPUT DATA (on D register)
-   byte prevState = B0;
-   for (int i=0; i<pcSetupData.data.num_outd07; i++){
-     requestData();
-     delay(150);
-         if (Serial.available() < 5) {
-             return;
-         }
-         for (byte n = 0; n < 5; n++) {
-             pcoutd07[n] = Serial.read();
-         }
-         for (byte n = 0; n < 5; n++) {
-             out_d07[i].pcoutData[n] = pcoutd07[n];
-         }
-     askForData = true;
-     nowState[i] = prevState^out_d07[i].data.pins;
-     prevState = nowState[i];
-   }
-   //#######################################
-   
-   //#######################################
-   //PWM/FREQ MODULATION DATA (on B register)
-   for (int i=0; i<pcSetupData.data.num_pwmb813; i++){
-     requestData();
-     delay(150);
-       if (Serial.available() < 25) {
-           return;
-       }
-       for (byte n = 0; n < 25; n++) {
-           pcpwmb813[n] = Serial.read();
-       }
-       for (byte n = 0; n < 25; n++) {
-           pwm_b813[i].pcpwmData[n] = pcpwmb813[n];
-       }
-   askForData = true;
+   //EVENT DATA. Fill the buffer before starting; the rest is streamed during the run
+   unsigned long fillStart = millis();
+   while (received < min(numEvents, MAX_EVENTS) && millis()-fillStart < FILL_TIMEOUT){
+     checkSerial();
    }
    //#######################################
    
@@ -237,67 +188,29 @@ void setup(){
 //MAIN PROGRAM
 void loop() {
   //#######################################
-  //TONE LOOP. 
-  //NOTE: Pin 10 is assigned to TONE Exclusively. Do NOT use for PWM/other Freq Modulation
-  for (int i=0; i<pcSetupData.data.num_tones;i++){
-    if (pcToneData[i].data.tone_on <= (millis()-startTime) && pcToneData[i].data.tone_off > (millis()-startTime)){
-      NewTone(10,pcToneData[i].data.freq);
-    }
-    else if (pcToneData[i].data.tone_off <= (millis()-startTime) && pcToneData[i+1].data.tone_on > (millis()-startTime)){
-      noNewTone(10);
-    }
-    else if (pcToneData[pcSetupData.data.num_tones-1].data.tone_off <= (millis()-startTime)){
-      noNewTone(10);
-    }
-  }
+  //CLOSED LOOP TRIGGERS AND STREAMED EVENTS
+  checkSerial();
   //#######################################
 
   //#######################################
-  //OUTPUT LOOP (on D register)
-  for (int i=0; i<pcSetupData.data.num_outd07; i++) {
-    if (out_d07[i].data.time_to_trigger <= (millis()-startTime) && out_d07[i+1].data.time_to_trigger > (millis()-startTime)){
-      PORTD = nowState[i];
-    }
-    else if (out_d07[pcSetupData.data.num_outd07-1].data.time_to_trigger <= (millis()-startTime)){
-      PORTD = B0;
-    }
+  //SCHEDULE. Events are time sorted, so we apply those due and stop at the first one that is not
+  unsigned long now = millis()-startTime;
+  while (cursor < received && events[cursor & EVENT_MASK].data.time_ms <= now){
+    applyEvent(&events[cursor & EVENT_MASK].data);
+    cursor++;
   }
   //#######################################
 
   //#######################################
-  for (int i=0; i<pcSetupData.data.num_pwmb813; i++) {
-    if (pwm_b813[i].data.time_on <= (millis()-startTime) && pwm_b813[i].data.time_off > (millis()-startTime)){
-        if (cycleCheck[i] == 0){
-          if (cycleCheckMicros(&pwm_b813[i].data.startMillis,pwm_b813[i].data.timePhaseShift)){
-            PORTB = PORTB^byte(pwm_b813[i].data.pins);
-            cycleCheck[i] = 1;
-          }
-        }
-        if (cycleCheck[i] == 1){
-          if (cycleCheckMicros(&pwm_b813[i].data.startMillis, pwm_b813[i].data.cycleTimeOn)){
-            PORTB = PORTB^byte(pwm_b813[i].data.pins);
-            cycleCheck[i] = 2;
-          }
-        }
-        if (cycleCheck[i] == 2){
-          if (cycleCheckMicros(&pwm_b813[i].data.startMillis, pwm_b813[i].data.cycleTimeOff)){
-            PORTB = PORTB^byte(pwm_b813[i].data.pins);
-            cycleCheck[i] = 1;
-          }
-        }
-    }
-    else if (pwm_b813[i].data.time_off <= (millis()-startTime) && pwm_b813[i+1].data.time_on > (millis()-startTime)){
-      PORTB = PORTB&(~byte(pwm_b813[i].data.pins));
-    }
-    else if (pwm_b813[pcSetupData.data.num_pwmb813-1].data.time_off <= (millis()-startTime)){
-      PORTB = PORTB&(~byte(pwm_b813[i].data.pins));
-    }
+  //PWM/FREQ MODULATION (on B register)
+  for (byte n = 0; n < numPwm; n++) {
+    updatePwm(&pwm[n]);
   }
   //#######################################
   
   //#######################################
   //FINISHING EXPERIMENT AND REPORTING TIME.
-  if (millis()-startTime >= pcSetupData.data.total_time) {
+  if (now >= pcSetupData.data.total_time) {
      if (i == 0) {
        endATime.hours = hour();
        endATime.minutes = minute();
@@ -326,6 +239,66 @@ void loop() {
 
 //##############################################################################
 //Misc. Functions
+  //#######################################
+  //Serial input
+  //Events: 'E', count, then count events of 20 bytes; read as they arrive, the block is larger than the serial buffer
+  //Closed Loop Trigger: 'T', sequence number, D register state. Acknowledged with <a{sequence number}>
+  void checkSerial(){
+    requestEvents();
+    while (blockLeft > 0 && Serial.available() > 0) {
+      events[received & EVENT_MASK].pceventData[eventByte] = Serial.read();
+      eventByte++;
+      if (eventByte == 20) {
+        eventByte = 0;
+        received++;
+        blockLeft--;
+      }
+    }
+    if (blockLeft > 0 || Serial.available() < 1) {
+      return;
+    }
+    byte header = Serial.peek();
+    if (header == 'E') {
+      if (Serial.available() < 2) {
+        return;
+      }
+      Serial.read();
+      blockLeft = Serial.read();
+      eventsRequested = false;
+    }
+    else if (header == 'T') {
+      if (Serial.available() < 3) {
+        return;
+      }
+      Serial.read();
+      byte seq = Serial.read();
+      byte state = Serial.read() & B11111100; //never drive the serial pins
+      DDRD = DDRD | state;
+      PORTD = outState | state;
+      closedLoopState = state;
+      Serial.print("<a");
+      Serial.print(seq);
+      Serial.print(">");
+    }
+    else {
+      Serial.read(); //discard the start byte and any noise
+    }
+  }
+  //#######################################
+
+  //#######################################
+  //Asks for the next block of events with <R> once the buffer has room for it
+  void requestEvents() {
+    if (eventsRequested || blockLeft > 0 || received >= numEvents) {
+      return;
+    }
+    unsigned int room = MAX_EVENTS - (received - cursor);
+    if (room >= min(EVENT_BLOCK, numEvents - received)) {
+      Serial.print("<R>");
+      eventsRequested = true;
+    }
+  }
+  //#######################################
   //#######################################
   //Requesting Data
   void requestData() {
@@ -336,6 +309,70 @@ void loop() {
   }
   //#######################################
   
+  //#######################################
+  //Schedule events
+  void applyEvent(eventData *event) {
+    switch (event->kind) {
+      case EVT_PORTD:
+        outState = event->mask;
+        PORTD = outState|closedLoopState;
+        break;
+      case EVT_TONE:
+        //NOTE: Pin 10 is assigned to TONE Exclusively. Do NOT use for PWM/other Freq Modulation
+        if (event->freq > 0) {
+          NewTone(10, event->freq);
+        }
+        else {
+          noNewTone(10);
+        }
+        break;
+      case EVT_PWM_ON:
+        if (numPwm < MAX_PWM) {
+          pwm[numPwm].pins = event->mask;
+          pwm[numPwm].cycleCheck = 0;
+          pwm[numPwm].lastMicros = micros()-startMicros;
+          pwm[numPwm].cycleTimeOn = event->cycleTimeOn;
+          pwm[numPwm].cycleTimeOff = event->cycleTimeOff;
+          pwm[numPwm].timePhaseShift = event->timePhaseShift;
+          numPwm++;
+        }
+        break;
+      case EVT_PWM_OFF:
+        PORTB = PORTB&(~event->mask);
+        for (byte n = 0; n < numPwm; n++) {
+          if (pwm[n].pins == event->mask) {
+            numPwm--;
+            pwm[n] = pwm[numPwm];
+            break;
+          }
+        }
+        break;
+    }
+  }
+  //#######################################
+
+  //#######################################
+  //Toggles a running pwm channel at its phase shift, then every cycle time on/off
+  void updatePwm(pwmChannel *channel) {
+    if (channel->cycleCheck == 0){
+      if (cycleCheckMicros(&channel->lastMicros, channel->timePhaseShift)){
+        PORTB = PORTB^channel->pins;
+        channel->cycleCheck = 1;
+      }
+    }
+    else if (channel->cycleCheck == 1){
+      if (cycleCheckMicros(&channel->lastMicros, channel->cycleTimeOn)){
+        PORTB = PORTB^channel->pins;
+        channel->cycleCheck = 2;
+      }
+    }
+    else if (cycleCheckMicros(&channel->lastMicros, channel->cycleTimeOff)){
+      PORTB = PORTB^channel->pins;
+      channel->cycleCheck = 1;
+    }
+  }
+  //#######################################
+
   //#######################################
   //Non-Tone (i.e. high Frequency) frequency modulation logic
   boolean cycleCheckMicros(unsigned long *lastMicros, unsigned long CycleTime) 
@@ -86,9 +86,6 @@ class ProcessHandler(StoppableProcess):
                         self.master_dump_queue.put_nowait(msg)
                         self.labjack_running = False
                         self.use_labjack = False
-                    elif msg.startswith(LJ_CONFIG):
-                        self.set_device_params(msg, update_cmr=False, update_lj=True)
-                        self.master_dump_queue.put_nowait(LJ_CONFIG)
                     # Exp Configuration
                     elif msg.startswith(TTL_TIME_HEADER) or msg.startswith(DIR_TO_USE_HEADER):
                         self.set_device_params(msg)
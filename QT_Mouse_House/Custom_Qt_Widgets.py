@@ -20,7 +20,8 @@ import pyximea as xi
 import PyQt4.QtGui as qg
 import PyQt4.QtCore as qc
 from copy import deepcopy
-from LJ_Procs import find_packets_per_req, find_samples_per_pack
+from LJ_Procs import request_size
+from Photometry_Procs import fp_channel_keys, FP_COLUMNS, FP_LIVE_POINTS
 
 
 class GUI_ProgressBar(qg.QGraphicsView):
@@ -486,6 +487,9 @@ class GUI_CameraDisplay(qg.QWidget):
 
 class GUI_LiveScrollingGraph(qg.QWidget):
     """Plots graphs; number depends on number of LJ channels enabled"""
+    # Emitted once for each reconfigure() call: (config id, True if the LabJack process streams with its settings)
+    lj_reconfigured = qc.pyqtSignal(int, bool)
+
     def __init__(self, dirs):
         qg.QWidget.__init__(self)
         self.dirs = dirs
@@ -500,13 +504,22 @@ class GUI_LiveScrollingGraph(qg.QWidget):
         self.grid.addWidget(self.frame)
         # Data Containers
         self.ch_num = []
-        self.array_shape = (8, 1200)  # Max 8 Channels; Max 1200 Samples per Request (25 * 48)
+        self.array_shape = (LJ_NUM_CH, 1200)  # A row for each channel; Max 1200 Samples per Request (25 * 48)
         self.mp_array = None
         self.np_array = None
+        # Photometry [main, isos, dF/F], plotted below the channels while its data channel is streamed
+        self.fp_mp_array = None
+        self.fp_np_array = None
+        self.fp_plots = []
         self.plots_are_reset = False
         self.lj_proc = None
         self.sync_event = None
         self.msg_pipes = None
+        self.config_queue = None
+        self.config_results = None
+        self.config_id = 0
+        # [missed samples, writer backlog, request latency ms, USB efficiency] published by the LabJack process
+        self.health_array = mp.Array('d', 4, lock=False)
         # Setup
         self.initialize()
 
@@ -544,32 +557,72 @@ class GUI_LiveScrollingGraph(qg.QWidget):
         self.mp_array = mp.Array('f', int(np.prod(self.array_shape)), lock=mp.Lock())
         self.np_array = np.frombuffer(self.mp_array.get_obj(), dtype='f').reshape(self.array_shape)
         self.np_array[:] = None
+        fp_shape = (len(FP_COLUMNS), FP_LIVE_POINTS)
+        self.fp_mp_array = mp.Array('f', int(np.prod(fp_shape)), lock=mp.Lock())
+        self.fp_np_array = np.frombuffer(self.fp_mp_array.get_obj(), dtype='f').reshape(fp_shape)
+        self.fp_np_array[:] = None
 
     def create_process(self):
         """Generates separate process for LabJack"""
         self.msg_pipes = mp.Pipe()
         self.sync_event = mp.Event()
         self.sync_event.clear()
+        self.config_queue = mp.Queue()
+        self.config_results = mp.Queue()
         lj_pipe_main, lj_pipe_lj = self.msg_pipes
         self.lj_proc = lp.LabJackProcess(self.dirs, lj_pipe_lj, self.mp_array,
-                                         self.sync_event, self.array_shape)
+                                         self.sync_event, self.array_shape, self.health_array,
+                                         self.fp_mp_array, self.config_queue, self.config_results)
         self.lj_proc.name = 'lj_stream_proc'
+        relay = tr.Thread(target=self.relay_config_results, args=(self.config_results,))
+        relay.daemon = True
+        relay.start()
+
+    def reconfigure(self, ch_num, scan_freq, mode):
+        """Sends new settings to the LabJack process, which prepares them and swaps them in between two requests.
+        Returns their config id; lj_reconfigured reports it once they are applied, refused or superseded.
+        If the process is not running there is nothing to wait for"""
+        self.config_id += 1
+        config_id = self.config_id
+        if not self.lj_proc.is_alive():
+            qc.QTimer.singleShot(0, lambda: self.lj_reconfigured.emit(config_id, True))
+        else:
+            self.config_queue.put_nowait((config_id, ch_num, scan_freq, mode))
+        return config_id
+
+    def relay_config_results(self, config_results):
+        """Run on separate thread; relays each (config id, applied) reported by the LabJack process to the GUI"""
+        while True:
+            config_id, applied = config_results.get()
+            self.lj_reconfigured.emit(config_id, applied)
 
     def update_graphs(self):
         """Get data from shared mp array and appends to graph if we are ready to do so"""
-        if self.sync_event.is_set():
-            if self.plots_are_reset:
-                self.arrays_plots = {self.plots[ch]:
-                                     chunked([n for n in self.np_array[i] if not np.isnan(n)], 50)
-                                     for i, ch in enumerate(self.ch_num)
-                                     if not np.isnan(self.np_array[i][0])}
-                self.add_point_to_graph()
+        if self.sync_event.is_set() and self.plots_are_reset:
+            self.arrays_plots = {self.plots[ch]:
+                                 chunked([n for n in self.np_array[ch] if not np.isnan(n)], 50)
+                                 for ch in self.ch_num
+                                 if not np.isnan(self.np_array[ch][0])}
+            num_pts = max([int(np.ceil(np.count_nonzero(~np.isnan(self.np_array[ch])) / 50.0))
+                           for ch in self.ch_num] + [1])
+            for i, plot in enumerate(self.fp_plots):
+                self.arrays_plots[plot] = self.stretch_points(self.fp_np_array[i], num_pts, plot.data[-1])
+            self.add_point_to_graph()
         else:
             qc.QTimer.singleShot(5, self.update_graphs)
 
         #todo: make sure sync_event set/not_set does not affect write rate on lj_procs
         # todo: sync event set/not set should ONLY affect speed of lj sending to display, not lj write to file.
 
+    @staticmethod
+    def stretch_points(values, num_pts, last):
+        """num_pts single point chunks spread evenly over the values; repeats last if there are none"""
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return iter([[last]] * num_pts)
+        positions = np.linspace(0, len(values) - 1, num_pts)
+        return iter([[value] for value in np.interp(positions, np.arange(len(values)), values)])
+
     def add_point_to_graph(self):
         """From mp_array, get data, append to graph"""
         time_to_wait = self.ms_per_pt
@@ -589,16 +642,44 @@ class GUI_LiveScrollingGraph(qg.QWidget):
 
     def create_plots(self):
         """Creates number of plots equal to number of LJ channels enabled"""
-        self.ch_num = deepcopy(self.dirs.settings.lj_last_used.ch_num)
-        self.labels = {ch: qg.QLabel(str(ch)) for ch in self.ch_num}
-        self.plots = {ch: GUI_SinglePlot(self.color_scheme[self.ch_num.index(ch)]) for ch in self.ch_num}
-        [self.inner_grid.addWidget(self.labels[i], i, 0) for i in self.ch_num]
-        [self.inner_grid.addWidget(self.plots[i], i, 1) for i in self.ch_num]
+        self.ch_num = []
+        self.labels = {}
+        self.plots = {}
+        self.fp_labels = []
+        self.fp_plots = []
+        self.resize_plots()
+
+    def resize_plots(self):
+        """Adds and removes plots to match the LJ channels enabled; plots that stay keep their data"""
+        ch_num = deepcopy(self.dirs.settings.lj_last_used.ch_num)
+        for ch in [ch for ch in self.ch_num if ch not in ch_num]:
+            self.labels.pop(ch).setParent(None)
+            self.plots.pop(ch).setParent(None)
+        used_colors = [plot.color for plot in self.plots.values()]
+        free_colors = [color for color in self.color_scheme if color not in used_colors]
+        for ch in [ch for ch in ch_num if ch not in self.ch_num]:
+            self.labels[ch] = qg.QLabel(str(ch))
+            self.plots[ch] = GUI_SinglePlot(free_colors.pop(0))
+            self.inner_grid.addWidget(self.labels[ch], ch, 0)
+            self.inner_grid.addWidget(self.plots[ch], ch, 1)
+        self.ch_num = ch_num
+        # Photometry rows go below the channel rows
+        show_fp = bool(fp_channel_keys(self.dirs.settings.fp_last_used.ch_num, self.ch_num))
+        if show_fp and not self.fp_plots:
+            for i, name in enumerate(FP_COLUMNS):
+                self.fp_labels.append(qg.QLabel(name))
+                self.fp_plots.append(GUI_SinglePlot(fp_color_scheme[i]))
+                self.inner_grid.addWidget(self.fp_labels[i], LJ_NUM_CH + i, 0)
+                self.inner_grid.addWidget(self.fp_plots[i], LJ_NUM_CH + i, 1)
+        elif not show_fp and self.fp_plots:
+            [widget.setParent(None) for widget in self.fp_labels + self.fp_plots]
+            self.fp_labels = []
+            self.fp_plots = []
         # Get update rate
         scan_freq = self.dirs.settings.lj_last_used.scan_freq
         n_ch = len(self.ch_num)
-        args = (scan_freq, n_ch)
-        smpls_per_req = find_packets_per_req(*args) * find_samples_per_pack(*args)
+        packets, smpls_per_pack = request_size(scan_freq, n_ch, self.dirs.settings.lj_last_used.mode)
+        smpls_per_req = packets * smpls_per_pack
         reqs_per_sec = scan_freq * n_ch / smpls_per_req
         ms_per_update = int(np.floor(1000.0 / reqs_per_sec))
         pts_per_update = 8 / n_ch
@@ -663,8 +744,9 @@ class GUI_LJDataReport(qg.QWidget):
 
 class GUI_StatusBars(qg.QWidget):
     """A set of status bars to report current application/device statuses"""
-    def __init__(self):
+    def __init__(self, lj_graph_widget):
         qg.QWidget.__init__(self)
+        self.lj_graph_widget = lj_graph_widget
         self.grid = qg.QGridLayout()
         self.setLayout(self.grid)
         self.labels = ['Ard', 'LJk', 'Cmr', 'Sys']
@@ -681,6 +763,23 @@ class GUI_StatusBars(qg.QWidget):
             self.status_bars[s].setFrameStyle(qg.QFrame.Sunken | qg.QFrame.StyledPanel)
             self.grid.addWidget(label, index, 0)
             self.grid.addWidget(self.status_bars[s], index, 1)
+        # LabJack health is refreshed periodically from the LabJack process
+        update_timer = qc.QTimer(self)
+        update_timer.timeout.connect(self.update_lj_health)
+        update_timer.start(250)
+
+    def update_lj_health(self):
+        """Shows missed samples, writer backlog and request timing; turns red if any samples were missed this run"""
+        health = self.lj_graph_widget.health_array
+        missed, backlog = health[LJ_HEALTH_MISSED], health[LJ_HEALTH_BACKLOG]
+        self.status_bars['LJk'].setText('Missed Samples: {:.0f} | Writer Backlog: {:.0f} | '
+                                        'Latency: {:.1f} ms | USB Efficiency: {:.0%}'
+                                        ''.format(missed, backlog, health[LJ_HEALTH_LATENCY],
+                                                  health[LJ_HEALTH_USB_EFF]))
+        if missed >= LJ_MISSED_ALARM:
+            self.status_bars['LJk'].setStyleSheet('background-color: rgb(255, 0, 0)')
+        else:
+            self.status_bars['LJk'].setStyleSheet('')
 
 
 # NOTE NOTE NOTE NOTE
@@ -183,6 +183,12 @@ class LabJackData(object):
     def __init__(self):
         self.ch_num = []
         self.scan_freq = 0
+        self.mode = LJ_HIGH_THROUGHPUT  # Request sizing; LJ_LOW_LATENCY for closed loop use
+
+    def __setstate__(self, state):
+        """Settings saved before request modes existed use high throughput"""
+        state.setdefault('mode', LJ_HIGH_THROUGHPUT)
+        self.__dict__.update(state)
 
     def load_blank(self):
         """Blank Config"""
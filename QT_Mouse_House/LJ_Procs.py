@@ -2,8 +2,8 @@
 
 """Separate Process for LabJack Operation"""
 
-import ast
 import sys
+import copy
 import math
 import time
 import u6 as u6
@@ -14,6 +14,8 @@ from struct import pack
 import LabJackPython as lj
 from itertools import zip_longest
 from Misc_Classes import StoppableProcess, NamedObjectContainer
+from Photometry_Procs import PhotometryPipeline, fp_channel_keys, open_fp_file, write_fp_block
+from Photometry_Procs import FP_COLUMNS, FP_LIVE_POINTS
 from datetime import datetime
 if sys.version[0] == '2':
     import Queue as Queue
@@ -21,44 +23,84 @@ else:
     import queue as Queue
 
 
-def find_packets_per_req(scan_freq, n_ch):
-        """Returns optimal packets per request to use"""
-        if n_ch == 7:
-            high = 42
-        else:
-            high = 48
-        hold = []
-        for i in range(scan_freq + 1):
-            if i % 25 == 0 and i % n_ch == 0:
-                hold.append(i)
-        hold = np.asarray(hold)
-        hold = min(high, max(hold / 25))
-        hold = max(1, int(hold))
-        return hold
+# U6 Streaming over full speed USB
+LJ_MAX_SAMPLES_PER_PACKET = 25
+LJ_MAX_PACKETS_PER_REQ = 48
+LJ_PACKET_BYTES = 64  # 12 byte header, 25 two byte samples, 2 byte trailer
+LJ_PACKETS_PER_FRAME = 19  # 64 byte bulk packets that fit in one 1 ms USB frame
+# Low latency mode takes the smallest whole scan requests that keep us under this many requests per second
+LJ_MAX_REQS_PER_SEC = 200
+
+
+def packet_step(n_ch, samples_per_pack=LJ_MAX_SAMPLES_PER_PACKET):
+    """Packets per request must be a multiple of this for each request to hold whole scans"""
+    a, b = n_ch, samples_per_pack
+    while b:
+        a, b = b, a % b
+    return n_ch // a
+
+
+def find_packets_per_req(scan_freq, n_ch, mode=LJ_HIGH_THROUGHPUT):
+    """Returns packets per request to use; always whole scans, at most 48 packets
+    High throughput: the largest request up to one second of scans. Low latency: the smallest request
+    that keeps the request rate under LJ_MAX_REQS_PER_SEC"""
+    step = packet_step(n_ch)
+    high = LJ_MAX_PACKETS_PER_REQ // step * step
+    if mode == LJ_LOW_LATENCY:
+        packets = -(-scan_freq * n_ch // (LJ_MAX_SAMPLES_PER_PACKET * LJ_MAX_REQS_PER_SEC))
+        packets = -(-packets // step) * step
+    else:
+        packets = scan_freq // (LJ_MAX_SAMPLES_PER_PACKET * step) * step
+    return max(step, min(high, packets))
 
 
 def find_samples_per_pack(scan_freq, n_ch):
-        """Returns optimal samples per packet to use"""
-        hold = []
-        for i in range(scan_freq + 1):
-            if i % n_ch == 0:
-                hold.append(i)
-        hold = max(hold)
-        hold = max(hold, 1)
-        hold = int(hold)
-        hold = min(hold, 25)
-        return hold
+    """Returns samples per packet to use; the most whole scans that fit in a packet and in scan_freq"""
+    return max(1, min(LJ_MAX_SAMPLES_PER_PACKET, scan_freq // n_ch * n_ch))
+
+
+def request_size(scan_freq, n_ch, mode=LJ_HIGH_THROUGHPUT):
+    """(packets per request, samples per packet) that LabJackU6.streamConfig() will use"""
+    if scan_freq < 25:
+        return 1, find_samples_per_pack(scan_freq, n_ch)
+    return find_packets_per_req(scan_freq, n_ch, mode), LJ_MAX_SAMPLES_PER_PACKET
+
+
+def request_timing(scan_freq, n_ch, packets_per_req, samples_per_pack):
+    """(latency ms, USB efficiency) of a request size. Latency is the time the LabJack takes to fill
+    one request; efficiency is the share of the USB frames each request occupies that carries samples"""
+    samples = packets_per_req * samples_per_pack
+    latency_ms = 1000.0 * samples / (scan_freq * n_ch)
+    frames = -(-packets_per_req // LJ_PACKETS_PER_FRAME)
+    efficiency = 2.0 * samples / (frames * LJ_PACKETS_PER_FRAME * LJ_PACKET_BYTES)
+    return latency_ms, efficiency
 
 
 class LabJackU6(u6.U6):
     """LabJack Device"""
+    # Set by a stream config; also all that processStreamData() needs to decode a request taken under it
+    streamAttributes = ['streamSamplesPerPacket', 'streamChannelNumbers', 'streamChannelOptions', 'streamConfiged',
+                        'packetsPerRequest', 'streamLatencyMs', 'streamUsbEfficiency']
+
     def __init__(self):
         super(LabJackU6, self).__init__()
 
-    def streamConfig(self, NumChannels=1, ResolutionIndex=0, SamplesPerPacket=25, SettlingFactor=0,
-                     InternalStreamClockFrequency=0, DivideClockBy256=False, ScanInterval=1, ChannelNumbers=[0],
-                     ChannelOptions=[0], ScanFrequency=None, SampleFrequency=None):
-        """Sets up Streaming settings"""
+    def streamConfig(self, *args, **kwargs):
+        """Sets up Streaming settings; takes the same arguments as prepareStreamConfig()"""
+        self.applyStreamConfig(self.prepareStreamConfig(*args, **kwargs))
+
+    def applyStreamConfig(self, prepared):
+        """Sends a config from prepareStreamConfig() to the LabJack; the stream must be stopped"""
+        self._writeRead(prepared.streamConfigCommand, 8, [0xF8, 0x01, 0x11])
+        for name in self.streamAttributes:
+            setattr(self, name, getattr(prepared, name))
+
+    def prepareStreamConfig(self, NumChannels=1, ResolutionIndex=0, SamplesPerPacket=25, SettlingFactor=0,
+                            InternalStreamClockFrequency=0, DivideClockBy256=False, ScanInterval=1,
+                            ChannelNumbers=[0], ChannelOptions=[0], ScanFrequency=None, SampleFrequency=None,
+                            RequestMode=LJ_HIGH_THROUGHPUT):
+        """Works out Streaming settings without contacting the LabJack. Returns a copy of this device holding them
+        and the config command, which applyStreamConfig() sends; the copy decodes requests taken under them"""
         if NumChannels != len(ChannelNumbers) or NumChannels != len(ChannelOptions):
             raise LabJackException("NumChannels must match length "
                                    "of ChannelNumbers and ChannelOptions")
@@ -102,47 +144,90 @@ class LabJackU6(u6.U6):
         for i in range(NumChannels):
             command[14 + (i * 2)] = ChannelNumbers[i]
             command[15 + (i * 2)] = ChannelOptions[i]
-        self._writeRead(command, 8, [0xF8, 0x01, 0x11])
         # Setup some variables for future use
-        self.streamSamplesPerPacket = SamplesPerPacket
-        self.streamChannelNumbers = ChannelNumbers
-        self.streamChannelOptions = ChannelOptions
-        self.streamConfiged = True
+        prepared = copy.copy(self)
+        prepared.streamConfigCommand = command
+        prepared.streamSamplesPerPacket = SamplesPerPacket
+        prepared.streamChannelNumbers = list(ChannelNumbers)
+        prepared.streamChannelOptions = list(ChannelOptions)
+        prepared.streamConfiged = True
         # Only happens for ScanFreq < 25, in which case
         # this number is generated as described above
         if SamplesPerPacket < 25:
-            self.packetsPerRequest = 1
+            prepared.packetsPerRequest = 1
         elif SamplesPerPacket == 25:  # For all ScanFreq > 25.
-            self.packetsPerRequest = find_packets_per_req(ScanFrequency, NumChannels)
+            prepared.packetsPerRequest = find_packets_per_req(ScanFrequency, NumChannels, RequestMode)
             # Such that PacketsPerRequest*SamplesPerPacket % NumChannels == 0,
             # where min P/R is 1 and max 48 for nCh 1-6,8
             # and max 42 for nCh 7.
+        # What this request size costs; see request_timing()
+        prepared.streamLatencyMs, prepared.streamUsbEfficiency = 0, 0
+        if ScanFrequency:
+            prepared.streamLatencyMs, prepared.streamUsbEfficiency = request_timing(
+                ScanFrequency, NumChannels, prepared.packetsPerRequest, SamplesPerPacket)
+        return prepared
+
+
+def fp_pipeline(fp, ch_num, scan_freq):
+    """(PhotometryPipeline, data keys it reads) if the photometry data channel is streamed, else None"""
+    keys = fp_channel_keys(fp.ch_num, ch_num)
+    if not keys:
+        return None
+    try:
+        return PhotometryPipeline(scan_freq, fp.main_freq, fp.isos_freq, with_refs=len(keys) == 3), keys
+    except ValueError as error:
+        print('Photometry Disabled: {}'.format(error))
+        return None
+
+
+class StreamSettings(object):
+    """One set of LabJack settings, with everything streaming under them needs prepared in advance:
+    the config command, a decoder for the requests taken under it and the photometry pipeline"""
+    def __init__(self, lj, config_id, ch_num, scan_freq, mode, fp):
+        self.config_id = config_id
+        self.ch_num = list(ch_num)
+        self.scan_freq = scan_freq
+        self.mode = mode
+        self.decoder = lj.prepareStreamConfig(NumChannels=len(self.ch_num), ChannelNumbers=self.ch_num,
+                                              ChannelOptions=[0] * len(self.ch_num), ScanFrequency=scan_freq,
+                                              RequestMode=mode)
+        self.fp_pipeline = fp_pipeline(fp, self.ch_num, scan_freq)
 
 
 class LabJackProcess(StoppableProcess):
     """Connects to and records from LabJack. Streams a low frequency output and writes high
     frequency data to a file. Communicates with proc_handler with a queue and main gui through a shared buffer"""
-    def __init__(self, dirs, lj_pipe_lj, mp_array, sync_event, array_shape):
+    def __init__(self, dirs, lj_pipe_lj, mp_array, sync_event, array_shape, health_array, fp_array,
+                 config_queue, config_results):
         super(LabJackProcess, self).__init__(callable_fn=None, args=None)
         # Provided Params
         self.dirs = dirs
         self.array_shape = array_shape
         self.mp_array = mp_array
+        self.health_array = health_array  # [missed, backlog, latency ms, USB efficiency]; read by GUI status bars
+        self.fp_array = fp_array  # [main, isos, dF/F] photometry for the live graph
         # Synchronization
         self.lj_pipe = lj_pipe_lj
         self.data_to_gui_sync_event = sync_event
         self.exp_start_event = EXP_START_EVENT
         self.proc_handler_queue = PROC_HANDLER_QUEUE
         self.master_dumpp_queue = MASTER_DUMP_QUEUE
+        # New settings arrive from the GUI on config_queue as (config id, ch_num, scan_freq, mode);
+        # each id is reported once on config_results as (config id, True if streaming with it)
+        self.config_queue = config_queue
+        self.config_results = config_results
+        self.prepared_streams = None
         # LabJack Operation Params
         self.lj = None
-        self.lj_is_being_config = False
+        self.stream = None  # StreamSettings in use
         self.ch_num = self.dirs.settings.lj_last_used.ch_num
         self.scan_freq = self.dirs.settings.lj_last_used.scan_freq
+        self.request_mode = self.dirs.settings.lj_last_used.mode
         self.lj_error = (lj.LabJackException, lj.LowlevelErrorException)
         # We create a data_buffer to keep new data for sending to GUI on a sep. thread;
         # This way we can continuously grab data from LabJack with minimal delay
         self.data_buffer = None
+        self.write_to_file_queue = None
         # Process Operation Params
         self.save_dir = self.dirs.settings.last_used_save_dir
         self.ttl_time = self.dirs.settings.ttl_time()
@@ -152,6 +237,7 @@ class LabJackProcess(StoppableProcess):
         self.recording = False
         self.connected = False
         self.save_file_name = ''
+        self.fp_file_writer = None
 
     # -- Device Operations -- #
     def initialize(self):
@@ -175,8 +261,11 @@ class LabJackProcess(StoppableProcess):
                         return
             self.lj.open()
             self.connected = True
-            self.lj.streamConfig(NumChannels=len(self.ch_num), ChannelNumbers=self.ch_num,
-                                 ChannelOptions=[0] * len(self.ch_num), ScanFrequency=self.scan_freq)
+            # Settings from dirs were never sent by the GUI, so they have no config id
+            self.stream = StreamSettings(self.lj, 0, self.ch_num, self.scan_freq, self.request_mode,
+                                         self.dirs.settings.fp_last_used)
+            self.lj.applyStreamConfig(self.stream.decoder)
+            self.report_request_timing()
             try:
                 self.lj.streamStart()
             except self.lj_error:
@@ -185,6 +274,11 @@ class LabJackProcess(StoppableProcess):
         except self.lj_error:
             self.report_lj_error()
 
+    def report_request_timing(self):
+        """Publishes the latency and USB efficiency of the request size the LabJack was configured with"""
+        self.health_array[LJ_HEALTH_LATENCY] = self.lj.streamLatencyMs
+        self.health_array[LJ_HEALTH_USB_EFF] = self.lj.streamUsbEfficiency
+
     def check_connection(self):
         """Checks if LabJack is available and connected"""
         try:
@@ -222,11 +316,17 @@ class LabJackProcess(StoppableProcess):
         self.ttl_num_requests = int(math.ceil(ttl_smpls / smpls_per_req))  # Actual exp # packets
         half_sec_smpls = self.scan_freq * len(self.ch_num) * 0.5
         self.half_sec_requests = int(math.ceil(half_sec_smpls / smpls_per_req))  # we record for 0.5s before/after exp.
+        # Missed samples are counted per run
+        self.health_array[LJ_HEALTH_MISSED] = 0
         # Generate the save file writer
         self.save_file_writer = open(self.save_file_path, 'w')
         for channel in self.ch_num:
             self.save_file_writer.write('AIN{},'.format(channel))
         self.save_file_writer.write('\n')
+        # Demodulated photometry and dF/F go to a compact file alongside
+        if self.stream.fp_pipeline:
+            self.fp_file_writer = open_fp_file('{}\\{}_fp.bin'.format(self.save_dir, self.save_file_name),
+                                               self.stream.fp_pipeline[0].rate)
         # Ready to Record
         self.lj_pipe.send(LJ_READY)
         self.exp_start_event.wait()
@@ -266,52 +366,56 @@ class LabJackProcess(StoppableProcess):
                 elif msg.startswith(TTL_TIME_HEADER):
                     self.ttl_time = float(msg.replace(TTL_TIME_HEADER, '', 1))
                     self.lj_pipe.send(DIR_TO_USE_HEADER)
-                elif msg.startswith(LJ_CONFIG):
-                    self.lj_config(msg)
-                    self.lj_pipe.send(LJ_CONFIG)
                 elif msg.startswith(DIR_TO_USE_HEADER):
                     self.save_dir = msg.replace(DIR_TO_USE_HEADER, '', 1)
                     self.lj_pipe.send(DIR_TO_USE_HEADER)
                 elif msg == EXIT_HEADER:
                     self.stop()
 
-    def lj_config(self, msg):
-        """From proc_handler message get settings to pass to labjack"""
-        # Pause getting data
-        self.lj_is_being_config = True
-        # Parse Data
-        msg = (msg.replace(LJ_CONFIG, '', 1)).split('|')
-        self.ch_num = ast.literal_eval(msg[0])
-        self.scan_freq = int(msg[1])
-        # Reset LabJack
+    def prepare_stream_settings(self):
+        """Run on separate thread; prepares settings sent by the GUI so the main loop only has to swap them in"""
+        while self.connected:
+            try:
+                config_id, ch_num, scan_freq, mode = self.config_queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            try:
+                stream = StreamSettings(self.lj, config_id, ch_num, scan_freq, mode, self.dirs.settings.fp_last_used)
+            except self.lj_error as error:
+                print('LabJack Settings Refused: {}'.format(error))
+                self.config_results.put_nowait((config_id, False))
+            else:
+                self.prepared_streams.put_nowait(stream)
+
+    def swap_stream_settings(self):
+        """Run between two requests; restarts the stream under the latest prepared settings and reports
+        which settings it applied. Settings superseded before they could be swapped in are reported as not applied"""
+        stream = self.prepared_streams.get_nowait()
+        while not self.prepared_streams.empty():
+            self.config_results.put_nowait((stream.config_id, False))
+            stream = self.prepared_streams.get_nowait()
         try:
             self.lj.streamStop()
-        except IndexError:
+            self.lj.applyStreamConfig(stream.decoder)
+            self.lj.streamStart()
+        except self.lj_error:
+            self.config_results.put_nowait((stream.config_id, False))
             self.report_lj_error()
             return
-        self.lj = LabJackU6()
-        self.lj.streamConfig(NumChannels=len(self.ch_num), ChannelNumbers=self.ch_num,
-                             ChannelOptions=[0] * len(self.ch_num), ScanFrequency=self.scan_freq)
-        self.lj.streamStart()
-        # Unpause getting data
-        self.num_channels = len(self.dirs.settings.lj_last_used.ch_num)
-        self.lj_is_being_config = False
+        self.stream = stream
+        self.ch_num, self.scan_freq, self.request_mode = stream.ch_num, stream.scan_freq, stream.mode
+        self.report_request_timing()
+        self.config_results.put_nowait((stream.config_id, True))
 
     def submit_to_gui_live_stream(self):
         """Run on separate thread; send data at a low frequency to GUI for live visualization"""
-        self.data_buffer = mp.Queue()
         temp_array = np.empty(self.array_shape, dtype='f')
         temp_array[:] = None
         while self.connected:
             try:
                 # Remember: LabJack data gets sent into the stream queue wrapped in a NamedObjectContainer
-                # data.name indicates if it has already been CONVERTED to readable data or not.
-                # data.obj is the raw or converted data.
-                data = self.data_buffer.get_nowait()
-                if data.name != CONVERTED:
-                    data = self.lj.processStreamData(data.obj['result'])
-                else:
-                    data = data.obj
+                # The writer thread has already CONVERTED data.obj to readable data.
+                data = self.data_buffer.get_nowait().obj
             except Queue.Empty:
                 time.sleep(1.0/1000.0)
             else:
@@ -321,34 +425,52 @@ class LabJackProcess(StoppableProcess):
     def update_shared_array(self, data, temp_array):
         """Updates the shared mp_array between LJ and GUI with new data"""
         # data_set is the raw output from self.streamData(); we process it to give results
-        # in a readable list format: {channel:[data]}
+        # in a readable list format: {channel:[data]}. Each channel has its own row, whatever the settings
         temp_array[:] = None
-        for i, ch in enumerate(self.ch_num):
-            channel = 'AIN{}'.format(ch)
+        for channel in data:
+            if not channel.startswith('AIN'):
+                continue
+            row = temp_array[int(channel[3:])]
             if not len(data[channel]) == 0:
-                temp_array[i][:len(data[channel])] = data[channel]
+                row[:len(data[channel])] = data[channel]
             else:
-                temp_array[i] = 0
+                row[:] = 0
         self.np_array[:] = temp_array
+        # Photometry, if any; a request may hold no new points
+        self.fp_np_array[:] = None
+        if FP_MAIN in data:
+            points = min(len(data[FP_MAIN]), FP_LIVE_POINTS)
+            if points:
+                for i, key in enumerate([FP_MAIN, FP_ISOS, FP_DFF]):
+                    self.fp_np_array[i][:points] = data[key][-points:]
 
     def run(self):
         """Starts the LabJack Process"""
         self.initialize()
         self.np_array = np.frombuffer(self.mp_array.get_obj(), dtype='f').reshape(self.array_shape)
+        self.fp_np_array = np.frombuffer(self.fp_array.get_obj(), dtype='f').reshape((len(FP_COLUMNS), FP_LIVE_POINTS))
+        # Queues are created before the threads that use them start
+        self.data_buffer = mp.Queue()
+        self.write_to_file_queue = Queue.Queue()
+        self.prepared_streams = Queue.Queue()
         # Threading
-        thread_names = 'data_sender', 'polling', 'writer'
+        thread_names = 'data_sender', 'polling', 'writer', 'configurer'
         send_data = tr.Thread(target=self.submit_to_gui_live_stream, name=thread_names[0])
         polling = tr.Thread(target=self.msg_polling, name=thread_names[1])
         writer = tr.Thread(target=self.write_to_file, name=thread_names[2])
+        configurer = tr.Thread(target=self.prepare_stream_settings, name=thread_names[3])
         send_data.start()
         polling.start()
         writer.start()
+        configurer.start()
         # Main LabJack Loop
         while self.connected:
+            # New settings are swapped in between requests, never while recording
+            if not self.recording and not self.prepared_streams.empty():
+                self.swap_stream_settings()
             # We run get_data() every loop regardless of GUI sync
             # to avoid missing data points due to GUI responsiveness.
-            if not self.lj_is_being_config:
-                self.get_data()
+            self.get_data()
             # If we stop, we close device, threads, inform proc_handler
             # before we fully exit the process
             if self.stopped():
@@ -371,8 +493,8 @@ class LabJackProcess(StoppableProcess):
             except self.lj_error:
                 self.report_lj_error()
             else:
-                if not self.data_to_gui_sync_event.is_set():
-                    self.data_buffer.put_nowait(NamedObjectContainer(obj=data, name=None))
+                # Every request is converted by the writer thread, so the lock-in sees an unbroken stream
+                self.write_to_file_queue.put_nowait(NamedObjectContainer(obj=(data, self.stream), name=LJ_LIVE_DATA))
         # Get a request with appending to file
         elif self.recording:
             if self.curr_request < self.ttl_num_requests:
@@ -381,15 +503,29 @@ class LabJackProcess(StoppableProcess):
                 except self.lj_error:
                     self.report_lj_error()
                 else:
-                    print('Missed: ', data['missed']) if data['missed'] != 0 else None
-                    self.write_to_file_queue.put_nowait(data)
+                    if data['missed']:
+                        self.health_array[LJ_HEALTH_MISSED] += data['missed']
+                    self.write_to_file_queue.put_nowait(NamedObjectContainer(obj=(data, self.stream),
+                                                                             name=LJ_REC_DATA))
+                    self.health_array[LJ_HEALTH_BACKLOG] = self.write_to_file_queue.qsize()
                     self.curr_request += 1
             else:
                 self.finish_record()
 
+    @staticmethod
+    def demodulate(data, stream):
+        """Runs the photometry pipeline of the request's settings on converted data;
+        adds and returns [main, isos, dF/F], or None"""
+        if not stream.fp_pipeline:
+            return None
+        pipeline, keys = stream.fp_pipeline
+        signals = pipeline.process(*[data[key] for key in keys])
+        data[FP_MAIN], data[FP_ISOS], data[FP_DFF] = signals
+        return signals
+
     def write_to_file(self):
-        """Run as seprate thread. Looks for data to write and writes a new line of data to file"""
-        self.write_to_file_queue = Queue.Queue()
+        """Run as seprate thread. Converts every request and demodulates photometry;
+        requests taken while recording are written as new lines of data to file"""
         while self.connected:
             try:
                 msg = self.write_to_file_queue.get_nowait()
@@ -398,12 +534,22 @@ class LabJackProcess(StoppableProcess):
             else:
                 if msg == LJ_REC_FALSE:
                     self.save_file_writer.close()
+                    if self.fp_file_writer:
+                        self.fp_file_writer.close()
+                        self.fp_file_writer = None
                 else:
-                    data = self.lj.processStreamData(msg['result'])
+                    # Requests are decoded under the settings they were taken with, even if new ones are in use
+                    data, stream = msg.obj
+                    data = stream.decoder.processStreamData(data['result'])
+                    signals = self.demodulate(data, stream)
                     if not self.data_to_gui_sync_event.is_set():
                         self.data_buffer.put_nowait(NamedObjectContainer(obj=data, name=CONVERTED))
-                    for row, _ in enumerate(data['AIN{}'.format(self.ch_num[0])]):
-                        for channel in self.ch_num:
+                    if msg.name != LJ_REC_DATA:
+                        continue
+                    if signals is not None and self.fp_file_writer:
+                        write_fp_block(self.fp_file_writer, signals)
+                    for row, _ in enumerate(data['AIN{}'.format(stream.ch_num[0])]):
+                        for channel in stream.ch_num:
                             ch = 'AIN{}'.format(channel)
                             append = data[ch][row]
                             self.save_file_writer.write('{},'.format(append))
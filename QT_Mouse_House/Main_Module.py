@@ -107,8 +107,6 @@ class GUI_Master(qg.QWidget):
                 self.exp_cntrls.enable_disable_widgets(False)
             elif msg.startswith(FAILED_INIT_HEADER):
                 print(msg)
-            elif msg == LJ_CONFIG:
-                self.exp_cntrls.lj_config_widget.lj_proc_updated = True
             elif msg.startswith(CMR_ERROR_EXIT):
                 cmr_ind = int(msg.replace(CMR_ERROR_EXIT, '', 1))
                 self.cameras.display_error_notif(cmr_ind)
@@ -66,12 +66,29 @@ default_dutycycle = 50
 LJ_ERROR_EXIT = '<lj_err_exit>'
 LJ_READY = '<lj_ready>'
 LJ_REC_FALSE = '<lj_rec_false>'
-LJ_CONFIG = '<lj_config>'
+LJ_RECONFIG_TIMEOUT = 5  # s; the GUI shows its old LabJack settings again if new ones are not reported in time
+LJ_NUM_CH = 14
+LJ_LIVE_DATA = '<lj_live_data>'
+LJ_REC_DATA = '<lj_rec_data>'
+# LabJack Health (indices into the shared health array)
+LJ_HEALTH_MISSED = 0
+LJ_HEALTH_BACKLOG = 1
+LJ_MISSED_ALARM = 1
+LJ_HEALTH_LATENCY = 2
+LJ_HEALTH_USB_EFF = 3
+# LabJack Request Modes
+LJ_LOW_LATENCY = 'Low Latency'
+LJ_HIGH_THROUGHPUT = 'High Throughput'
 # Other settings
 lj_color_scheme = [(51, 204, 153), (51, 179, 204),
                    (153, 51, 204), (216, 100, 239),
                    (179, 204, 51), (204, 153, 51),
                    (204, 77, 51), (102, 204, 51)]
+# Photometry: demodulated signals added to the LabJack data
+FP_MAIN = 'FP_MAIN'
+FP_ISOS = 'FP_ISOS'
+FP_DFF = 'FP_DFF'
+fp_color_scheme = [(0, 153, 76), (76, 76, 204), (204, 0, 102)]
 
 
 # GUI Pointers
@@ -0,0 +1,170 @@
+# coding=utf-8
+
+"""Offline Photometry Processing of Recorded LabJack Sessions
+Runs the live lock-in and dF/F pipeline over LabJack CSVs, one session per worker process:
+    python Photometry_Batch.py SESSION.csv [SESSION_DIR ...] [--scan-freq HZ] [--channels 8 12 13] [--jobs N]
+Each session gives [name]_fp.bin (see Photometry_Procs) and [name]_fp_summary.csv"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+import numpy as np
+import multiprocessing as mp
+from itertools import islice
+from Photometry_Procs import PhotometryPipeline, fp_channel_keys, open_fp_file, write_fp_block, FP_COLUMNS
+
+
+# Rows read from a session file at a time; sessions are never loaded whole
+CHUNK_ROWS = 65536
+# Used when neither the command line nor the file says otherwise; same as the example settings
+DEFAULT_SCAN_FREQ = 6250
+DEFAULT_FP_CH_NUM = [8, 12, 13]
+DEFAULT_MAIN_FREQ = 211
+DEFAULT_ISOS_FREQ = 531
+
+
+def read_header(csv_file):
+    """Reads up to and including the AIN column line. Returns (channel numbers, settings found in the
+    summary the Tkinter GUI puts above the data: scan_freq, ch_num, main_freq, isos_freq)"""
+    found = {}
+    names = []
+    for line in csv_file:
+        cells = [cell.strip() for cell in line.split(',')]
+        if cells[0].startswith('AIN'):
+            return [int(cell[3:]) for cell in cells if cell], found
+        if 'DATA CH' in cells:
+            names = cells
+        elif cells[0] == 'TIME (s)' and names:
+            values = dict(zip(names, cells))
+            found['ch_num'] = [int(values[name]) for name in ['DATA CH', 'MAIN REF CH', 'ISOS REF CH']]
+            found['main_freq'] = float(values['MAIN REF FREQ'])
+            found['isos_freq'] = float(values['ISOS REF FREQ'])
+        elif cells[0].upper() == 'SCAN FREQ (HZ)':
+            try:
+                found['scan_freq'] = int(round(float(cells[2])))
+            except (IndexError, ValueError):
+                pass
+    raise ValueError('No AIN column line found')
+
+
+def read_chunks(csv_file, num_columns):
+    """(rows, columns) arrays of at most CHUNK_ROWS rows; an incomplete last row is dropped"""
+    while True:
+        lines = list(islice(csv_file, CHUNK_ROWS))
+        if not lines:
+            return
+        text = ','.join(line.strip().rstrip(',') for line in lines if line.strip())
+        values = np.fromstring(text, sep=',') if text else np.zeros(0)
+        rows = values.size // num_columns
+        yield values[:rows * num_columns].reshape(rows, num_columns)
+
+
+class RunningStats(object):
+    """Count, mean, standard deviation, min and max of each column, over blocks of samples"""
+    def __init__(self, num_columns):
+        self.count = np.zeros(num_columns)
+        self.total = np.zeros(num_columns)
+        self.total_sq = np.zeros(num_columns)
+        self.low = np.full(num_columns, np.inf)
+        self.high = np.full(num_columns, -np.inf)
+
+    def update(self, block):
+        """Adds a (columns, samples) block; nan samples are skipped"""
+        valid = ~np.isnan(block)
+        values = np.where(valid, block, 0)
+        self.count += valid.sum(axis=1)
+        self.total += values.sum(axis=1)
+        self.total_sq += (values * values).sum(axis=1)
+        self.low = np.minimum(self.low, np.where(valid, block, np.inf).min(axis=1, initial=np.inf))
+        self.high = np.maximum(self.high, np.where(valid, block, -np.inf).max(axis=1, initial=-np.inf))
+
+    def rows(self):
+        """(name, value per column) summary rows"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = self.total / self.count
+            std = np.sqrt(np.maximum(self.total_sq / self.count - mean * mean, 0))
+        return [('MEAN', mean), ('STD', std), ('MIN', self.low), ('MAX', self.high)]
+
+
+def process_session(job):
+    """Runs the photometry pipeline over one session file; returns its summary lines, or an error line"""
+    path, out_dir, options = job
+    start = time.time()
+    name = os.path.splitext(os.path.basename(path))[0]
+    fp_path = os.path.join(out_dir, '{}_fp.bin'.format(name))
+    try:
+        with open(path, 'r') as csv_file:
+            columns, found = read_header(csv_file)
+            settings = dict(found)
+            settings.update((key, value) for key, value in options.items() if value is not None)
+            for key, default in [('scan_freq', DEFAULT_SCAN_FREQ), ('ch_num', DEFAULT_FP_CH_NUM),
+                                 ('main_freq', DEFAULT_MAIN_FREQ), ('isos_freq', DEFAULT_ISOS_FREQ)]:
+                settings.setdefault(key, default)
+            keys = fp_channel_keys(settings['ch_num'], columns)
+            if not keys:
+                raise ValueError('Photometry data channel AIN{} was not recorded'.format(settings['ch_num'][0]))
+            indices = [columns.index(int(key[3:])) for key in keys]
+            pipeline = PhotometryPipeline(settings['scan_freq'], settings['main_freq'], settings['isos_freq'],
+                                          with_refs=len(keys) == 3)
+            stats = RunningStats(len(FP_COLUMNS))
+            num_samples = 0
+            fp_file = open_fp_file(fp_path, pipeline.rate)
+            try:
+                for chunk in read_chunks(csv_file, len(columns)):
+                    signals = pipeline.process(*[chunk[:, index] for index in indices])
+                    write_fp_block(fp_file, signals)
+                    stats.update(signals)
+                    num_samples += len(chunk)
+            finally:
+                fp_file.close()
+    except (IOError, ValueError, KeyError) as error:
+        return '{}: skipped; {}'.format(path, error)
+    # Per session summary
+    lines = ['SOURCE,{}'.format(path),
+             'DATA CH,{},MAIN REF CH,{},ISOS REF CH,{}'.format(*(settings['ch_num'] + [None] * 3)[:3]),
+             'REFERENCES USED,{}'.format('yes' if len(keys) == 3 else 'no (magnitude)'),
+             'MAIN REF FREQ (Hz),{},ISOS REF FREQ (Hz),{}'.format(settings['main_freq'], settings['isos_freq']),
+             'SCAN FREQ (Hz),{},SAMPLES,{},DURATION (s),{:.3f}'.format(settings['scan_freq'], num_samples,
+                                                                       num_samples / float(settings['scan_freq'])),
+             'OUTPUT RATE (Hz),{:.4f},OUTPUTS,{:.0f}'.format(pipeline.rate, stats.count[0]),
+             ',' + ','.join(FP_COLUMNS)]
+    lines += ['{},{}'.format(row, ','.join('{:.6g}'.format(value) for value in values))
+              for row, values in stats.rows()]
+    lines.append('PROCESSING TIME (s),{:.2f}'.format(time.time() - start))
+    with open(os.path.join(out_dir, '{}_fp_summary.csv'.format(name)), 'w') as summary_file:
+        summary_file.write('\n'.join(lines) + '\n')
+    return '{}: {} samples -> {:.0f} outputs in {:.2f} s'.format(path, num_samples, stats.count[0],
+                                                                time.time() - start)
+
+
+def session_files(paths):
+    """CSV files given directly, or found in given directories; outputs of this module are left out"""
+    found = []
+    for path in paths:
+        found.extend(sorted(glob.glob(os.path.join(path, '*.csv'))) if os.path.isdir(path) else [path])
+    return [path for path in found if not path.endswith('_fp_summary.csv')]
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Demodulate and compute dF/F for recorded LabJack sessions.')
+    PARSER.add_argument('paths', nargs='+', help='session CSV files, or directories of them')
+    PARSER.add_argument('--out', default=None, help='output directory; default is next to each session')
+    PARSER.add_argument('--scan-freq', type=int, default=None, help='scan frequency the sessions were recorded at')
+    PARSER.add_argument('--channels', type=int, nargs='+', default=None, help='data, main ref, isos ref channels')
+    PARSER.add_argument('--main-freq', type=float, default=None, help='main reference frequency')
+    PARSER.add_argument('--isos-freq', type=float, default=None, help='isosbestic reference frequency')
+    PARSER.add_argument('--jobs', type=int, default=mp.cpu_count(), help='worker processes')
+    ARGS = PARSER.parse_args()
+    OPTIONS = {'scan_freq': ARGS.scan_freq, 'ch_num': ARGS.channels,
+               'main_freq': ARGS.main_freq, 'isos_freq': ARGS.isos_freq}
+    JOBS = [(path, ARGS.out or os.path.dirname(os.path.abspath(path)), OPTIONS)
+            for path in session_files(ARGS.paths)]
+    if not JOBS:
+        sys.exit('No session files found')
+    POOL = mp.Pool(processes=max(1, min(ARGS.jobs, len(JOBS))))
+    for REPORT in POOL.imap_unordered(process_session, JOBS):
+        print(REPORT)
+    POOL.close()
+    POOL.join()
@@ -0,0 +1,192 @@
+# coding=utf-8
+
+"""Software Lock-In Amplifier and dF/F for Fiber Photometry Channels Streamed by the LabJack"""
+
+import numpy as np
+from struct import Struct
+from numpy.lib.stride_tricks import as_strided
+
+
+# Demodulated signals are low passed, then decimated to about FP_OUTPUT_RATE
+FP_OUTPUT_RATE = 100  # Hz
+FP_CUTOFF = 15  # Hz; top of the pass band
+FP_STOP = 50  # Hz; bottom of the stop band, at the output Nyquist frequency
+# dF/F is taken against the isosbestic signal fitted to the main signal over this sliding window
+FP_DFF_WINDOW = 60  # s
+# Columns of the pipeline output, the live graph and the compact file
+FP_COLUMNS = ['Main', 'Isos', 'dF/F']
+# Most demodulated points one request can hand the live graph
+FP_LIVE_POINTS = 64
+# Compact output file: header, then one little endian float32 per column for every output sample
+FP_FILE_HEADER = Struct('<4sBf')  # magic, number of columns, output rate in Hz
+FP_FILE_MAGIC = b'FPLI'
+
+
+def fp_channel_keys(fp_ch_num, lj_ch_num):
+    """LabJack data keys of [data, main ref, isos ref] if all are streamed, [data] if the references
+    are not, and [] if the photometry data channel is not streamed at all"""
+    if not fp_ch_num or fp_ch_num[0] not in lj_ch_num:
+        return []
+    if len(fp_ch_num) >= 3 and all(ch in lj_ch_num for ch in fp_ch_num[1:3]):
+        return ['AIN{}'.format(ch) for ch in fp_ch_num[:3]]
+    return ['AIN{}'.format(fp_ch_num[0])]
+
+
+def folded(freq, scan_freq):
+    """Frequency a component at freq appears at after sampling at scan_freq"""
+    return abs(freq - scan_freq * round(float(freq) / scan_freq))
+
+
+def check_frequencies(scan_freq, main_freq, isos_freq):
+    """Raises ValueError if the two excitations cannot be separated at this scan frequency"""
+    if max(main_freq, isos_freq) + FP_STOP >= scan_freq / 2.0:
+        raise ValueError('Scan frequency [{} Hz] is too low for references at [{} Hz] and [{} Hz]'
+                         ''.format(scan_freq, main_freq, isos_freq))
+    # Mixing products that the low pass filter must remove
+    products = [2 * main_freq, 2 * isos_freq, main_freq + isos_freq, abs(main_freq - isos_freq)]
+    if any(folded(freq, scan_freq) < FP_STOP for freq in products):
+        raise ValueError('References at [{} Hz] and [{} Hz] mix into the pass band at a scan frequency of [{} Hz]'
+                         ''.format(main_freq, isos_freq, scan_freq))
+
+
+def lowpass_taps(scan_freq):
+    """Blackman windowed sinc low pass; symmetric, with unit gain at DC"""
+    num_taps = int(np.ceil(5.5 * scan_freq / (FP_STOP - FP_CUTOFF))) | 1
+    cutoff = (FP_CUTOFF + FP_STOP) / 2.0 / scan_freq
+    taps = np.sinc(2 * cutoff * (np.arange(num_taps) - (num_taps - 1) / 2.0)) * np.blackman(num_taps)
+    return taps / taps.sum()
+
+
+class DecimatingFilter(object):
+    """FIR filter evaluated only at the samples kept after decimation, for several streams at once
+    Keeps the samples the next output still needs between blocks, so blocks can be any length"""
+    def __init__(self, taps, factor, num_streams):
+        self.taps = taps
+        self.factor = factor
+        self.history = np.zeros((num_streams, 0))
+
+    def process(self, block):
+        """(streams, samples) block -> (streams, outputs) filtered and decimated block"""
+        x = np.ascontiguousarray(np.concatenate((self.history, block), axis=1))
+        num_out = max(0, (x.shape[1] - self.taps.size) // self.factor + 1)
+        # Each output is the dot product of the taps with a window starting factor samples after the last
+        windows = as_strided(x, shape=(x.shape[0], num_out, self.taps.size),
+                             strides=(x.strides[0], x.strides[1] * self.factor, x.strides[1]))
+        self.history = x[:, num_out * self.factor:]
+        return np.dot(windows, self.taps)
+
+
+class LockIn(object):
+    """Streaming quadrature lock-in for one photometry data channel excited at a main and an isosbestic frequency
+    The data, and the references if recorded, are mixed with quadrature oscillators, low passed and decimated.
+    With references, each signal is the amplitude in phase with its reference; otherwise it is the magnitude"""
+    def __init__(self, scan_freq, main_freq, isos_freq, with_refs=True):
+        check_frequencies(scan_freq, main_freq, isos_freq)
+        self.with_refs = with_refs
+        self.factor = max(1, int(round(float(scan_freq) / FP_OUTPUT_RATE)))
+        self.rate = float(scan_freq) / self.factor
+        # Oscillator phases carry over between blocks
+        self.step = 2 * np.pi * np.array([main_freq, isos_freq], dtype=float) / scan_freq
+        self.phase = np.zeros(2)
+        # Streams: I, Q of the data at main, at isos; then I, Q of the main ref, of the isos ref
+        self.filter = DecimatingFilter(lowpass_taps(scan_freq), self.factor, 8 if with_refs else 4)
+
+    def process(self, data, main_ref=None, isos_ref=None):
+        """One block of samples -> (2, outputs) array of demodulated [main, isos]"""
+        data = np.asarray(data, dtype=float)
+        phase = self.phase[:, np.newaxis] + self.step[:, np.newaxis] * np.arange(data.size)
+        self.phase = (self.phase + self.step * data.size) % (2 * np.pi)
+        oscillators = np.stack((np.cos(phase), np.sin(phase)), axis=1)  # (main/isos, I/Q, samples)
+        mixed = [data * oscillators]
+        if self.with_refs:
+            refs = np.asarray([main_ref, isos_ref], dtype=float)
+            mixed.append(refs[:, np.newaxis] * oscillators)
+        # Mixing halves the amplitude
+        out = 2 * self.filter.process(np.concatenate(mixed).reshape(-1, data.size))
+        signal = out[:4].reshape(2, 2, -1)
+        if not self.with_refs:
+            return np.hypot(signal[:, 0], signal[:, 1])
+        ref = out[4:].reshape(2, 2, -1)
+        ref_amplitude = np.hypot(ref[:, 0], ref[:, 1])
+        return (signal * ref).sum(axis=1) / np.maximum(ref_amplitude, np.finfo(float).tiny)
+
+
+class DeltaF(object):
+    """Sliding window least squares fit of isos to main; dF/F = (main - fit) / fit
+    The window's sums are kept running, so each sample costs O(1) however long the window is"""
+    def __init__(self, window_samples):
+        self.window = max(2, int(window_samples))
+        # Last window samples of [isos, main]; unfilled slots are zero and count for nothing
+        self.ring = np.zeros((2, self.window))
+        self.pos = 0
+        self.count = 0
+        # Sums of isos, main, isos^2, isos*main over the window
+        self.sums = np.zeros(4)
+
+    @staticmethod
+    def terms(isos, main):
+        """(4, samples) terms of the running sums"""
+        return np.array([isos, main, isos * isos, isos * main])
+
+    def process(self, main, isos):
+        """dF/F of each new sample, fitted over the window ending at that sample"""
+        main = np.asarray(main, dtype=float)
+        isos = np.asarray(isos, dtype=float)
+        # Samples leaving the window must already be in the ring, so take at most a window at a time
+        if main.size > self.window:
+            return np.concatenate([self.process(main[i:i + self.window], isos[i:i + self.window])
+                                   for i in range(0, main.size, self.window)])
+        slots = (self.pos + np.arange(main.size)) % self.window
+        leaving = self.ring[:, slots]
+        sums = self.sums[:, np.newaxis] + np.cumsum(self.terms(isos, main) - self.terms(*leaving), axis=1)
+        self.ring[:, slots] = isos, main
+        self.pos = (self.pos + main.size) % self.window
+        count = np.minimum(self.count + np.arange(1, main.size + 1), self.window)
+        self.count = count[-1] if main.size else self.count
+        # Rounding errors cannot build up: the sums are recomputed every time the ring wraps
+        if self.pos < main.size:
+            self.sums = self.terms(*self.ring).sum(axis=1)
+        elif main.size:
+            self.sums = sums[:, -1]
+        sum_x, sum_y, sum_xx, sum_xy = sums
+        with np.errstate(divide='ignore', invalid='ignore'):
+            denominator = count * sum_xx - sum_x * sum_x
+            slope = np.where(denominator > 0, (count * sum_xy - sum_x * sum_y) / denominator, 0)
+            fit = slope * isos + (sum_y - slope * sum_x) / count
+            return np.where(fit != 0, (main - fit) / fit, 0)
+
+
+class PhotometryPipeline(object):
+    """Lock-in demodulation followed by dF/F; turns blocks of samples into blocks of FP_COLUMNS"""
+    def __init__(self, scan_freq, main_freq, isos_freq, with_refs=True):
+        self.lock_in = LockIn(scan_freq, main_freq, isos_freq, with_refs)
+        self.rate = self.lock_in.rate
+        self.delta_f = DeltaF(FP_DFF_WINDOW * self.rate)
+
+    def process(self, data, main_ref=None, isos_ref=None):
+        """One block of samples -> (3, outputs) array of [main, isos, dF/F]"""
+        main, isos = self.lock_in.process(data, main_ref, isos_ref)
+        return np.array([main, isos, self.delta_f.process(main, isos)])
+
+
+# -- Compact Output File -- #
+def open_fp_file(path, rate, num_columns=len(FP_COLUMNS)):
+    """Opens a compact photometry file for writing and writes its header"""
+    fp_file = open(path, 'wb')
+    fp_file.write(FP_FILE_HEADER.pack(FP_FILE_MAGIC, num_columns, rate))
+    return fp_file
+
+
+def write_fp_block(fp_file, signals):
+    """Appends a (columns, outputs) block of signals"""
+    fp_file.write(np.asarray(signals, dtype='<f4').T.tobytes())
+
+
+def read_fp_file(path):
+    """(output rate in Hz, (columns, outputs) array) from a compact photometry file"""
+    with open(path, 'rb') as fp_file:
+        magic, num_columns, rate = FP_FILE_HEADER.unpack(fp_file.read(FP_FILE_HEADER.size))
+        if magic != FP_FILE_MAGIC:
+            raise ValueError('[{}] is not a photometry file'.format(path))
+        signals = np.frombuffer(fp_file.read(), dtype='<f4')
+    return rate, signals.reshape(-1, num_columns).T
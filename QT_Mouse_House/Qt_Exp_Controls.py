@@ -10,6 +10,7 @@ from Custom_Qt_Tools import *
 from copy import deepcopy
 from Dirs_Settings import ArdDataContainer
 from Custom_Qt_Widgets import GUI_LiveScrollingGraph, GUI_LJDataReport, GUI_StatusBars
+from LJ_Procs import request_size, request_timing
 import PyQt4.QtGui as qg
 import PyQt4.QtCore as qc
 
@@ -31,7 +32,7 @@ class GUI_ExpControls(qg.QWidget):
         self.device_presets_widget = GUI_DevicePresets(self.dirs, self.gui_progbar,
                                                        self.lj_config_widget,
                                                        self.time_config_widget)
-        self.status_bars = GUI_StatusBars()
+        self.status_bars = GUI_StatusBars(self.lj_graph_widget)
         # Layout
         self.setup_tabs()
         self.grid = qg.QGridLayout()
@@ -105,8 +106,11 @@ class GUI_LabJackConfig(qg.QWidget):
         qg.QWidget.__init__(self)
         self.num_ch = 14
         self.dirs = dirs
-        self.lj_proc_updated = False
+        # Settings sent to lj_proc and not yet reported on, by config id
+        self.pending = {}
+        self.latest_config_id = 0
         self.grapher = grapher
+        self.grapher.lj_reconfigured.connect(self.lj_reconfigured)
         self.proc_handler_queue = PROC_HANDLER_QUEUE
         self.grid = qg.QGridLayout()
         self.setLayout(self.grid)
@@ -123,7 +127,9 @@ class GUI_LabJackConfig(qg.QWidget):
         grid.addWidget(self.init_summary_label(), 0, 0)
         grid.addWidget(self.init_entry(), 1, 0)
         grid.addWidget(self.init_checkboxes(), 2, 0)
+        grid.addWidget(self.init_mode_buttons(), 3, 0)
         self.reload_gui_info(True)
+        self.grapher.reset_plots()
 
     def init_summary_label(self):
         """Sets up a label for summarizing labjack settings"""
@@ -170,6 +176,23 @@ class GUI_LabJackConfig(qg.QWidget):
         [self.checkboxes[i].clicked.connect(self.save_channels) for i in list(range(self.num_ch))]
         return frame
 
+    def init_mode_buttons(self):
+        """Sets up buttons to choose between small (low latency) and large (high throughput) requests"""
+        frame = qg.QFrame()
+        grid = qg.QGridLayout()
+        frame.setLayout(grid)
+        grid.addWidget(qg.QLabel('Request Size:'), 0, 0, 1, 2)
+        self.mode_buttons = {mode: qg.QRadioButton(mode) for mode in [LJ_LOW_LATENCY, LJ_HIGH_THROUGHPUT]}
+        for index, mode in enumerate([LJ_LOW_LATENCY, LJ_HIGH_THROUGHPUT]):
+            self.mode_buttons[mode].clicked.connect(lambda checked=False, mode=mode: self.save_mode(mode))
+            grid.addWidget(self.mode_buttons[mode], 1, index)
+        return frame
+
+    def save_mode(self, mode):
+        """Sets the request size mode"""
+        if mode != self.dirs.settings.lj_last_used.mode:
+            self.update_lj_last_used(mode=mode, reset_gui_elements=False)
+
     def set_max_freq_label(self):
         """Shows user the maximum scan freq allowed"""
         num_ch = len(self.dirs.settings.lj_last_used.ch_num)
@@ -181,7 +204,12 @@ class GUI_LabJackConfig(qg.QWidget):
         """Sets the summary label to reflect most updated LJ settings"""
         ch = self.dirs.settings.lj_last_used.ch_num
         freq = self.dirs.settings.lj_last_used.scan_freq
-        self.summ_label.setText('Channels:\n{}\n\nScan Freq: [{} Hz]'.format(ch, freq))
+        mode = self.dirs.settings.lj_last_used.mode
+        packets, smpls_per_pack = request_size(freq, len(ch), mode)
+        latency, efficiency = request_timing(freq, len(ch), packets, smpls_per_pack)
+        self.summ_label.setText('Channels:\n{}\n\nScan Freq: [{} Hz]\n\n{}: [{} Samples/Request]\n'
+                                'Latency: [{:.1f} ms] | USB Efficiency: [{:.0%}]'
+                                ''.format(ch, freq, mode, packets * smpls_per_pack, latency, efficiency))
 
     def save_scan_freq(self):
         """Sets the scan frequency"""
@@ -194,27 +222,42 @@ class GUI_LabJackConfig(qg.QWidget):
             return
         self.update_lj_last_used(scan_freq=int(deepcopy(scan_freq)), reset_gui_elements=False)
 
-    def update_lj_last_used(self, ch_num=None, scan_freq=None, send_to_proc_handler=True, reset_gui_elements=False):
-        """Update dirs.settings.lj_last_used. Also notify proc_handler to update lj_proc settings"""
-        self.grapher.plots_are_reset = False
+    def update_lj_last_used(self, ch_num=None, scan_freq=None, reset_gui_elements=False, mode=None):
+        """Sends new settings to lj_proc; dirs.settings.lj_last_used is updated once lj_proc streams with them"""
         if not ch_num:
             ch_num = deepcopy(self.dirs.settings.lj_last_used.ch_num)
         if not scan_freq:
             scan_freq = deepcopy(self.dirs.settings.lj_last_used.scan_freq)
-        # first notify proc_handler to update lj_proc settings
-        if not self.lj_proc_updated:
-            # Send Message
-            if send_to_proc_handler:
-                self.proc_handler_queue.put_nowait('{}{}|{}'.format(LJ_CONFIG, ch_num, scan_freq))
-            # check back every 5 ms until lj_proc has been updated
-            qc.QTimer.singleShot(5, lambda: self.update_lj_last_used(ch_num, scan_freq, False, reset_gui_elements))
-        # once proc_handler has updated lj_procs, we update the GUI
-        elif self.lj_proc_updated:
-            self.dirs.settings.lj_last_used.ch_num = deepcopy(ch_num)
-            self.dirs.settings.lj_last_used.scan_freq = deepcopy(scan_freq)
+        if not mode:
+            mode = self.dirs.settings.lj_last_used.mode
+        config_id = self.grapher.reconfigure(ch_num, scan_freq, mode)
+        self.pending[config_id] = (deepcopy(ch_num), deepcopy(scan_freq), mode, reset_gui_elements)
+        self.latest_config_id = config_id
+        qc.QTimer.singleShot(LJ_RECONFIG_TIMEOUT * 1000, lambda: self.check_reconfigured(config_id))
+
+    def lj_reconfigured(self, config_id, applied):
+        """lj_proc reports settings it was sent as applied, or as refused or superseded by later settings.
+        Only applied settings are saved; the plots are then resized in place"""
+        if config_id not in self.pending:
+            return
+        ch_num, scan_freq, mode, reset_gui_elements = self.pending.pop(config_id)
+        if applied:
+            self.dirs.settings.lj_last_used.ch_num = ch_num
+            self.dirs.settings.lj_last_used.scan_freq = scan_freq
+            self.dirs.settings.lj_last_used.mode = mode
+            self.grapher.resize_plots()
+        if applied and config_id == self.latest_config_id:
             self.reload_gui_info(reset_gui_elements)
-            self.lj_proc_updated = False
-            self.grapher.update_graphs()
+        else:
+            # Once nothing is pending, the controls show the settings lj_proc streams with
+            self.reload_gui_info(not self.pending)
+
+    def check_reconfigured(self, config_id):
+        """Shows the saved settings again if lj_proc has not reported on config_id in time"""
+        if config_id in self.pending:
+            print('LabJack did not confirm new settings within {} s; showing previous settings'
+                  ''.format(LJ_RECONFIG_TIMEOUT))
+            self.reload_gui_info(True)
 
     def save_channels(self):
         """Saves channels selected based on boxes checked"""
@@ -245,10 +288,10 @@ class GUI_LabJackConfig(qg.QWidget):
         if reset_gui_elements:
             self.scan_freq_entry.setText(str(self.dirs.settings.lj_last_used.scan_freq))
             self.set_channels()
+            self.mode_buttons[self.dirs.settings.lj_last_used.mode].setChecked(True)
         self.set_summ_label()
         self.enable_disable_chkboxes()
         self.set_max_freq_label()
-        self.grapher.reset_plots()
 
     def set_channels(self):
         """Sets channels based on which ones enabled in dirs.settings"""
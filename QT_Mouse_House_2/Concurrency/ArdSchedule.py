@@ -0,0 +1,215 @@
+# coding=utf-8
+
+"""Compiles arduino segments into one time sorted event list for the firmware, and simulates its timing
+Run from the QT_Mouse_House_2 directory: python -m Concurrency.ArdSchedule (simulates the example preset)"""
+
+import math
+from heapq import heappush, heappop
+from itertools import groupby
+from operator import attrgetter
+from struct import Struct
+from Misc.Names import TONE, OUTP, PWM, TONE_PIN
+
+
+# Event kinds; the firmware applies each event once, when it is due
+EVT_PORTD = 0  # mask is the new state of the D register outputs
+EVT_TONE = 1  # freq is the new tone on pin 10; 0 turns it off
+EVT_PWM_ON = 2  # mask is the B register pin; cycle times and phase shift in us
+EVT_PWM_OFF = 3  # mask is the B register pin
+# Packets: time ms, kind, mask, freq, cycle on us, cycle off us, phase shift us
+ARD_EVENT = Struct('<LBBHLLL')
+# Firmware limits; must match MAX_EVENTS and EVENT_BLOCK in Arduino-Fear-Firmware.ino
+ARD_MAX_EVENTS = 32  # ring buffer, refilled while running
+ARD_EVENT_BLOCK = 8  # events sent per refill
+ARD_MAX_TOTAL_EVENTS = 65535  # event count is sent as an unsigned int
+ARD_MAX_FREQ = 65535
+# A refill arrives at most this long after the firmware asks: host polling, USB latency, then the block itself
+# at 115200 baud (11.52 bytes/ms); the events still buffered must last at least this long
+ARD_REFILL_MS = 5 + 16 + int(math.ceil((2 + ARD_EVENT_BLOCK * ARD_EVENT.size) / 11.52))
+# Pins 8-13 are bits 0-5 of the B register
+B_REGISTER_OFFSET = 8
+
+# Firmware cost model, in CPU cycles; estimated from the instructions each step compiles to, not measured
+ARD_CPU_HZ = 16000000
+CYC_LOOP = 60  # loop() overhead, checkSerial() with nothing waiting, one millis()
+CYC_EVENT_CHECK = 12  # comparing the next event's time
+CYC_EVENT = {EVT_PORTD: 20, EVT_TONE: 400, EVT_PWM_ON: 120, EVT_PWM_OFF: 60}
+CYC_PWM = 70  # micros() and compare for each running PWM channel
+MICROS_RESOLUTION = 4  # us
+# The previous firmware scanned every segment on every loop, calling millis() several times per segment
+CYC_SCAN = {TONE: 260, OUTP: 180, PWM: 330}
+
+
+class ArdEvent(object):
+    """One scheduled change of the Arduino's outputs"""
+    def __init__(self, time_ms, kind, mask=0, freq=0, cycle_on=0, cycle_off=0, phase_shift=0):
+        self.time_ms = time_ms
+        self.kind = kind
+        self.mask = mask
+        self.freq = freq
+        self.cycle_on = cycle_on
+        self.cycle_off = cycle_off
+        self.phase_shift = phase_shift
+
+    def pack(self):
+        """Packet requested by the firmware"""
+        return ARD_EVENT.pack(self.time_ms, self.kind, self.mask, self.freq,
+                              self.cycle_on, self.cycle_off, self.phase_shift)
+
+
+def pwm_cycle_times(segment):
+    """(cycle on, cycle off, phase shift) of a PWM segment in us"""
+    period = 1000000.0 / segment.freq
+    duty = segment.duty_cycle / 100.0
+    phase = (segment.phast_shift or 0) / 360.0
+    return int(round(period * duty)), int(round(period * (1 - duty))), int(round(period * phase))
+
+
+def active_changes(segments):
+    """(time, segment) every time the segment in effect changes; segment is None while none is on
+    Where segments overlap, the one started last is in effect"""
+    segments = sorted(segments, key=attrgetter('on_ms'))
+    times = sorted(set([segment.on_ms for segment in segments] + [segment.off_ms for segment in segments]))
+    changes = []
+    started = []
+    index = 0
+    current = None
+    for time_ms in times:
+        while index < len(segments) and segments[index].on_ms <= time_ms:
+            heappush(started, (-segments[index].on_ms, -index, segments[index]))
+            index += 1
+        # Segments that ended are dropped once they reach the top
+        while started and started[0][2].off_ms <= time_ms:
+            heappop(started)
+        active = started[0][2] if started else None
+        if active is not current:
+            changes.append((time_ms, active))
+            current = active
+    return changes
+
+
+def compile_schedule(configs):
+    """Time sorted events playing back a list of ArdSegment"""
+    events = []
+    # Outputs: the whole D register state, at every time it changes
+    edges = sorted([(cfg.on_ms, 1, cfg.pin) for cfg in configs if cfg.types == OUTP] +
+                   [(cfg.off_ms, -1, cfg.pin) for cfg in configs if cfg.types == OUTP])
+    segments_on = {}
+    state = 0
+    for time_ms, group in groupby(edges, key=lambda edge: edge[0]):
+        for _, step, pin in group:
+            segments_on[pin] = segments_on.get(pin, 0) + step
+        new_state = sum(1 << pin for pin, count in segments_on.items() if count > 0)
+        if new_state != state:
+            events.append(ArdEvent(time_ms, EVT_PORTD, mask=new_state))
+            state = new_state
+    # Tone
+    for time_ms, segment in active_changes([cfg for cfg in configs if cfg.types == TONE]):
+        events.append(ArdEvent(time_ms, EVT_TONE, freq=segment.freq if segment else 0))
+    # PWM, one channel per pin
+    pwm_pins = sorted(set(cfg.pin for cfg in configs if cfg.types == PWM))
+    for pin in pwm_pins:
+        mask = 1 << (pin - B_REGISTER_OFFSET)
+        running = None
+        for time_ms, segment in active_changes([cfg for cfg in configs if cfg.types == PWM and cfg.pin == pin]):
+            if running:
+                events.append(ArdEvent(time_ms, EVT_PWM_OFF, mask=mask))
+            if segment:
+                cycle_on, cycle_off, phase_shift = pwm_cycle_times(segment)
+                events.append(ArdEvent(time_ms, EVT_PWM_ON, mask, 0, cycle_on, cycle_off, phase_shift))
+            running = segment
+    # Stable sort: at equal times, a pin's PWM is stopped before it is restarted
+    events.sort(key=attrgetter('time_ms'))
+    return events
+
+
+def check_schedule(events, ttl_time):
+    """Raises ValueError if the firmware cannot hold or stream the events in time"""
+    if len(events) > ARD_MAX_TOTAL_EVENTS:
+        raise ValueError('{} events exceed the Arduino limit of {}'.format(len(events), ARD_MAX_TOTAL_EVENTS))
+    if events and events[-1].time_ms > ttl_time:
+        raise ValueError('Events continue past the total experiment time')
+    if any(event.freq > ARD_MAX_FREQ for event in events):
+        raise ValueError('Tone frequencies cannot exceed {} Hz'.format(ARD_MAX_FREQ))
+    # When the firmware asks for a refill, the events it still holds must last until the refill arrives
+    held = ARD_MAX_EVENTS - ARD_EVENT_BLOCK
+    for index in range(len(events) - held):
+        if events[index + held].time_ms - events[index].time_ms < ARD_REFILL_MS:
+            raise ValueError('More than {} events within {} ms at {} ms; the Arduino cannot be refilled in time'
+                             ''.format(held, ARD_REFILL_MS, events[index].time_ms))
+
+
+def schedule_pins(events):
+    """(D register, B register) pins the schedule drives"""
+    pins_d = 0
+    pins_b = 0
+    for event in events:
+        if event.kind == EVT_PORTD:
+            pins_d |= event.mask
+        elif event.kind == EVT_TONE:
+            pins_b |= 1 << (TONE_PIN - B_REGISTER_OFFSET)
+        else:
+            pins_b |= event.mask
+    return pins_d, pins_b
+
+
+def scan_cycles(configs):
+    """Cycles the previous firmware spent on every loop scanning the segments"""
+    return sum(CYC_SCAN[cfg.types] for cfg in configs)
+
+
+class ScheduleTiming(object):
+    """Timing of one schedule played back by the firmware, in us"""
+    def __init__(self, loop_us, worst_loop_us, lateness_us, pwm_jitter_us):
+        self.loop_us = loop_us  # loop period while nothing is due
+        self.worst_loop_us = worst_loop_us  # longest loop, including events applied in it
+        self.max_lateness_us = max(lateness_us) if lateness_us else 0
+        self.mean_lateness_us = sum(lateness_us) / len(lateness_us) if lateness_us else 0
+        self.pwm_jitter_us = pwm_jitter_us  # worst delay of a PWM edge
+
+    def report(self):
+        """Human readable summary"""
+        return ('loop {:.1f} us (worst {:.1f} us); event lateness mean {:.1f} us, worst {:.1f} us; '
+                'PWM edge jitter {:.1f} us'.format(self.loop_us, self.worst_loop_us, self.mean_lateness_us,
+                                                   self.max_lateness_us, self.pwm_jitter_us))
+
+
+def simulate(events, extra_cycles=0):
+    """Plays events back against the firmware's cost model, one loop at a time
+    Events are late by the time until the next loop reads millis(), plus the events applied before them
+    extra_cycles is added to every loop; scan_cycles() models the previous firmware"""
+    us_per_cycle = 1000000.0 / ARD_CPU_HZ
+    # Worst case steady loop: as many PWM channels running as ever run at once
+    running = peak = 0
+    for event in events:
+        running += {EVT_PWM_ON: 1, EVT_PWM_OFF: -1}.get(event.kind, 0)
+        peak = max(peak, running)
+    loop_us = (CYC_LOOP + CYC_EVENT_CHECK + peak * CYC_PWM + extra_cycles) * us_per_cycle
+    worst_loop_us = loop_us
+    lateness = []
+    loop_start = 0.0
+    index = 0
+    while index < len(events):
+        due = events[index].time_ms * 1000.0
+        if loop_start < due:
+            loop_start += math.ceil((due - loop_start) / loop_us) * loop_us
+        # This loop applies every event due when it read millis()
+        elapsed = CYC_LOOP * us_per_cycle
+        while index < len(events) and events[index].time_ms * 1000.0 <= loop_start:
+            elapsed += (CYC_EVENT_CHECK + CYC_EVENT[events[index].kind]) * us_per_cycle
+            lateness.append(loop_start + elapsed - events[index].time_ms * 1000.0)
+            index += 1
+        loop_us_now = loop_us + elapsed - CYC_LOOP * us_per_cycle
+        worst_loop_us = max(worst_loop_us, loop_us_now)
+        loop_start += loop_us_now
+    pwm_jitter_us = worst_loop_us + MICROS_RESOLUTION if peak else 0
+    return ScheduleTiming(loop_us, worst_loop_us, lateness, pwm_jitter_us)
+
+
+if __name__ == '__main__':
+    from DirsSettings.Settings import ArdSettings
+    CONFIGS = ArdSettings().load_example().configs
+    EVENTS = compile_schedule(CONFIGS)
+    print('{} segments -> {} events'.format(len(CONFIGS), len(EVENTS)))
+    print('event list firmware:  {}'.format(simulate(EVENTS).report()))
+    print('segment scan firmware: {}'.format(simulate(EVENTS, scan_cycles(CONFIGS)).report()))
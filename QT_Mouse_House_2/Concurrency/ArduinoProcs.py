@@ -0,0 +1,376 @@
+# coding=utf-8
+
+"""Process handling serial communication with the Arduino, including closed-loop stimulus triggering"""
+
+import sys
+import glob
+import time
+import calendar
+import serial
+from struct import pack
+from Misc.Names import *
+from Misc.CustomClasses import *
+from Concurrency.ArdSchedule import compile_schedule, check_schedule, schedule_pins, ARD_MAX_EVENTS, ARD_EVENT_BLOCK
+from Tracking.Tracker import TRK_FRAME, TRK_TIME, TRK_X, TRK_Y, TRK_FOUND
+
+
+# Serial link
+ARD_BAUDRATE = 115200
+ARD_TIMEOUT = 3.5  # s; the Arduino resets when the port opens and takes ~2s to boot
+ARD_START_MARKER = b'<'
+ARD_END_MARKER = b'>'
+ARD_READY = 'ready'
+ARD_REQUEST = 'M'
+ARD_ACK = 'a'
+ARD_EVENTS_REQUEST = 'R'
+# Packets
+ARD_START_BYTE = pack('<B', 1)
+ARD_TRIGGER_HEADER = b'T'
+ARD_EVENTS_HEADER = b'E'
+# D register pins 0 and 1 are the serial lines
+SERIAL_PINS_MASK = 0b00000011
+# Seconds past the experiment time after which we stop waiting for the Arduino's end message
+ARD_END_GRACE = 2.0
+# Closed loop checks for new tracking records this often; well below one frame period
+CL_POLL_INTERVAL = 0.5 / 1000.0
+ARD_POLL_INTERVAL = 5.0 / 1000.0
+CL_ACK_TIMEOUT = 0.1
+
+
+class ArduinoLink(object):
+    """Serial link to the Arduino firmware; messages from the Arduino are framed as <message>"""
+    def __init__(self, port):
+        self.port = port
+        self.serial = None
+        self.read_buffer = b''
+
+    @staticmethod
+    def list_serial_ports():
+        """Lists the serial ports available on this platform"""
+        if sys.platform.startswith('win'):
+            return ['COM{}'.format(i + 1) for i in range(256)]
+        elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
+            return glob.glob('/dev/tty[A-Za-z]*')
+        elif sys.platform.startswith('darwin'):
+            return glob.glob('/dev/tty.*')
+        return []
+
+    def connect(self):
+        """Tries the last used port, then every other port. Returns True if an Arduino answered"""
+        ports = [self.port] + [port for port in self.list_serial_ports() if port != self.port]
+        for port in ports:
+            if port and self.open(port):
+                self.port = port
+                return True
+        return False
+
+    def open(self, port):
+        """Opens a port and waits for the firmware to report ready"""
+        try:
+            self.serial = serial.Serial(port, ARD_BAUDRATE, timeout=0)
+        except (serial.SerialException, OSError, ValueError):
+            self.serial = None
+            return False
+        self.read_buffer = b''
+        if self.wait_for(ARD_READY) is not None:
+            return True
+        self.close()
+        return False
+
+    def reset(self):
+        """Reopening the port resets the Arduino, turning off all outputs. Returns True once it is ready again"""
+        self.close()
+        return self.open(self.port)
+
+    def close(self):
+        """Closes the port if open"""
+        if self.serial:
+            self.serial.close()
+            self.serial = None
+
+    def write(self, data):
+        """Writes bytes and returns once they have left the host"""
+        self.serial.write(data)
+        self.serial.flush()
+
+    def read_messages(self):
+        """Complete messages received so far, without blocking"""
+        waiting = self.serial.in_waiting
+        if waiting:
+            self.read_buffer += self.serial.read(waiting)
+        messages = []
+        while True:
+            start = self.read_buffer.find(ARD_START_MARKER)
+            if start < 0:
+                self.read_buffer = b''  # nothing framed; discard noise
+                break
+            end = self.read_buffer.find(ARD_END_MARKER, start + 1)
+            if end < 0:
+                self.read_buffer = self.read_buffer[start:]
+                break
+            messages.append(self.read_buffer[start + 1:end].decode('ascii', 'replace'))
+            self.read_buffer = self.read_buffer[end + 1:]
+        return messages
+
+    def wait_for(self, expected, timeout=ARD_TIMEOUT):
+        """Blocks until a message starting with expected arrives. Returns it, or None on timeout"""
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            for message in self.read_messages():
+                if message.startswith(expected):
+                    return message
+            time.sleep(1.0 / 1000.0)
+        return None
+
+    def send_packets(self, packets):
+        """Sends each packet in answer to one data request. Returns False if the Arduino stops asking"""
+        for packet in packets:
+            if self.wait_for(ARD_REQUEST) is None:
+                return False
+            self.write(packet)
+        return True
+
+
+def setup_packets(ttl_time, num_events=0, pins_d=0, pins_b=0):
+    """Time and setup packets requested by the firmware; the Arduino clock is set to local time"""
+    local_time = calendar.timegm(time.localtime())
+    return [pack('<L', local_time),
+            pack('<BBLH', pins_d & ~SERIAL_PINS_MASK, pins_b, ttl_time, num_events)]
+
+
+class EventStreamer(object):
+    """Streams the compiled schedule to the firmware in blocks, each time it has room for one"""
+    def __init__(self, link, events):
+        self.link = link
+        self.packets = [event.pack() for event in events]
+        self.sent = 0
+
+    def send_block(self):
+        """Sends the next block of events, if any are left"""
+        block = self.packets[self.sent:self.sent + ARD_EVENT_BLOCK]
+        if block:
+            self.link.write(ARD_EVENTS_HEADER + pack('<B', len(block)) + b''.join(block))
+            self.sent += len(block)
+
+    def fill(self):
+        """Answers requests until the firmware's buffer is full. Returns False if it stops asking"""
+        while self.sent < min(len(self.packets), ARD_MAX_EVENTS):
+            if self.link.wait_for(ARD_EVENTS_REQUEST) is None:
+                return False
+            self.send_block()
+        return True
+
+
+class ClosedLoopController(object):
+    """Triggers an output pin while the tracked animal is inside any of the trigger zones
+    Every trigger is logged with its latency from frame capture to the Arduino's acknowledgement"""
+    def __init__(self, settings, track_records, frame_period, link, stats):
+        self.settings = settings
+        self.track_records = track_records
+        self.frame_period = frame_period
+        self.link = link
+        self.stats = stats
+        self.pin_mask = 1 << settings.pin
+        # Run State
+        self.last_count = 0
+        self.state = False
+        self.seq = 0
+        self.pending = {}
+        self.log_file = None
+
+    def start(self, log_path):
+        """Starts a run with outputs off, ignoring records from before the run"""
+        self.last_count = self.track_records.count
+        self.state = False
+        self.pending = {}
+        self.log_file = open(log_path, 'w')
+        self.log_file.write('frame,state,frame_time,detect_ms,write_ms,ack_ms\n')
+
+    def in_zone(self, record):
+        """True if a record found the animal inside a trigger zone"""
+        if not record[TRK_FOUND]:
+            return False
+        x, y = record[TRK_X], record[TRK_Y]
+        return any(zx <= x < zx + width and zy <= y < zy + height for zx, zy, width, height in self.settings.zones)
+
+    def update(self):
+        """Checks the latest tracking record and triggers on a change of zone occupancy"""
+        records, self.last_count = self.track_records.read_since(self.last_count)
+        if not len(records):
+            return
+        detected = time.perf_counter()
+        record = records[-1]
+        state = self.in_zone(record)
+        if state != self.state:
+            self.trigger(state, record[TRK_FRAME], record[TRK_TIME], detected)
+
+    def trigger(self, state, frame, frame_time, detected):
+        """Sends a trigger and keeps its timings until the Arduino acknowledges it"""
+        self.seq = (self.seq + 1) % 256
+        self.link.write(ARD_TRIGGER_HEADER + pack('<BB', self.seq, self.pin_mask if state else 0))
+        written = time.perf_counter()
+        self.state = state
+        self.pending[self.seq] = (frame, state, frame_time, detected, written)
+        self.stats.record('frame_to_write', written - frame_time)
+        self.stats.count('triggers')
+        if written - frame_time > self.frame_period:
+            self.stats.count('late_triggers')
+
+    def acknowledge(self, message):
+        """Logs a trigger once the Arduino reports it was applied"""
+        acked = time.perf_counter()
+        try:
+            frame, state, frame_time, detected, written = self.pending.pop(int(message[len(ARD_ACK):]))
+        except (ValueError, KeyError):
+            return
+        self.stats.record('frame_to_ack', acked - frame_time)
+        if self.log_file:
+            self.log_file.write('{:.0f},{:d},{:.6f},{:.3f},{:.3f},{:.3f}\n'.format(
+                frame, state, frame_time, (detected - frame_time) * 1e3,
+                (written - frame_time) * 1e3, (acked - frame_time) * 1e3))
+
+    def finish(self):
+        """Turns the output off, logs outstanding acknowledgements and closes the log"""
+        if self.state:
+            now = time.perf_counter()
+            self.trigger(False, -1, now, now)
+        # Triggers still in flight are logged if acknowledged promptly
+        while self.pending:
+            message = self.link.wait_for(ARD_ACK, timeout=CL_ACK_TIMEOUT)
+            if not message:
+                break
+            self.acknowledge(message)
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = None
+
+
+class ArduinoHandler(StoppableProcess):
+    """Runs the Arduino for one experiment at a time, and closed-loop triggering if configured"""
+    def __init__(self, dirs, ard_pipe_end, proc_handler_queue, exp_start_event, stats, track_records=None,
+                 frame_period=None):
+        super(ArduinoHandler, self).__init__()
+        self.name = 'Arduino Handler'
+        self.dirs = dirs
+        # Concurrency
+        self.ard_pipe_end = ard_pipe_end
+        self.proc_handler_queue = proc_handler_queue
+        self.exp_start_event = exp_start_event
+        # Closed loop needs the tracking records of the camera it watches
+        self.settings = dirs.settings.closed_loop
+        self.track_records = track_records
+        self.frame_period = frame_period
+        self.stats = stats
+        # Run Params; the GUI sends its current arduino outputs before every run
+        self.ard_settings = self.dirs.settings.last_ard
+        self.ttl_time = self.dirs.settings.ttl_time
+        self.save_dir = ''
+        self.running = False
+        self.run_start = 0
+        self.streamer = None
+
+    @property
+    def closed_loop_enabled(self):
+        """True if closed loop triggering was configured and its camera is tracking"""
+        return self.settings.enabled and self.track_records is not None and bool(self.settings.zones)
+
+    def setup_message_parser(self):
+        """Creates Message Parsing Dictionaries"""
+        self.message_parser = {
+            CMD_START: lambda value: self.start_run(save_file_name=value),
+            CMD_STOP: lambda value: self.stop_run(),
+            CMD_EXIT: lambda value: self.stop(),
+            CMD_SET_TIME: lambda value: self.set_ttl_time(ttl_time=value),
+            CMD_SET_DIRS: lambda value: self.set_save_dir(save_dir=value),
+            CMD_SET_ARD: lambda value: self.set_ard_settings(ard_settings=value),
+            CMD_CHECK_CONN: lambda value: None
+        }
+
+    def run(self):
+        """Connects, then answers commands and runs closed loop until told to exit"""
+        self.setup_message_parser()
+        self.link = ArduinoLink(self.dirs.settings.ard_ser_port)
+        self.closed_loop = None
+        if not self.link.connect():
+            # Without an Arduino there is nothing to run; proc_handler stops using this device,
+            # but we keep answering the pipe until told to exit
+            self.proc_handler_queue.put_nowait(NewMessage(dev=ARDUINO, cmd=MSG_ERROR))
+        elif self.closed_loop_enabled:
+            self.closed_loop = ClosedLoopController(self.settings, self.track_records, self.frame_period,
+                                                    self.link, self.stats)
+        while not self.stopped():
+            if self.ard_pipe_end.poll():
+                msg = ReadMessage(self.ard_pipe_end.recv_bytes())
+                self.message_parser[msg.command](msg.value)
+                self.ard_pipe_end.send(self.link.serial is not None if msg.command == CMD_CHECK_CONN
+                                       else NewMessage(dev=ARDUINO, cmd=MSG_RECEIVED))
+            if self.running:
+                self.check_run()
+            time.sleep(CL_POLL_INTERVAL if self.running and self.closed_loop else ARD_POLL_INTERVAL)
+        self.link.close()
+
+    def set_ttl_time(self, ttl_time):
+        """Sets total experiment time in ms"""
+        self.ttl_time = ttl_time
+
+    def set_save_dir(self, save_dir):
+        """Sets the directory the closed loop log is saved to"""
+        self.save_dir = save_dir
+
+    def set_ard_settings(self, ard_settings):
+        """Sets the arduino outputs played back by the next run"""
+        self.ard_settings = ard_settings
+
+    def start_run(self, save_file_name):
+        """Uploads the run configuration, then starts the Arduino when exp_start_event is released"""
+        events = compile_schedule(self.ard_settings.configs)
+        try:
+            check_schedule(events, self.ttl_time)
+        except ValueError:
+            self.proc_handler_queue.put_nowait(NewMessage(dev=ARDUINO, cmd=MSG_ERROR))
+            return
+        pins_d, pins_b = schedule_pins(events)
+        if self.closed_loop:
+            pins_d |= self.closed_loop.pin_mask
+        packets = setup_packets(self.ttl_time, len(events), pins_d, pins_b)
+        self.streamer = EventStreamer(self.link, events)
+        if not (self.link.serial and self.link.reset() and self.link.send_packets(packets) and self.streamer.fill()):
+            self.proc_handler_queue.put_nowait(NewMessage(dev=ARDUINO, cmd=MSG_ERROR))
+            return
+        if self.closed_loop:
+            self.closed_loop.start('{}\\{}_closedloop.csv'.format(self.save_dir, save_file_name))
+        self.running = True
+        self.run_start = 0
+
+    def check_run(self):
+        """Starts the Arduino once the experiment is released, then runs closed loop until it reports finishing"""
+        if not self.run_start:
+            if self.exp_start_event.is_set():
+                self.link.write(ARD_START_BYTE)
+                self.run_start = time.perf_counter()
+            return
+        if self.closed_loop:
+            self.closed_loop.update()
+        finished = False
+        for message in self.link.read_messages():
+            if message == ARD_EVENTS_REQUEST:
+                self.streamer.send_block()
+            elif message.startswith(ARD_ACK) and self.closed_loop:
+                self.closed_loop.acknowledge(message)
+            elif ',' in message:
+                finished = True  # <ms,start HH:MM:SS,end HH:MM:SS>
+        if finished or time.perf_counter() - self.run_start > self.ttl_time / 1000.0 + ARD_END_GRACE:
+            self.end_run()
+            self.proc_handler_queue.put_nowait(NewMessage(dev=ARDUINO, cmd=MSG_FINISHED))
+
+    def end_run(self):
+        """Turns closed loop output off and closes its log"""
+        self.running = False
+        if self.closed_loop:
+            self.closed_loop.finish()
+
+    def stop_run(self):
+        """Forces a premature stop; resetting the Arduino turns off every output"""
+        if self.running:
+            self.end_run()
+            self.link.reset()
@@ -12,17 +12,34 @@ import pyximea as xi
 import scipy.misc
 from Misc.Names import *
 from Misc.CustomClasses import *
+from Misc.CustomFunctions import fit_size
+from Tracking.Tracker import TRK_FRAME, TRK_TIME, TRK_X, TRK_Y, TRK_FOUND, draw_overlay
 if sys.version[0] == '2':
     import Queue as Queue
 else:
     import queue as Queue
 
 
+# FlyCapture frame rate modes of the FireFly's discrete frame rates
+FF_FRAMERATES = {15: fc.FRAMERATE_15, 30: fc.FRAMERATE_30, 60: fc.FRAMERATE_60}
+# xiAPI acquisition timing mode in which the 'framerate' parameter limits the free running rate
+XI_ACQ_TIMING_MODE_FRAME_RATE = 1
+# A gap between recorded frames longer than this many frame periods means frames were dropped
+DROPPED_FRAME_GAP = 1.5
+# Seconds between saves of tracking records published by the tracking pool
+TRACK_SAVE_INTERVAL = 50.0 / 1000.0
+# Idle wait when neither the display nor tracking wants frames outside of recording
+PREVIEW_IDLE_SLEEP = 20.0 / 1000.0
+
+
 class CameraDevice(object):
     """Container for specific camera hardware attributes"""
-    def __init__(self, cmr_type, cmr_id):
+    def __init__(self, cmr_type, cmr_id, profile):
         self.cmr_type = cmr_type
         self.cmr_id = cmr_id
+        self.profile = profile  # resolved CameraProfile
+        self.full_width = None
+        self.full_height = None
         self.connected = False
         self.initialize()
 
@@ -41,13 +58,13 @@ class CameraDevice(object):
             self.file_fmt = '.avi'
             self.camera_error = fc.ApiError
             self.init_ff_camera()
-            self.get_img_method = self.fc_context.tempImgGet
-            self.record_vid_method = self.fc_context.appendAVI
+            self.get_img_method = self.ff_get_image
+            self.record_vid_method = self.ff_rec_to_file
         elif self.cmr_type == MINIMIC_CAMERA:
             self.file_fmt = '.mkv'
             self.camera_error = xi.ximea.XI_Error, xi.XI_Error
             self.init_mm_camera()
-            self.get_img_method = self.xi_camera.get_image
+            self.get_img_method = self.mini_mic_get_image
             self.record_vid_method = self.mini_mic_rec_to_file
 
     def init_ff_camera(self):
@@ -55,7 +72,7 @@ class CameraDevice(object):
         try:
             self.fc_context = fc.Context()
             self.fc_context.connect(*self.fc_context.get_camera_from_index(self.cmr_id))
-            self.fc_context.set_video_mode_and_frame_rate(fc.VIDEOMODE_640x480Y8, fc.FRAMERATE_30)
+            self.fc_context.set_video_mode_and_frame_rate(fc.VIDEOMODE_640x480Y8, FF_FRAMERATES[self.profile.fps])
             self.fc_context.set_property(**self.fc_context.get_property(fc.FRAME_RATE))
             self.fc_context.start_capture()
         except self.camera_error:
@@ -67,23 +84,59 @@ class CameraDevice(object):
         """Initializes a Ximea camera (mini microscope)"""
         try:
             self.xi_camera = xi.Xi_Camera(DevID=self.cmr_id)
-            self.xi_camera.set_param('exposure', 33333.33)
-            self.xi_camera.set_binning(4, skipping=False)
+            self.xi_camera.set_param('exposure', self.profile.exposure_us)
+            self.xi_camera.set_binning(self.profile.binning, skipping=False)
             self.xi_camera.set_debug_level('Error')
         except self.camera_error:
             self.connected = False
         else:
             self.connected = True
+            self.full_width = self.xi_camera.get_param('width')
+            self.full_height = self.xi_camera.get_param('height')
+            self.set_mm_frame_rate()
+            self.set_roi(self.profile)
+
+    def set_mm_frame_rate(self):
+        """Limits the Ximea to the profile frame rate; models without frame rate control free run at exposure"""
+        try:
+            self.xi_camera.set_param('acq_timing_mode', XI_ACQ_TIMING_MODE_FRAME_RATE)
+            self.xi_camera.set_param('framerate', float(self.profile.fps))
+        except self.camera_error:
+            pass
+
+    def set_roi(self, profile):
+        """Applies the ROI of a resolved profile; on-sensor if supported, otherwise frames are cropped as views"""
+        self.profile = profile
+        if self.cmr_type != MINIMIC_CAMERA:
+            return
+        x, y, width, height = profile.roi or (0, 0, self.full_width, self.full_height)
+        try:
+            # Offsets first go to 0 so that any new width/height is valid, then move to the new position
+            self.xi_camera.set_param('offsetX', 0)
+            self.xi_camera.set_param('offsetY', 0)
+            self.xi_camera.set_param('width', width)
+            self.xi_camera.set_param('height', height)
+            self.xi_camera.set_param('offsetX', x)
+            self.xi_camera.set_param('offsetY', y)
+        except self.camera_error:
+            self.profile.roi_on_sensor = False
+
+    def crop(self, data):
+        """Returns a view of the ROI of a full frame, if the ROI is not applied on-sensor"""
+        if self.profile.roi and not self.profile.roi_on_sensor:
+            x, y, width, height = self.profile.roi
+            return data[y:y + height, x:x + width]
+        return data
 
     def setup_recording_params(self, save_name):
         """Initializes recording parameters for camera"""
         if self.cmr_type == FIREFLY_CAMERA:
             save_name = save_name.encode()
-            self.fc_context.openAVI(save_name, 30, 1000000)
+            self.fc_context.openAVI(save_name, self.profile.fps, 1000000)
             self.fc_context.set_strobe_mode(3, True, 1, 0, 10)
         elif self.cmr_type == MINIMIC_CAMERA:
-            self.mini_mic_video_writer = imageio.get_writer(save_name, mode='I', fps=30, codex='ffv1', quality=10,
-                                                            pixelformat='yuv420p', macro_block_size=None,
+            self.mini_mic_video_writer = imageio.get_writer(save_name, mode='I', fps=self.profile.fps, codex='ffv1',
+                                                            quality=10, pixelformat='yuv420p', macro_block_size=None,
                                                             ffmpeg_log_level='error')
 
     def reset_recording_params(self):
@@ -97,9 +150,21 @@ class CameraDevice(object):
         elif self.cmr_type == MINIMIC_CAMERA:
             self.mini_mic_video_writer.close()
 
+    def ff_get_image(self):
+        """Image Acquisition Method for FireFly"""
+        return self.crop(self.fc_context.tempImgGet())
+
+    def ff_rec_to_file(self):
+        """Video Recording Method for FireFly; FlyCapture's AVI recorder always writes the full frame"""
+        return self.crop(self.fc_context.appendAVI())
+
+    def mini_mic_get_image(self):
+        """Image Acquisition Method for MiniMicroscope (Ximea Camera)"""
+        return self.crop(self.xi_camera.get_image())
+
     def mini_mic_rec_to_file(self):
         """Video Recording Method for MiniMicroscope (Ximea Camera)"""
-        data = self.xi_camera.get_image()
+        data = self.crop(self.xi_camera.get_image())
         self.mini_mic_video_writer.append_data(data)
         return data
 
@@ -117,20 +182,38 @@ class CameraDevice(object):
 
 class CameraHandler(StoppableProcess):
     """Single Camera Process, handles incoming messages from GUI/Proc Handler, and sends to external hardware"""
-    def __init__(self, dirs, stream_index, mp_array, img_size, sync_event, cmr_pipe_end, cmr_type, cmr_id):
+    def __init__(self, dirs, stream_index, mp_array, buffer_size, sync_event, cmr_pipe_end, proc_handler_queue,
+                 exp_start_event, cmr_type, cmr_id, profile, stats, health, tracking, track_records, frame_slot,
+                 preview, preview_demand):
         super(CameraHandler, self).__init__()
         # Supplied Params
         self.dirs = dirs
         self.stream_index = stream_index
         self.mp_array = mp_array
-        self.img_size = img_size
+        self.buffer_size = buffer_size
         self.cmr_type = cmr_type
         self.cmr_id = cmr_id
+        self.profile = profile
+        self.pending_profile = None  # new ROI, applied between frames by the main loop
+        # Frames are scaled into the top left img_size region of the shared buffer
+        self.img_size = fit_size(profile.width, profile.height, buffer_size)
+        self.stats = stats  # Hot path instrumentation, read by proc_handler
+        self.health = health  # Dropped frames, backlog and errors, read by GUI
+        # Frames are published to frame_slot for the tracking pool, which publishes records to track_records
+        self.tracking = tracking
+        self.track_records = track_records
+        self.frame_slot = frame_slot  # None if this camera is not tracked
+        self.track_file = None
+        # Preview frames are only sent when the policy allows and the GUI wants them (tile visible, or hovered)
+        self.preview = preview
+        self.preview_demand = preview_demand
+        self.last_preview_time = 0
+        self.track_save_name = ''
         # Synchronization
         self.img_to_gui_sync_event = sync_event  # Sync with GUI for image sending
-        self.exp_start_event = EXP_START_EVENT  # Sync with proc_handler for experiment start
+        self.exp_start_event = exp_start_event  # Sync with proc_handler for experiment start
         self.cmr_pipe = cmr_pipe_end  # Comms with proc_handler for messages PH explicitly waiting for
-        self.proc_handler_queue = PROC_HANDLER_QUEUE  # Comms with proc_handler for general messages
+        self.proc_handler_queue = proc_handler_queue  # Comms with proc_handler for general messages; ours alone
         # We create a frame_buffer to keep new frames for sending to GUI on separate thread
         # This way cameras can continuously acquire images without delay
         self.frame_buffer = None
@@ -141,6 +224,8 @@ class CameraHandler(StoppableProcess):
         self.ttl_num_frames = 0
         self.hardstopped_rec = False
         self.recording_vid = False
+        self.rec_start_time = 0
+        self.last_frame_time = 0
 
     def setup_message_parser(self):
         """Generates a dictionary of {Message:Actions} for message parsing"""
@@ -150,6 +235,8 @@ class CameraHandler(StoppableProcess):
             CMD_STOP: lambda value: self.hardstop_record(),
             CMD_SET_DIRS: lambda value: self.set_rec_params(save_dir=value),
             CMD_SET_TIME: lambda value: self.set_rec_params(ttl_time=value),
+            CMD_SET_ROI: lambda value: self.set_profile(profile=value),
+            CMD_SET_PREVIEW: lambda value: self.set_preview(preview=value),
             CMD_EXIT: lambda value: self.stop()
         }
 
@@ -161,7 +248,7 @@ class CameraHandler(StoppableProcess):
             # we poll the pipe so as to not block this thread indefinitely if no messages
             # especially if self.camera.connected = False and we have exited other parts of the program
             if self.cmr_pipe.poll(1.0):
-                msg = ReadMessage(self.cmr_pipe.recv())
+                msg = ReadMessage(self.cmr_pipe.recv_bytes())
             # Follow Message Instructions
             if msg:
                 self.process_queued_message(msg)
@@ -171,13 +258,17 @@ class CameraHandler(StoppableProcess):
         self.frame_buffer = Queue.Queue()
         temp_array = np.empty(self.img_size, dtype=np.uint32)
         while self.camera.connected:
+            if temp_array.shape != self.img_size:
+                temp_array = np.empty(self.img_size, dtype=np.uint32)
             try:
                 data = self.frame_buffer.get_nowait()
             except Queue.Empty:
                 time.sleep(1.0 / 1000.0)
             else:
-                self.update_shared_array(data, temp_array)
+                with self.stats.timer('submit_frames'):
+                    self.update_shared_array(data, temp_array)
                 self.img_to_gui_sync_event.set()
+                self.stats.set_gauge('frame_buffer', self.frame_buffer.qsize())
 
     def update_shared_array(self, data, array):
         """Updates the shared mp array between camera and GUI with a new image"""
@@ -185,28 +276,36 @@ class CameraHandler(StoppableProcess):
         array[:, :] = data
         array[:, :] = (array << 8) + data  # Blue + Green Channel
         array[:, :] = (array << 8) + data  # Blue/Green + Red Channel
-        self.np_array[:, :] = array
+        # Overlays are drawn on the downscaled copy only
+        if self.frame_slot:
+            draw_overlay(array, float(array.shape[1]) / self.profile.width, self.tracking.roi,
+                         self.track_records.latest())
+        self.np_array[:array.shape[0], :array.shape[1]] = array
 
     def run(self):
         """Starts the Camera Process"""
         self.setup_message_parser()
         # Create camera device
-        self.camera = CameraDevice(cmr_type=self.cmr_type, cmr_id=self.cmr_id)
-        self.np_array = np.frombuffer(self.mp_array.get_obj(), dtype='I').reshape(self.img_size)
+        self.camera = CameraDevice(cmr_type=self.cmr_type, cmr_id=self.cmr_id, profile=self.profile)
+        self.np_array = np.frombuffer(self.mp_array.get_obj(), dtype='I').reshape(self.buffer_size)
         # Threading
-        SEND_FRAMES, POLLING = 'send_frames', 'polling'
+        SEND_FRAMES, POLLING, SAVE_TRACKS = 'send_frames', 'polling', 'save_tracks'
         thr_send_frames = thr.Thread(target=self.submit_frames, name=SEND_FRAMES, daemon=True)
         thr_msg_polling = thr.Thread(target=self.msg_polling, name=POLLING, daemon=True)
+        thr_save_tracks = thr.Thread(target=self.save_tracks, name=SAVE_TRACKS, daemon=True)
         thr_send_frames.start()
         thr_msg_polling.start()
+        thr_save_tracks.start()
         # Main Camera Loop
-        k = qc.QTime()
-        k.start()
+        loop_timer = self.stats.timer('get_frames')
         while self.camera.connected:
             # We must acquire images regardless of GUI responsiveness; loss of frames if locked to GUI
-            k.restart()
-            self.get_frames()
-            #print(k.elapsed())
+            if self.pending_profile:
+                self.apply_profile()
+            with loop_timer:
+                self.get_frames()
+            self.stats.count('loop')
+            self.health.publish()
             # If exiting, we must first close devices and threads, then inform proc_handler
             if self.stopped():
                 self.camera.connected = False
@@ -214,7 +313,7 @@ class CameraHandler(StoppableProcess):
                 while True:
                     time.sleep(5.0 / 1000.0)
                     threads = (thread.name for thread in thr.enumerate())
-                    if SEND_FRAMES not in threads and POLLING not in threads:
+                    if SEND_FRAMES not in threads and POLLING not in threads and SAVE_TRACKS not in threads:
                         break  # we only exit process if threads have been killed
                 self.cmr_pipe.send(MSG_RECEIVED)
 
@@ -230,12 +329,21 @@ class CameraHandler(StoppableProcess):
         #print(self.img_to_gui_sync_event.is_set())
 
         if not self.recording_vid and not self.img_to_gui_sync_event.is_set():
+            preview = self.preview_due()
+            # Nothing wants frames; we idle instead of acquiring
+            if not preview and not self.frame_slot:
+                time.sleep(PREVIEW_IDLE_SLEEP)
+                return
             try:
-                data = self.camera.get_img_method()
+                with self.stats.timer('acquire'):
+                    data = self.camera.get_img_method()
             except self.camera.camera_error:
                 self.report_camera_error()
             else:
-                self.frame_buffer.put_nowait(data)
+                self.stats.count('frames')
+                self.submit_to_tracker(data)
+                if preview:
+                    self.frame_buffer.put_nowait(data)
                 time.sleep(5.0/1000.0)
         # -- Gets 1 frame. Also records frame to video file -- #
         # since we are now recording, we cannot lock image acquisition to GUI
@@ -245,30 +353,96 @@ class CameraHandler(StoppableProcess):
         elif self.recording_vid:
             if self.curr_frame <= self.ttl_num_frames:
                 try:
-                    data = self.camera.record_vid_method()
+                    with self.stats.timer('acquire'):
+                        data = self.camera.record_vid_method()
                 except self.camera.camera_error:
                     self.report_camera_error()
                 else:
+                    self.stats.count('frames')
                     self.curr_frame += 1
-                    if not self.img_to_gui_sync_event.is_set():
+                    self.check_frame_timing()
+                    self.submit_to_tracker(data)
+                    # While the GUI still holds the previous frame, a due preview is skipped but its slot is kept
+                    if self.img_to_gui_sync_event.is_set():
+                        if self.preview_due(claim=False):
+                            self.health.add(HLTH_SKIPPED)
+                    elif self.preview_due():
                         self.frame_buffer.put_nowait(data)
                         time.sleep(5.0 / 1000.0)
             elif self.curr_frame > self.ttl_num_frames:
                 self.finish_record()
 
+    def preview_due(self, claim=True):
+        """True if a preview frame should be sent now, under the preview policy and the GUI's demand
+        Under PREVIEW_FPS, a due preview uses up the current slot unless claim is False"""
+        if not self.preview_demand.value:
+            return False  # tile hidden, window minimised, or not hovered
+        if self.preview.mode == PREVIEW_NOT_RECORDING and self.recording_vid:
+            return False
+        if self.preview.mode == PREVIEW_FPS:
+            now = time.perf_counter()
+            if now - self.last_preview_time < 1.0 / self.preview.fps:
+                return False
+            if claim:
+                self.last_preview_time = now
+        return True
+
+    def submit_to_tracker(self, data):
+        """Publishes the newest frame to the tracking pool; frames it has no time for are skipped there"""
+        if self.frame_slot:
+            with self.stats.timer('publish_frame'):
+                self.frame_slot.write(data, self.curr_frame, time.perf_counter())
+
+    def save_tracks(self):
+        """Run on separate thread. Saves the tracking records published for this camera while recording"""
+        last_count = self.track_records.count
+        while self.camera.connected:
+            time.sleep(TRACK_SAVE_INTERVAL)
+            # The track file is only opened and closed on this thread
+            if self.recording_vid and not self.track_file and self.frame_slot:
+                last_count = self.track_records.count  # records from before the run are not saved
+                self.track_file = open(self.track_save_name, 'w')
+                self.track_file.write('frame,time,x,y\n')
+            records, last_count = self.track_records.read_since(last_count)
+            if self.track_file:
+                for record in records:
+                    x, y = ('{:.2f}'.format(record[TRK_X]), '{:.2f}'.format(record[TRK_Y])) \
+                        if record[TRK_FOUND] else ('', '')
+                    self.track_file.write('{:.0f},{:.6f},{},{}\n'.format(record[TRK_FRAME], record[TRK_TIME], x, y))
+                if not self.recording_vid:
+                    self.track_file.close()
+                    self.track_file = None
+
+    def check_frame_timing(self):
+        """Counts frames dropped since the last recorded frame, and frames we are behind schedule"""
+        now = time.perf_counter()
+        gap = (now - self.last_frame_time) * self.profile.fps
+        if self.curr_frame > 1 and gap > DROPPED_FRAME_GAP:
+            self.health.add(HLTH_DROPPED, int(round(gap)) - 1)
+        self.last_frame_time = now
+        # The writer is behind if it has recorded fewer frames than elapsed time calls for
+        expected = (now - self.rec_start_time) * self.profile.fps
+        self.health.set(HLTH_BACKLOG, max(0, int(expected) - self.curr_frame))
+
     def start_record(self, save_file_name):
         """Initializes recording parameters for camera and waits for start event to begin recording"""
         save_name = '{}\\{}_[{}#{}]{}'.format(self.save_dir, save_file_name,
                                               self.cmr_type, self.cmr_id, self.camera.file_fmt)
         self.camera.setup_recording_params(save_name=save_name)
+        self.track_save_name = '{}\\{}_[{}#{}]_track.csv'.format(self.save_dir, save_file_name,
+                                                                 self.cmr_type, self.cmr_id)
         # Ready to Record Video
-        self.ttl_num_frames = int(self.ttl_time * 30) // 1000
+        self.ttl_num_frames = int(self.ttl_time * self.profile.fps) // 1000
+        self.health.reset()
         self.cmr_pipe.send(MSG_RECEIVED)  # no need to package this message. PH only needs to pass the recv() block
         self.exp_start_event.wait()
+        self.rec_start_time = time.perf_counter()
         self.recording_vid = True  # We are ready to record. Main thread loop will enter recording status
 
     def report_camera_error(self):
         """If the camera produces an error, we notify proc handler such that it no longer attempts to reach camera"""
+        self.health.add(HLTH_USB_ERR)
+        self.health.publish(force=True)
         # Inform Proc Handler that Camera at Stream Index had an Error
         msg = NewMessage(dev=CAMERAS, cmd=MSG_ERROR, val=self.stream_index)
         self.proc_handler_queue.put_nowait(msg)
@@ -297,6 +471,24 @@ class CameraHandler(StoppableProcess):
         self.hardstopped_rec = True
         # This forces the get_frames() loop to exit recording, and also report hardstop to proc_handler
 
+    def set_profile(self, profile):
+        """Queues a new ROI for the main loop; never changed mid recording"""
+        if not self.recording_vid:
+            self.pending_profile = profile
+        self.cmr_pipe.send(MSG_RECEIVED)
+
+    def set_preview(self, preview):
+        """Sets the preview policy; takes effect from the next frame"""
+        self.preview = preview
+        self.cmr_pipe.send(MSG_RECEIVED)
+
+    def apply_profile(self):
+        """Applies a queued ROI between frames, on the thread that owns the camera"""
+        self.camera.set_roi(self.pending_profile)
+        self.profile = self.camera.profile
+        self.img_size = fit_size(self.profile.width, self.profile.height, self.buffer_size)
+        self.pending_profile = None
+
     def set_rec_params(self, save_dir=None, ttl_time=None):
         """Sets recording parameters"""
         if ttl_time:
@@ -0,0 +1,163 @@
+# coding=utf-8
+
+"""Named single producer, single consumer message channels in shared memory, wired by one orchestrator"""
+
+import sys
+import time
+import struct
+import multiprocessing as mp
+from Misc.CustomClasses import SharedViews
+if sys.version[0] == '2':
+    import Queue as Queue
+else:
+    import queue as Queue
+
+
+# Process endpoints; camera endpoints are named by stream index
+GUI = 'gui'
+PROC_HANDLER = 'proc_handler'
+POST_PROC = 'post_proc'
+ARDUINO_PROC = 'arduino'
+CAMERA_PROC = 'cmr #{}'
+# Channel layout
+CHANNEL_CAPACITY = 32  # messages
+CHANNEL_SLOT_SIZE = 8192  # bytes per message, including its length prefix
+LENGTH_PREFIX = struct.Struct('<I')
+CHANNEL_POLL_INTERVAL = 1.0 / 1000.0
+CHANNEL_SPIN_TIME = 0.5 / 1000.0  # yield instead of sleeping for this long before polling at the interval
+# ProcessStats counter of messages a producer dropped on full channels
+CHANNEL_DROPS = 'dropped_messages'
+
+
+class Channel(SharedViews):
+    """Ring of fixed size message slots in shared memory, for exactly one producer and one consumer
+    Only the producer advances head and only the consumer advances tail, so neither needs a lock
+    Carries Packaged Messages (see NewMessage); raises Queue.Empty like the queues it replaces. Like them, writing
+    never raises or blocks: a message its stalled consumer has no room for is dropped and counted in stats"""
+    def __init__(self, name, capacity=CHANNEL_CAPACITY, slot_size=CHANNEL_SLOT_SIZE, stats=None):
+        self.name = name
+        self.stats = stats  # producer's ProcessStats, with a CHANNEL_DROPS counter
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.mp_slots = mp.RawArray('B', capacity * slot_size)
+        self.mp_head = mp.RawValue('Q', 0)  # messages written
+        self.mp_tail = mp.RawValue('Q', 0)  # messages read
+        self._view = None
+
+    @property
+    def view(self):
+        """Writable memoryview of the slots"""
+        if self._view is None:
+            self._view = memoryview(self.mp_slots).cast('B')
+        return self._view
+
+    def qsize(self):
+        """Messages waiting to be read"""
+        return self.mp_head.value - self.mp_tail.value
+
+    def empty(self):
+        """True if no message is waiting"""
+        return not self.qsize()
+
+    # -- Producer -- #
+    def put_nowait(self, data):
+        """Writes a packaged message into the next free slot. Returns False at once if the channel is full;
+        the message is dropped, and callers may decide whether to send it again"""
+        if len(data) > self.slot_size - LENGTH_PREFIX.size:
+            raise ValueError('{} byte message does not fit channel {}'.format(len(data), self.name))
+        head = self.mp_head.value
+        if head - self.mp_tail.value >= self.capacity:
+            if self.stats:
+                self.stats.count(CHANNEL_DROPS)
+            return False
+        offset = (head % self.capacity) * self.slot_size
+        LENGTH_PREFIX.pack_into(self.view, offset, len(data))
+        self.view[offset + LENGTH_PREFIX.size:offset + LENGTH_PREFIX.size + len(data)] = data
+        # The slot is complete before the consumer can see it
+        self.mp_head.value = head + 1
+        return True
+
+    # -- Consumer -- #
+    def get_nowait(self):
+        """Reads the oldest packaged message"""
+        tail = self.mp_tail.value
+        if tail == self.mp_head.value:
+            raise Queue.Empty
+        offset = (tail % self.capacity) * self.slot_size
+        length = LENGTH_PREFIX.unpack_from(self.view, offset)[0]
+        data = bytes(self.view[offset + LENGTH_PREFIX.size:offset + LENGTH_PREFIX.size + length])
+        self.mp_tail.value = tail + 1
+        return data
+
+    def get(self, timeout=None):
+        """Waits up to timeout seconds (forever if None) for a message"""
+        return wait_for_message(self.get_nowait, timeout)
+
+
+class Inbox(object):
+    """Consumer end of every channel into one process; channels are read in turn so none is starved"""
+    def __init__(self, channels):
+        self.channels = list(channels)
+        self.turn = 0
+
+    def get_nowait(self):
+        """Reads the oldest message of the next channel that has one"""
+        for i in range(len(self.channels)):
+            channel = self.channels[(self.turn + i) % len(self.channels)]
+            if not channel.empty():
+                self.turn = (self.turn + i + 1) % len(self.channels)
+                return channel.get_nowait()
+        raise Queue.Empty
+
+    def get(self, timeout=None):
+        """Waits up to timeout seconds (forever if None) for a message"""
+        return wait_for_message(self.get_nowait, timeout)
+
+
+def wait_for_message(get_nowait, timeout):
+    """Polls get_nowait until it returns a message or timeout passes"""
+    start = time.perf_counter()
+    while True:
+        try:
+            return get_nowait()
+        except Queue.Empty:
+            waited = time.perf_counter() - start
+            if timeout is not None and waited >= timeout:
+                raise
+        # Replies usually arrive within the spin time; yielding until then keeps round trips short
+        time.sleep(0 if waited < CHANNEL_SPIN_TIME else CHANNEL_POLL_INTERVAL)
+
+
+class Topology(object):
+    """Creates every channel, pipe and event linking the program's processes, and hands them out by name
+    Built by the GUI process; each process is given its channels explicitly before it starts"""
+    def __init__(self):
+        self.channels = {}
+        self.pipes = {}
+        self.stats = {}  # ProcessStats of each producer, counting the messages it drops
+        # Released by proc_handler to start every device at once
+        self.exp_start_event = mp.Event()
+
+    def channel(self, producer, consumer):
+        """The channel from producer to consumer, created on first use"""
+        key = (producer, consumer)
+        if key not in self.channels:
+            self.channels[key] = Channel('{} -> {}'.format(producer, consumer), stats=self.stats.get(producer))
+        return self.channels[key]
+
+    def instrument(self, producer, stats):
+        """Counts messages dropped on producer's channels in stats, which must have a CHANNEL_DROPS counter"""
+        self.stats[producer] = stats
+        for (source, _), channel in self.channels.items():
+            if source == producer:
+                channel.stats = stats
+
+    def inbox(self, consumer):
+        """Consumer end of every channel declared so far into consumer; declare producers first"""
+        return Inbox(channel for (_, to), channel in sorted(self.channels.items()) if to == consumer)
+
+    def pipe(self, endpoint):
+        """(main end, device end) of the request/reply pipe between proc_handler and a device, created on first use"""
+        if endpoint not in self.pipes:
+            self.pipes[endpoint] = mp.Pipe()
+        return self.pipes[endpoint]
@@ -7,6 +7,8 @@ import time
 from Misc.Names import *
 from Misc.CustomFunctions import format_daytime
 from Misc.CustomClasses import *
+from DirsSettings.ResourceBudget import ResourceBudget
+from Misc.Profiling import STATS_INTERVAL
 if sys.version[0] == '2':
     import Queue as Queue
 else:
@@ -15,32 +17,45 @@ else:
 
 class Device(object):
     """Container for Device Parameters relevant to Process Handler"""
-    def __init__(self, device_type, mp_pipe=None, index=None):
+    def __init__(self, device_type, mp_pipe=None, index=None, model=None):
         self.device_type = device_type
         self.mp_pipe = mp_pipe
         self.index = index
+        self.model = model
         self.use_device = True
         self.running = False
 
     def send_message(self, msg):
-        """Sends a message through our mp_pipe ending"""
-        self.mp_pipe.send(msg)
+        """Sends a packaged message through our mp_pipe ending, and waits for the reply"""
+        self.mp_pipe.send_bytes(msg)
         new_msg = self.mp_pipe.recv()
 
 
 class ProcessHandler(StoppableProcess):
     """Handles Comms between GUI and Child Processes"""
-    def __init__(self, cmr_pipe_mains):
+    def __init__(self, dirs, proc_handler_queue, master_dump_queue, post_proc_queue, exp_start_event,
+                 cmr_pipe_mains, cmr_models, ard_pipe_main, stats, stats_summary):
         super(ProcessHandler, self).__init__()
         self.name = 'Proess Handler'
+        self.dirs = dirs
         # Concurrency
-        self.master_dump_queue = MASTER_DUMP_QUEUE
-        self.proc_handler_queue = PROC_HANDLER_QUEUE
-        self.exp_start_event = EXP_START_EVENT
+        self.master_dump_queue = master_dump_queue
+        self.proc_handler_queue = proc_handler_queue  # Inbox over the GUI's and every device's channel
+        self.post_proc_queue = post_proc_queue
+        self.exp_start_event = exp_start_event
         # Devices
-        self.cameras = [Device(CAMERAS, pipe, index) for index, pipe in enumerate(cmr_pipe_mains)]
+        self.cameras = [Device(CAMERAS, pipe, index, cmr_model)
+                        for index, (pipe, cmr_model) in enumerate(zip(cmr_pipe_mains, cmr_models))]
+        self.arduino = Device(ARDUINO, ard_pipe_main)
         # Handler Params
         self.hardstop_exp = False
+        self.ttl_time = self.dirs.settings.ttl_time
+        self.save_dir = ''
+        self.save_file_name = ''
+        # Instrumentation; we aggregate every block into the summary displayed by the GUI
+        self.stats = stats
+        self.stats_summary = stats_summary
+        self.last_aggregate = 0
 
     def setup_message_parser(self):
         """Creates Message Parsing Dictionaries"""
@@ -48,8 +63,11 @@ class ProcessHandler(StoppableProcess):
             CMD_START: lambda device, value: self.run_experiment(save_file_name=value),
             CMD_STOP: lambda device, value: self.hardstop_experiment(),
             CMD_EXIT: lambda device, value: self.close_devices(),
-            CMD_SET_TIME: lambda device, value: self.set_device_params(param=CMD_SET_TIME, value=value),
-            CMD_SET_DIRS: lambda device, value: self.set_device_params(param=CMD_SET_DIRS, value=value),
+            CMD_SET_TIME: lambda device, value: self.set_ttl_time(ttl_time=value),
+            CMD_SET_DIRS: lambda device, value: self.set_save_dir(save_dir=value),
+            CMD_SET_ROI: lambda device, value: self.set_camera_roi(*value),
+            CMD_SET_PREVIEW: lambda device, value: self.set_camera_preview(*value),
+            CMD_SET_ARD: lambda device, value: self.set_ard_settings(ard_settings=value),
             MSG_FINISHED: lambda device, value: self.set_device_stopped(device_type=device, index=value, error=False),
             MSG_ERROR: lambda device, value: self.set_device_stopped(device_type=device, index=value, error=True)
         }
@@ -59,27 +77,56 @@ class ProcessHandler(StoppableProcess):
         self.setup_message_parser()
         while not self.stopped():
             time.sleep(5.0 / 1000.0)
-            try:
-                msg = self.proc_handler_queue.get_nowait()
-            except Queue.Empty:
-                pass
-            else:
-                msg = ReadMessage(msg)
-                self.process_queue_message(msg)
-            self.check_exp_is_running()
+            with self.stats.timer('loop'):
+                # Every waiting message is handled each loop, so channels do not fill up and drop messages
+                while True:
+                    try:
+                        msg = self.proc_handler_queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    msg = ReadMessage(msg)
+                    self.process_queue_message(msg)
+                self.check_exp_is_running()
+            self.aggregate_stats()
+
+    def aggregate_stats(self):
+        """Summarizes instrumentation of all processes once per second"""
+        now = time.perf_counter()
+        if now - self.last_aggregate >= STATS_INTERVAL:
+            self.stats_summary.aggregate()
+            self.last_aggregate = now
 
     def process_queue_message(self, msg):
         """Processes Queued Message and follows instructions"""
         self.message_parser[msg.command](msg.device, msg.value)
 
+    @property
+    def devices(self):
+        """All devices managed by proc_handler"""
+        return self.cameras + [self.arduino]
+
     def check_exp_is_running(self):
         """Check for device status while experiment running, in order to know when to report experiment complete"""
         if self.exp_start_event.is_set():
-            devices_to_check = [camera.running for camera in self.cameras if camera.use_device]
+            devices_to_check = [device.running for device in self.devices if device.use_device]
             if not any(devices_to_check):
                 self.exp_start_event.clear()
                 msg = NewMessage(cmd=MSG_FINISHED)
                 self.master_dump_queue.put_nowait(msg)
+                self.dump_stats()
+                self.submit_post_processing()
+
+    def dump_stats(self):
+        """Saves the instrumentation summary alongside the files of the run that just finished"""
+        if self.save_dir and self.save_file_name:
+            self.stats_summary.aggregate()
+            self.stats_summary.dump('{}\\{}_stats.txt'.format(self.save_dir, self.save_file_name))
+
+    def submit_post_processing(self):
+        """Hands the files of the run that just finished to the post processing queue"""
+        if self.save_dir and self.save_file_name:
+            msg = NewMessage(cmd=CMD_POSTPROC, val=(self.save_dir, self.save_file_name))
+            self.post_proc_queue.put_nowait(msg)
 
     def set_device_stopped(self, device_type, index, error):
         """Sets device status to stopped; this is internal to proc_handler for managing active/inactive devices"""
@@ -93,13 +140,49 @@ class ProcessHandler(StoppableProcess):
                 msg = NewMessage(dev=CAMERAS, cmd=MSG_ERROR, val=index)
                 self.master_dump_queue.put_nowait(msg)
                 camera.use_device = False
+        elif device_type == ARDUINO:
+            # An Arduino that fails mid-run is reported; one missing at startup is simply not used
+            if error and self.arduino.running:
+                msg = NewMessage(cmd=MSG_WARNING, val='Arduino stopped responding; continuing without it.')
+                self.master_dump_queue.put_nowait(msg)
+            self.arduino.running = False
+            if error:
+                self.arduino.use_device = False
+
+    def set_ttl_time(self, ttl_time):
+        """Keeps track of total experiment time for resource estimates, and passes it on to devices"""
+        self.ttl_time = ttl_time
+        self.set_device_params(param=CMD_SET_TIME, value=ttl_time)
+
+    def set_save_dir(self, save_dir):
+        """Keeps track of the save directory for post processing, and passes it on to devices"""
+        self.save_dir = save_dir
+        self.set_device_params(param=CMD_SET_DIRS, value=save_dir)
+
+    def set_camera_roi(self, index, profile):
+        """Passes a new ROI to one camera, and updates its resource cost"""
+        camera = self.cameras[index]
+        if camera.use_device and not self.exp_start_event.is_set():
+            camera.send_message(NewMessage(cmd=CMD_SET_ROI, val=profile))
+            camera.model.width, camera.model.height = profile.width, profile.height
+
+    def set_camera_preview(self, index, policy):
+        """Passes a new preview policy to one camera; may change mid recording"""
+        camera = self.cameras[index]
+        if camera.use_device:
+            camera.send_message(NewMessage(cmd=CMD_SET_PREVIEW, val=policy))
+
+    def set_ard_settings(self, ard_settings):
+        """Passes the arduino outputs configured in the GUI to the Arduino process ahead of a run"""
+        if self.arduino.use_device and not self.exp_start_event.is_set():
+            self.arduino.send_message(NewMessage(cmd=CMD_SET_ARD, val=ard_settings))
 
     def set_device_params(self, param, value):
         """Change Device Parameters"""
-        for camera in self.cameras:
-            if camera.use_device:
+        for device in self.devices:
+            if device.use_device:
                 msg = NewMessage(cmd=param, val=value)
-                camera.send_message(msg)
+                device.send_message(msg)
 
     def run_experiment(self, save_file_name):
         """Checks devices available, and sends run command to devices in-use"""
@@ -108,13 +191,21 @@ class ProcessHandler(StoppableProcess):
         devices_to_use = [camera.use_device for camera in self.cameras]
         if not any(devices_to_use):
             return
+        self.save_file_name = save_file_name
+        # Refuse to start if the configuration cannot be sustained; warn if it is marginal
+        budget = self.estimate_resources()
+        if not budget.sustainable:
+            self.master_dump_queue.put_nowait(NewMessage(cmd=MSG_ERROR, val=budget.report()))
+            return
+        elif budget.warnings:
+            self.master_dump_queue.put_nowait(NewMessage(cmd=MSG_WARNING, val=budget.report()))
         # Check connections to devices
         msg = NewMessage(cmd=CMD_START, val=save_file_name)
         if self.devices_connected:
-            for camera in self.cameras:
-                if camera.use_device:
-                    camera.send_message(msg)
-                    camera.running = True
+            for device in self.devices:
+                if device.use_device:
+                    device.send_message(msg)
+                    device.running = True
         # Now we can start the experiment by releasing the multiprocessing exp_start_event seen by all processes
             self.exp_start_event.set()
             msg = NewMessage(cmd=MSG_STARTED)
@@ -123,16 +214,23 @@ class ProcessHandler(StoppableProcess):
         # We let Main GUI know if experiment was successfully started
         self.master_dump_queue.put_nowait(msg)
 
+    def estimate_resources(self):
+        """Estimates disk, free space and USB requirements of the devices in use"""
+        save_dir = self.save_dir or self.dirs.settings.last_save_dir
+        cmr_models = [camera.model for camera in self.cameras if camera.use_device]
+        # No LabJack process is run here, so it costs nothing
+        return ResourceBudget(save_dir=save_dir, ttl_time_ms=self.ttl_time, cmr_models=cmr_models, lj_settings=None)
+
     @property
     def devices_connected(self):
         """Checks if the in-use devices are connected and responsive"""
         nonresponsive_devices = []
         msg = NewMessage(cmd=CMD_CHECK_CONN)
-        for camera in self.cameras:
-            if camera.use_device:
-                camera.mp_pipe.send(msg)
-                if camera.mp_pipe.poll(3):
-                    if not camera.mp_pipe.recv():
+        for device in self.devices:
+            if device.use_device:
+                device.mp_pipe.send_bytes(msg)
+                if device.mp_pipe.poll(3):
+                    if not device.mp_pipe.recv():
                         nonresponsive_devices.append(True)
                 else:
                     nonresponsive_devices.append(True)
@@ -141,18 +239,22 @@ class ProcessHandler(StoppableProcess):
     def hardstop_experiment(self):
         """Forces a premature exit from running experiment"""
         msg = NewMessage(cmd=CMD_STOP)
-        for camera in self.cameras:
-            if camera.use_device:
-                camera.send_message(msg)
-                camera.running = False
+        for device in self.devices:
+            if device.use_device:
+                device.send_message(msg)
+                device.running = False
         self.exp_start_event.clear()
         msg = NewMessage(cmd=MSG_FINISHED)
         self.master_dump_queue.put_nowait(msg)
+        self.dump_stats()
+        self.submit_post_processing()
 
     def close_devices(self):
         """Safely close device connections and processes"""
         msg = NewMessage(cmd=CMD_EXIT)
-        for camera in self.cameras:
-            if camera.use_device:
-                camera.send_message(msg)
+        for device in self.devices:
+            # The Arduino process outlives a missing Arduino, so it is always told to exit
+            if device.use_device or device is self.arduino:
+                device.send_message(msg)
+        self.post_proc_queue.put_nowait(msg)
         self.master_dump_queue.put_nowait(msg)
@@ -0,0 +1,122 @@
+# coding=utf-8
+
+"""Microbenchmark of control messages between processes: messages/s and round trip latency
+Run from the QT_Mouse_House_2 directory: python -m Concurrency.MessageBenchmark [--messages N] [--round-trips N]"""
+
+import time
+import pickle
+import argparse
+import multiprocessing as mp
+from Misc.Names import CAMERAS, MSG_FINISHED
+from Misc.CustomClasses import NewMessage, ReadMessage
+from Concurrency.Channels import Channel, wait_for_message
+
+
+# A typical status message: camera #3 finished; pickled tuples carried the command's name
+LEGACY_MESSAGE = (CAMERAS, 'msg_finished', 3)
+PACKAGED_MESSAGE = NewMessage(dev=CAMERAS, cmd=MSG_FINISHED, val=3)
+# Transports
+PIPE_PICKLED = 'pipe, pickled tuples'
+PIPE_PACKAGED = 'pipe, packaged messages'
+CHANNEL_PACKAGED = 'channel, packaged messages'
+TRANSPORTS = (PIPE_PICKLED, PIPE_PACKAGED, CHANNEL_PACKAGED)
+
+
+class Endpoint(object):
+    """One end of a transport under test, with the send and receive calls the program would use"""
+    def __init__(self, transport, inbound, outbound):
+        self.transport = transport
+        self.inbound = inbound
+        self.outbound = outbound
+
+    def send(self):
+        """Sends the benchmark message"""
+        if self.transport == PIPE_PICKLED:
+            self.outbound.send(LEGACY_MESSAGE)
+        elif self.transport == PIPE_PACKAGED:
+            self.outbound.send_bytes(PACKAGED_MESSAGE)
+        else:
+            while not self.outbound.put_nowait(PACKAGED_MESSAGE):
+                time.sleep(0)
+
+    def receive(self):
+        """Receives and unpacks one message"""
+        if self.transport == PIPE_PICKLED:
+            return self.inbound.recv()[1]
+        elif self.transport == PIPE_PACKAGED:
+            return ReadMessage(self.inbound.recv_bytes()).command
+        return ReadMessage(wait_for_message(self.inbound.get_nowait, None)).command
+
+
+def create_endpoints(transport):
+    """(local, remote) endpoints connected in both directions"""
+    if transport == CHANNEL_PACKAGED:
+        forward, backward = Channel('forward'), Channel('backward')
+        return Endpoint(transport, backward, forward), Endpoint(transport, forward, backward)
+    local, remote = mp.Pipe()
+    return Endpoint(transport, local, local), Endpoint(transport, remote, remote)
+
+
+# -- Remote Processes -- #
+# Module level functions such that they can be started on spawned processes
+def send_stream(endpoint, num_messages):
+    """Sends num_messages as fast as the transport allows"""
+    for _ in range(num_messages):
+        endpoint.send()
+
+
+def echo(endpoint, num_messages):
+    """Unpacks every message received and sends one back"""
+    for _ in range(num_messages):
+        endpoint.receive()
+        endpoint.send()
+
+
+def measure_throughput(transport, num_messages):
+    """Messages/s received from another process, including unpacking"""
+    local, remote = create_endpoints(transport)
+    proc = mp.Process(target=send_stream, args=(remote, num_messages))
+    proc.start()
+    local.receive()  # start timing once the sender is running
+    start = time.perf_counter()
+    for _ in range(num_messages - 1):
+        local.receive()
+    elapsed = time.perf_counter() - start
+    proc.join()
+    return (num_messages - 1) / elapsed
+
+
+def measure_latency(transport, num_round_trips):
+    """(median, 99th percentile) round trip time in microseconds"""
+    local, remote = create_endpoints(transport)
+    proc = mp.Process(target=echo, args=(remote, num_round_trips))
+    proc.start()
+    round_trips = []
+    for _ in range(num_round_trips):
+        start = time.perf_counter()
+        local.send()
+        local.receive()
+        round_trips.append((time.perf_counter() - start) * 1e6)
+    proc.join()
+    round_trips.sort()
+    return round_trips[len(round_trips) // 2], round_trips[int(len(round_trips) * 0.99)]
+
+
+def run_benchmark(num_messages, num_round_trips):
+    """Measures every transport; returns one report line per transport"""
+    lines = ['{:<28}{:>8} B{:>14}{:>14}{:>14}'.format('transport', 'size', 'msgs/s', 'rtt p50 us', 'rtt p99 us')]
+    for transport in TRANSPORTS:
+        size = len(pickle.dumps(LEGACY_MESSAGE)) if transport == PIPE_PICKLED else len(PACKAGED_MESSAGE)
+        rate = measure_throughput(transport, num_messages)
+        median, worst = measure_latency(transport, num_round_trips)
+        lines.append('{:<28}{:>8} B{:>14,.0f}{:>14.1f}{:>14.1f}'.format(transport, size, rate, median, worst))
+    return lines
+
+
+if __name__ == '__main__':
+    mp.freeze_support()
+    PARSER = argparse.ArgumentParser(description='Benchmark control messages between processes.')
+    PARSER.add_argument('--messages', type=int, default=100000, help='messages for the throughput test')
+    PARSER.add_argument('--round-trips', type=int, default=10000, help='round trips for the latency test')
+    ARGS = PARSER.parse_args()
+    print('\n'.join(run_benchmark(ARGS.messages, ARGS.round_trips)))
@@ -0,0 +1,249 @@
+# coding=utf-8
+
+"""Background queue that compresses, verifies and checksums the files of finished runs"""
+
+import os
+import sys
+import gzip
+import time
+import pickle
+import hashlib
+import imageio
+import multiprocessing as mp
+from collections import deque
+from Misc.Names import *
+from Misc.CustomClasses import *
+if sys.version[0] == '2':
+    import Queue as Queue
+else:
+    import queue as Queue
+
+
+# Size of one independently compressed chunk of a LabJack file
+CHUNK_SIZE = 16 * 1024 * 1024
+# Block size used when streaming files for checksums
+HASH_BLOCK_SIZE = 1024 * 1024
+# File extensions produced by each device writer
+LJ_FILE_FMTS = ('.csv',)
+CMR_FILE_FMTS = ('.avi', '.mkv')
+# Suffixes of files produced by post processing; never processed again
+COMPRESSED_FMT = '.gz'
+CHECKSUM_FMT = '.sha256'
+PARTIAL_FMT = '.part'
+# Unfinished jobs are kept here between sessions
+PENDING_JOBS_FILE = HOME_DIR + '\\PostProcessQueue.qtmsh'
+
+
+# -- Pool Workers -- #
+# Module level functions such that they can be pickled and sent to pool workers
+def lower_priority():
+    """Pool initializer; runs workers at idle priority so they never compete with acquisition"""
+    if sys.platform.startswith('win'):
+        import ctypes
+        idle_priority_class = 0x00000040
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        ctypes.windll.kernel32.SetPriorityClass(handle, idle_priority_class)
+    else:
+        os.nice(19)
+
+
+def compress_chunk(path, offset, length):
+    """Reads one chunk of a file and returns it as a standalone gzip member"""
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        data = file.read(length)
+    # Concatenated gzip members are themselves a valid gzip file
+    return gzip.compress(data, compresslevel=6)
+
+
+def sha256_file(path, compressed=False):
+    """Returns the sha256 hex digest of a file; of its decompressed contents if compressed"""
+    digest = hashlib.sha256()
+    opener = gzip.open if compressed else open
+    with opener(path, 'rb') as file:
+        block = file.read(HASH_BLOCK_SIZE)
+        while block:
+            digest.update(block)
+            block = file.read(HASH_BLOCK_SIZE)
+    return digest.hexdigest()
+
+
+def count_video_frames(path):
+    """Returns the number of decodable frames in a video file, or None if unreadable"""
+    try:
+        reader = imageio.get_reader(path)
+        try:
+            num_frames = reader.count_frames()
+        except AttributeError:
+            num_frames = sum(1 for _ in reader)
+        reader.close()
+    except (IOError, OSError, RuntimeError, ValueError):
+        return None
+    return num_frames
+
+
+# -- Jobs -- #
+class PostProcessJob(object):
+    """All files belonging to one finished run"""
+    def __init__(self, save_dir, save_file_name):
+        self.save_dir = save_dir
+        self.save_file_name = save_file_name
+
+    @property
+    def files(self):
+        """Returns paths of raw data files written for this run"""
+        done_fmts = (COMPRESSED_FMT, CHECKSUM_FMT, PARTIAL_FMT)
+        try:
+            names = os.listdir(self.save_dir)
+        except (IOError, OSError):
+            return []
+        return ['{}\\{}'.format(self.save_dir, name) for name in sorted(names)
+                if name.startswith(self.save_file_name) and not name.endswith(done_fmts)]
+
+    @property
+    def manifest_path(self):
+        """Checksum manifest for this run, in sha256sum format"""
+        return '{}\\{}{}'.format(self.save_dir, self.save_file_name, CHECKSUM_FMT)
+
+
+class PostProcessHandler(StoppableProcess):
+    """Receives finished runs from proc_handler and post processes them on a low priority process pool"""
+    def __init__(self, job_queue, master_dump_queue, exp_start_event, num_workers=None, delete_originals=False):
+        super(PostProcessHandler, self).__init__()
+        self.name = 'Post Process Handler'
+        # A process pool cannot be created from inside a daemonic process
+        self.daemon = False
+        # Leave at least half of the machine to device processes
+        self.num_workers = num_workers or max(1, mp.cpu_count() // 2)
+        self.delete_originals = delete_originals
+        # Concurrency
+        self.job_queue = job_queue
+        self.exp_start_event = exp_start_event
+        self.master_dump_queue = master_dump_queue
+        # Jobs that have not been completed yet
+        self.pending = deque()
+
+    def setup_message_parser(self):
+        """Generates a dictionary of {Message:Actions} for message parsing"""
+        self.message_parser = {
+            CMD_POSTPROC: lambda value: self.pending.append(PostProcessJob(*value)),
+            CMD_EXIT: lambda value: self.stop()
+        }
+
+    def run(self):
+        """Processes finished runs one at a time, only while no experiment is running"""
+        self.setup_message_parser()
+        self.load_pending()
+        self.pool = mp.Pool(self.num_workers, initializer=lower_priority)
+        while not self.stopped():
+            self.check_messages(timeout=0.1)
+            # We never start a job while devices are acquiring
+            if self.pending and not self.exp_start_event.is_set():
+                if self.process_job(self.pending[0]):
+                    self.pending.popleft()
+        # Any unfinished jobs are saved and resumed next session
+        self.pool.terminate()
+        self.pool.join()
+        self.save_pending()
+
+    def check_messages(self, timeout):
+        """Gets one message from the job queue, if any"""
+        try:
+            msg = self.job_queue.get(timeout=timeout)
+        except Queue.Empty:
+            pass
+        else:
+            msg = ReadMessage(msg)
+            self.message_parser[msg.command](msg.value)
+
+    def wait_for(self, async_results):
+        """Blocks until all async results are ready; returns None if we were stopped in the meantime"""
+        while not all(result.ready() for result in async_results):
+            self.check_messages(timeout=0.05)
+            if self.stopped():
+                return None
+        return [result.get() for result in async_results]
+
+    def process_job(self, job):
+        """Checksums, compresses and verifies all files of one run. Returns True once the job is complete"""
+        files = job.files
+        lj_files = [path for path in files if path.endswith(LJ_FILE_FMTS)]
+        cmr_files = [path for path in files if path.endswith(CMR_FILE_FMTS)]
+        # Checksums of raw files, and frame counts of video files, run concurrently
+        checksums = [self.pool.apply_async(sha256_file, (path,)) for path in files]
+        frame_counts = [self.pool.apply_async(count_video_frames, (path,)) for path in cmr_files]
+        results = self.wait_for(checksums + frame_counts)
+        if results is None:
+            return False
+        checksums = dict(zip(files, results[:len(files)]))
+        frame_counts = dict(zip(cmr_files, results[len(files):]))
+        # Compress LabJack data
+        errors = ['{} could not be decoded'.format(path) for path in cmr_files if frame_counts[path] is None]
+        for path in lj_files:
+            compressed = self.compress_file(path, checksums[path])
+            if compressed is None:
+                return False
+            elif not compressed:
+                errors.append('{} failed compression verification'.format(path))
+        # Finish
+        self.write_manifest(job, checksums, frame_counts)
+        if errors:
+            msg = NewMessage(cmd=MSG_ERROR, val='Post Processing Errors:\n\n{}'.format('\n'.join(errors)))
+            self.master_dump_queue.put_nowait(msg)
+        return True
+
+    def compress_file(self, path, checksum):
+        """Compresses a file in parallel chunks and verifies the result against the original checksum
+        Returns True if verified, False if verification failed, None if stopped"""
+        size = os.path.getsize(path)
+        chunks = [self.pool.apply_async(compress_chunk, (path, offset, CHUNK_SIZE))
+                  for offset in range(0, max(size, 1), CHUNK_SIZE)]
+        members = self.wait_for(chunks)
+        if members is None:
+            return None
+        # We write to a partial file first so an interrupted write is never mistaken for a finished one
+        partial_path = path + COMPRESSED_FMT + PARTIAL_FMT
+        with open(partial_path, 'wb') as file:
+            for member in members:
+                file.write(member)
+        verified = self.wait_for([self.pool.apply_async(sha256_file, (partial_path, True))])
+        if verified is None:
+            return None
+        if verified[0] != checksum:
+            os.remove(partial_path)
+            return False
+        os.replace(partial_path, path + COMPRESSED_FMT)
+        if self.delete_originals:
+            os.remove(path)
+        return True
+
+    @staticmethod
+    def write_manifest(job, checksums, frame_counts):
+        """Writes sha256sum compatible checksums, with frame counts of video files as comments"""
+        with open(job.manifest_path, 'w') as file:
+            for path, checksum in sorted(checksums.items()):
+                name = os.path.basename(path.replace('\\', os.sep))
+                if path in frame_counts:
+                    file.write('# {}: {} frames\n'.format(name, frame_counts[path]))
+                file.write('{}  {}\n'.format(checksum, name))
+
+    def load_pending(self):
+        """Resumes jobs left unfinished from a previous session"""
+        if os.path.isfile(PENDING_JOBS_FILE):
+            with open(PENDING_JOBS_FILE, 'rb') as file:
+                self.pending.extend(pickle.load(file))
+            os.remove(PENDING_JOBS_FILE)
+
+    def save_pending(self):
+        """Saves unfinished jobs for the next session"""
+        # Drain anything proc_handler sent after we stopped
+        while True:
+            try:
+                msg = ReadMessage(self.job_queue.get_nowait())
+            except Queue.Empty:
+                break
+            if msg.command == CMD_POSTPROC:
+                self.pending.append(PostProcessJob(*msg.value))
+        if self.pending:
+            with open(PENDING_JOBS_FILE, 'wb') as file:
+                pickle.dump(list(self.pending), file)
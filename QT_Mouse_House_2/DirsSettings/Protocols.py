@@ -0,0 +1,156 @@
+# coding=utf-8
+
+"""Generates arduino settings for large randomized or block design protocols, validated against the firmware
+Run from the QT_Mouse_House_2 directory: python -m DirsSettings.Protocols [--trials N] [--seed N]"""
+
+import time
+import random
+import argparse
+from Misc.Names import TONE, OUTP, PWM, TONE_PIN
+from DirsSettings.Settings import ArdSettings, ArdSegment
+from DirsSettings.SegmentModel import SegmentModel
+from Concurrency.ArdSchedule import compile_schedule, check_schedule
+
+
+# -- Jitter Distributions -- #
+# Any time below may be a number of ms or one of these; each is drawn again every time it is used
+def uniform(low_ms, high_ms):
+    """Uniformly distributed between low_ms and high_ms"""
+    return lambda rng: rng.uniform(low_ms, high_ms)
+
+
+def exponential(mean_ms, low_ms=0, high_ms=None):
+    """low_ms plus an exponentially distributed wait of mean mean_ms, truncated at high_ms"""
+    def draw(rng):
+        value = low_ms + rng.expovariate(1.0 / mean_ms)
+        return min(value, high_ms) if high_ms is not None else value
+    return draw
+
+
+def choice(*values_ms):
+    """One of values_ms, each equally likely"""
+    return lambda rng: rng.choice(values_ms)
+
+
+def draw_ms(value, rng):
+    """A time in ms, drawn from value if it is a distribution"""
+    return value(rng) if callable(value) else value
+
+
+# -- Protocol Description -- #
+class Stimulus(object):
+    """One segment of a trial; onset is relative to the start of the trial"""
+    def __init__(self, types, pin, onset_ms, duration_ms, frequency=None, phase_shft=None, duty_cycle=None):
+        self.types = types
+        self.pin = pin
+        self.onset_ms = onset_ms
+        self.duration_ms = duration_ms
+        self.freq = frequency
+        self.phase_shft = phase_shft
+        self.duty_cycle = duty_cycle
+
+    def segment(self, trial_start_ms, rng):
+        """ArdSegment of this stimulus in a trial starting at trial_start_ms"""
+        on_ms = int(round(trial_start_ms + draw_ms(self.onset_ms, rng)))
+        off_ms = on_ms + int(round(draw_ms(self.duration_ms, rng)))
+        return ArdSegment(on_ms, off_ms, self.types, self.pin, self.freq, self.phase_shft, self.duty_cycle)
+
+
+def tone(frequency, duration_ms, onset_ms=0):
+    """Tone on pin 10"""
+    return Stimulus(TONE, TONE_PIN, onset_ms, duration_ms, frequency=frequency)
+
+
+def output(pin, duration_ms, onset_ms=0):
+    """Constant output on a D register pin"""
+    return Stimulus(OUTP, pin, onset_ms, duration_ms)
+
+
+def pwm(pin, frequency, duty_cycle, duration_ms, onset_ms=0, phase_shift=0):
+    """PWM on a B register pin; duty cycle in %, phase shift in degrees"""
+    return Stimulus(PWM, pin, onset_ms, duration_ms, frequency, phase_shift, duty_cycle)
+
+
+class Trial(object):
+    """Stimuli delivered together; lasts until its last stimulus ends unless given a duration"""
+    def __init__(self, stimuli, duration_ms=None):
+        self.stimuli = stimuli
+        self.duration_ms = duration_ms
+
+    def segments(self, start_ms, rng):
+        """(segments, trial duration in ms) of one trial starting at start_ms"""
+        segments = [stimulus.segment(start_ms, rng) for stimulus in self.stimuli]
+        if self.duration_ms is not None:
+            return segments, draw_ms(self.duration_ms, rng)
+        return segments, max([segment.off_ms for segment in segments] + [start_ms]) - start_ms
+
+
+class Block(object):
+    """Trials repeated in a block, separated by inter trial intervals
+    With shuffle, the trials of all repeats are delivered in random order"""
+    def __init__(self, trials, repeats=1, iti_ms=0, shuffle=False, lead_ms=0):
+        self.trials = trials
+        self.repeats = repeats
+        self.iti_ms = iti_ms
+        self.shuffle = shuffle
+        self.lead_ms = lead_ms  # before the first trial
+
+    def order(self, rng):
+        """Trials in the order they are delivered"""
+        order = list(self.trials) * self.repeats
+        if self.shuffle:
+            rng.shuffle(order)
+        return order
+
+
+class Protocol(object):
+    """Blocks delivered one after another; the same seed always generates the same settings"""
+    def __init__(self, blocks, seed=None, tail_ms=0):
+        self.blocks = blocks
+        self.seed = seed
+        self.tail_ms = tail_ms  # after the last trial
+
+    def segments(self):
+        """(segments, total time in ms) of the whole protocol"""
+        rng = random.Random(self.seed)
+        segments = []
+        time_ms = 0
+        for block in self.blocks:
+            time_ms += draw_ms(block.lead_ms, rng)
+            for index, trial in enumerate(block.order(rng)):
+                if index:
+                    time_ms += draw_ms(block.iti_ms, rng)
+                trial_segments, duration_ms = trial.segments(time_ms, rng)
+                segments.extend(trial_segments)
+                time_ms += duration_ms
+        ttl_time = int(round(time_ms + draw_ms(self.tail_ms, rng)))
+        return segments, max([ttl_time] + [segment.off_ms for segment in segments])
+
+    def generate(self):
+        """ArdSettings of the protocol; raises ValueError if segments conflict or the firmware cannot play it"""
+        segments, ttl_time = self.segments()
+        settings = ArdSettings()
+        settings.ttl_time_ms = ttl_time
+        settings.configs = SegmentModel(segments).configs
+        check_schedule(compile_schedule(settings.configs), ttl_time)
+        return settings
+
+
+def fear_conditioning(trials, seed=None):
+    """Example: tone-shock pairings in random order with unpaired tones, separated by jittered intervals"""
+    paired = Trial([tone(2800, 20000), output(6, 2000, onset_ms=18000)])
+    unpaired = Trial([tone(2800, 20000)])
+    return Protocol([Block([paired, unpaired], repeats=trials // 2, iti_ms=uniform(40000, 80000), shuffle=True,
+                           lead_ms=120000)], seed=seed, tail_ms=60000)
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description='Generate and validate an example protocol.')
+    PARSER.add_argument('--trials', type=int, default=10000, help='trials in the example protocol')
+    PARSER.add_argument('--seed', type=int, default=0, help='random seed')
+    ARGS = PARSER.parse_args()
+    START = time.perf_counter()
+    SETTINGS = fear_conditioning(ARGS.trials, ARGS.seed).generate()
+    print('{} segments, {} events, {:.1f} h; generated and validated in {:.3f} s'.format(
+        len(SETTINGS.configs), len(compile_schedule(SETTINGS.configs)), SETTINGS.ttl_time_ms / 3.6e6,
+        time.perf_counter() - START))
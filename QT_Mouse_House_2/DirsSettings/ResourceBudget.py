@@ -0,0 +1,172 @@
+# coding=utf-8
+
+"""Estimates whether disk, free space and USB bandwidth can sustain an experiment configuration"""
+
+import os
+import time
+import shutil
+from Misc.Names import *
+
+
+# Fraction of measured capacity above which we warn, and above which we refuse to start
+WARN_UTILIZATION = 0.75
+MAX_UTILIZATION = 1.0
+# Practical bulk throughput of one USB 2.0 host controller shared by all devices, bytes/s
+USB_BANDWIDTH = 35e6
+# Extra free space kept in reserve after a run, bytes
+FREE_SPACE_RESERVE = 1e9
+# Disk calibration write
+CALIBRATION_SIZE = 64 * 1024 * 1024
+CALIBRATION_BLOCK = 1024 * 1024
+CALIBRATION_FILE = 'disk_calibration.tmp'
+# LabJack U6 streams 25 two byte samples per 64 byte packet
+LJ_USB_BYTES_PER_SAMPLE = 64.0 / 25
+# Each sample written by the LabJack CSV writer is a formatted float plus a separator
+LJ_CSV_BYTES_PER_SAMPLE = 20.0
+
+
+class CameraCostModel(object):
+    """Bytes per second one camera moves over USB and writes to disk at its encoder"""
+    def __init__(self, width, height, fps, bytes_per_px, encoder_ratio):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.bytes_per_px = bytes_per_px
+        self.encoder_ratio = encoder_ratio  # encoded size / raw size
+
+    @property
+    def usb_rate(self):
+        """Raw sensor data transferred per second"""
+        return self.width * self.height * self.bytes_per_px * self.fps
+
+    @property
+    def disk_rate(self):
+        """Encoded data written per second"""
+        return self.usb_rate * self.encoder_ratio
+
+
+# (bytes_per_px, encoder_ratio) of each camera type
+# FireFly: Y8 written uncompressed by FlyCapture's AVI recorder
+# Mini Microscope: written as yuv420p (1.5 bytes/px) ffv1, ~2:1 lossless
+CMR_ENCODINGS = {
+    FIREFLY_CAMERA: (1, 1.0),
+    MINIMIC_CAMERA: (1, 0.75)
+}
+
+
+def camera_cost_model(cmr_type, profile):
+    """Cost model of one camera acquiring with a resolved CameraProfile"""
+    bytes_per_px, encoder_ratio = CMR_ENCODINGS[cmr_type]
+    return CameraCostModel(width=profile.width, height=profile.height, fps=profile.fps,
+                           bytes_per_px=bytes_per_px, encoder_ratio=encoder_ratio)
+
+
+def format_bytes(num_bytes, per_sec=False):
+    """Human readable byte counts"""
+    suffix = '/s' if per_sec else ''
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(num_bytes) < 1000.0:
+            return '{:.1f} {}{}'.format(num_bytes, unit, suffix)
+        num_bytes /= 1000.0
+    return '{:.1f} TB{}'.format(num_bytes, suffix)
+
+
+def measure_disk_throughput(directory):
+    """Times a short synced write to directory. Returns bytes/s"""
+    path = '{}\\{}'.format(directory, CALIBRATION_FILE)
+    block = os.urandom(CALIBRATION_BLOCK)  # random data so compressing filesystems can't cheat
+    start = time.perf_counter()
+    try:
+        with open(path, 'wb') as file:
+            for _ in range(CALIBRATION_SIZE // CALIBRATION_BLOCK):
+                file.write(block)
+            file.flush()
+            os.fsync(file.fileno())
+        elapsed = time.perf_counter() - start
+    finally:
+        if os.path.isfile(path):
+            os.remove(path)
+    return CALIBRATION_SIZE / max(elapsed, 1e-6)
+
+
+class ResourceBudget(object):
+    """Sums the per device cost models of a configuration and checks it against measured capacity"""
+    # Disk throughput is measured once per directory per session
+    measured_throughput = {}
+
+    def __init__(self, save_dir, ttl_time_ms, cmr_models, lj_settings=None):
+        self.save_dir = save_dir
+        self.ttl_secs = ttl_time_ms / 1000.0
+        self.cmr_models = cmr_models
+        self.lj_settings = lj_settings
+        self.errors = []
+        self.warnings = []
+        self.check()
+
+    @property
+    def lj_sample_rate(self):
+        """Total LabJack samples per second across all channels"""
+        if not self.lj_settings:
+            return 0
+        return self.lj_settings.scan_freq * len(self.lj_settings.ch_num)
+
+    @property
+    def disk_rate(self):
+        """Total bytes/s written by all devices"""
+        return sum(model.disk_rate for model in self.cmr_models) \
+            + self.lj_sample_rate * LJ_CSV_BYTES_PER_SAMPLE
+
+    @property
+    def usb_rate(self):
+        """Total bytes/s transferred over USB by all devices"""
+        return sum(model.usb_rate for model in self.cmr_models) \
+            + self.lj_sample_rate * LJ_USB_BYTES_PER_SAMPLE
+
+    @property
+    def disk_throughput(self):
+        """Measured write throughput of the save directory"""
+        if self.save_dir not in self.measured_throughput:
+            self.measured_throughput[self.save_dir] = measure_disk_throughput(self.save_dir)
+        return self.measured_throughput[self.save_dir]
+
+    @property
+    def sustainable(self):
+        """True if the configuration can run without missing samples"""
+        return not self.errors
+
+    def check(self):
+        """Compares each requirement with its available capacity"""
+        # USB bandwidth
+        self.check_utilization('USB bandwidth', self.usb_rate, USB_BANDWIDTH, per_sec=True)
+        # A missing or unplugged save directory refuses the run instead of raising
+        try:
+            # Disk write rate
+            self.check_utilization('Disk write rate', self.disk_rate, self.disk_throughput, per_sec=True)
+            # Free space; we want a reserve left over after the run
+            required = self.disk_rate * self.ttl_secs + FREE_SPACE_RESERVE
+            self.check_utilization('Disk space', required, shutil.disk_usage(self.save_dir).free)
+        except OSError as error:
+            self.errors.append('Save directory [{}] is not writable: {}'.format(self.save_dir,
+                                                                              error.strerror or error))
+
+    def check_utilization(self, name, required, available, per_sec=False):
+        """Sorts one requirement into errors or warnings depending on utilization"""
+        utilization = required / max(available, 1.0)
+        line = '{}: {} required of {} available ({:.0%})'.format(name, format_bytes(required, per_sec),
+                                                                 format_bytes(available, per_sec), utilization)
+        if utilization > MAX_UTILIZATION:
+            self.errors.append(line)
+        elif utilization > WARN_UTILIZATION:
+            self.warnings.append(line)
+
+    def report(self):
+        """Summary of any problems found, for display to the user"""
+        lines = []
+        if self.errors:
+            lines += ['Cannot start: this configuration exceeds available resources.\n'] + self.errors
+        if self.warnings:
+            lines += ['\nResources are close to their limits; samples may be missed.\n'] + self.warnings
+        lines += ['\n{} camera(s), {} LabJack samples/s, {:.0f}s total'.format(len(self.cmr_models),
+                                                                            self.lj_sample_rate,
+                                                                            self.ttl_secs)]
+        return '\n'.join(lines).strip()
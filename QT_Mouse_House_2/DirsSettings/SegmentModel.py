@@ -0,0 +1,213 @@
+# coding=utf-8
+
+"""Arduino segments of one protocol held in an interval tree per pin, with merging and conflict detection"""
+
+import random
+from heapq import merge
+from operator import attrgetter
+from Misc.Names import TONE, OUTP, PWM, TONE_PIN, OUTP_PIN, PWM_PINS
+
+
+# Pins each segment type may drive
+SEGMENT_PINS = {TONE: [TONE_PIN], OUTP: OUTP_PIN, PWM: PWM_PINS}
+
+
+def same_stimulus(segment, other):
+    """True if two segments drive their pin the same way, so they can be merged"""
+    return (segment.types, segment.freq, segment.phast_shift, segment.duty_cycle) == \
+        (other.types, other.freq, other.phast_shift, other.duty_cycle)
+
+
+class IntervalNode(object):
+    """One segment in an IntervalTree; max_off is the latest end in its subtree"""
+    def __init__(self, segment):
+        self.segment = segment
+        self.key = (segment.on_ms, id(segment))
+        self.priority = random.random()
+        self.max_off = segment.off_ms
+        self.left = None
+        self.right = None
+
+    def update(self):
+        """Recomputes max_off from the children"""
+        self.max_off = max([self.segment.off_ms] + [child.max_off for child in (self.left, self.right) if child])
+
+
+def rotate_right(node):
+    """Lifts the left child above node"""
+    child = node.left
+    node.left = child.right
+    node.update()
+    child.right = node
+    child.update()
+    return child
+
+
+def rotate_left(node):
+    """Lifts the right child above node"""
+    child = node.right
+    node.right = child.left
+    node.update()
+    child.left = node
+    child.update()
+    return child
+
+
+def join(left, right):
+    """Joins two subtrees whose keys are all ordered left before right"""
+    if left is None or right is None:
+        return left or right
+    if left.priority > right.priority:
+        left.right = join(left.right, right)
+        left.update()
+        return left
+    right.left = join(left, right.left)
+    right.update()
+    return right
+
+
+class IntervalTree(object):
+    """Segments ordered by start time; a treap, so insert, remove and overlap queries take O(log n) expected time
+    A segment's times must not change while it is in the tree"""
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        """Segments in order of start time"""
+        stack = []
+        node = self.root
+        while stack or node:
+            while node:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.segment
+            node = node.right
+
+    def insert(self, segment):
+        """Adds a segment"""
+        self.root = self._insert(self.root, IntervalNode(segment))
+        self.size += 1
+
+    def _insert(self, node, new):
+        if node is None:
+            return new
+        if new.key < node.key:
+            node.left = self._insert(node.left, new)
+            if node.left.priority > node.priority:
+                node = rotate_right(node)
+        else:
+            node.right = self._insert(node.right, new)
+            if node.right.priority > node.priority:
+                node = rotate_left(node)
+        node.update()
+        return node
+
+    def remove(self, segment):
+        """Removes a segment; does nothing if it is not in the tree"""
+        size = self.size
+        self.root = self._remove(self.root, (segment.on_ms, id(segment)))
+        return self.size < size
+
+    def _remove(self, node, key):
+        if node is None:
+            return None
+        if key == node.key:
+            self.size -= 1
+            return join(node.left, node.right)
+        if key < node.key:
+            node.left = self._remove(node.left, key)
+        else:
+            node.right = self._remove(node.right, key)
+        node.update()
+        return node
+
+    def overlapping(self, on_ms, off_ms):
+        """Segments overlapping or touching [on_ms, off_ms]"""
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            # Nothing in this subtree ends late enough
+            if node is None or node.max_off < on_ms:
+                continue
+            stack.append(node.left)
+            # Nothing right of a segment starting too late starts early enough
+            if node.segment.on_ms <= off_ms:
+                if node.segment.off_ms >= on_ms:
+                    found.append(node.segment)
+                stack.append(node.right)
+        return found
+
+
+class SegmentModel(object):
+    """Arduino segments of one protocol, in an interval tree per pin
+    Overlapping or adjacent segments with the same stimulus are merged into one
+    Overlapping segments that drive one pin differently are a conflict and are refused"""
+    def __init__(self, configs=()):
+        self.trees = {}
+        for segment in configs:
+            self.add(segment)
+
+    def __len__(self):
+        return sum(len(tree) for tree in self.trees.values())
+
+    @property
+    def configs(self):
+        """All segments, in order of start time"""
+        return list(merge(*self.trees.values(), key=attrgetter('on_ms')))
+
+    def load(self, configs):
+        """Adds every valid segment; returns the ones that were refused"""
+        refused = []
+        for segment in configs:
+            try:
+                self.add(segment)
+            except ValueError:
+                refused.append(segment)
+        return refused
+
+    def overlapping(self, pin, on_ms, off_ms):
+        """Segments on a pin overlapping or touching [on_ms, off_ms]"""
+        tree = self.trees.get(pin)
+        return tree.overlapping(on_ms, off_ms) if tree else []
+
+    def conflicts(self, segment):
+        """Segments on the same pin that overlap segment but drive the pin differently"""
+        return [other for other in self.overlapping(segment.pin, segment.on_ms, segment.off_ms)
+                if other.on_ms < segment.off_ms and other.off_ms > segment.on_ms
+                and not same_stimulus(other, segment)]
+
+    def check(self, segment):
+        """Raises ValueError if segment cannot be added"""
+        if segment.pin not in SEGMENT_PINS.get(segment.types, []):
+            raise ValueError('Pin {} cannot be used for {} segments'.format(segment.pin, segment.types))
+        if not 0 <= segment.on_ms < segment.off_ms:
+            raise ValueError('Segments must end after they start')
+        conflicts = self.conflicts(segment)
+        if conflicts:
+            raise ValueError('Pin {} is already used by {} segment(s) between {} and {} ms'
+                             ''.format(segment.pin, len(conflicts), min(other.on_ms for other in conflicts),
+                                       max(other.off_ms for other in conflicts)))
+
+    def add(self, segment):
+        """Adds a segment, absorbing overlapping or adjacent segments of the same stimulus
+        Returns the segment stored; raises ValueError if it is invalid or conflicts with another"""
+        self.check(segment)
+        tree = self.trees.setdefault(segment.pin, IntervalTree())
+        for other in tree.overlapping(segment.on_ms, segment.off_ms):
+            if same_stimulus(other, segment):
+                tree.remove(other)
+                segment.on_ms = min(segment.on_ms, other.on_ms)
+                segment.off_ms = max(segment.off_ms, other.off_ms)
+        tree.insert(segment)
+        return segment
+
+    def remove(self, segment):
+        """Removes a segment; returns False if it was not in the model"""
+        tree = self.trees.get(segment.pin)
+        return bool(tree) and tree.remove(segment)
@@ -3,14 +3,26 @@
 """Handles IO and Configurations across all modules and devices"""
 
 import sys
+import copy
 from Misc.Names import *
+from DirsSettings.SegmentModel import SegmentModel
 
 
-class MainSettings(object):
+class DefaultsOnUnpickle(object):
+    """Base of settings pickled to disk; __init__ must take no required arguments"""
+    def __setstate__(self, state):
+        """Settings pickled by older versions may lack newer attributes; we start from defaults"""
+        self.__init__()
+        self.__dict__.update(state)
+
+
+class MainSettings(DefaultsOnUnpickle):
     """Holds all relevant user configurable settings"""
     def __init__(self):
         # Device Specific Params
         self.ard_ser_port = ''
+        # Paint camera previews with OpenGL where available
+        self.gl_preview = False
         # Last Used Settings
         self.last_save_dir = ''
         self.last_fp = PhotometrySettings()
@@ -19,6 +31,44 @@ class MainSettings(object):
         # User configured Presets for future use
         self.ard_presets = {}
         self.ljk_presets = {}
+        # Device health alarm thresholds
+        self.health = HealthSettings()
+        # Camera acquisition profiles, {'type #id': CameraProfile}; cameras without one use the default
+        self.cmr_profiles = {}
+        # Camera preview policies, {'type #id': PreviewPolicy}
+        self.cmr_previews = {}
+        # Animal tracking, {'type #id': TrackingSettings}
+        self.tracking = {}
+        # Stimulus triggered by the tracked position of the animal
+        self.closed_loop = ClosedLoopSettings()
+
+    def cmr_profile(self, cmr_type, cmr_id):
+        """Returns the fully resolved acquisition profile of one camera"""
+        profile = self.cmr_profiles.get('{} #{}'.format(cmr_type, cmr_id), CameraProfile())
+        return profile.resolve(cmr_type)
+
+    def preview_policy(self, cmr_type, cmr_id):
+        """Returns the preview policy of one camera"""
+        return self.cmr_previews.setdefault('{} #{}'.format(cmr_type, cmr_id), PreviewPolicy())
+
+    def tracking_settings(self, cmr_type, cmr_id):
+        """Returns the tracking settings of one camera; behaviour cameras track by default"""
+        key = '{} #{}'.format(cmr_type, cmr_id)
+        if key not in self.tracking:
+            self.tracking[key] = TrackingSettings(enabled=(cmr_type == FIREFLY_CAMERA))
+        return self.tracking[key]
+
+    def set_cmr_roi(self, cmr_type, cmr_id, roi):
+        """Stores a new ROI for one camera, or None for the full frame. Returns the resolved profile"""
+        self.cmr_profiles.setdefault('{} #{}'.format(cmr_type, cmr_id), CameraProfile()).roi = roi
+        return self.cmr_profile(cmr_type, cmr_id)
+
+    def save_ard_preset(self, name):
+        """Saves the current arduino settings as a preset, with overlapping and adjacent segments merged
+        Raises ValueError if any segments conflict"""
+        preset = copy.deepcopy(self.last_ard)
+        preset.configs = SegmentModel(preset.configs).configs
+        self.ard_presets[name] = preset
 
     @property
     def ttl_time(self):
@@ -42,6 +92,7 @@ class MainSettings(object):
         self.last_ard.load_blank()
         self.last_lj.load_blank()
         self.last_fp.load_example()
+        self.health.load_default()
         # Preconfigured Presets
         self.ard_presets = {'example': ArdSettings().load_example()}
         self.ljk_presets = {'example': LjkSettings().load_example()}
@@ -98,6 +149,133 @@ class LjkSettings(object):
         return self
 
 
+class SensorSpec(object):
+    """Hardware limits of one camera type"""
+    def __init__(self, width, height, pixel_rate, binnings=(1,), frame_rates=None, roi_align=None):
+        self.width = width
+        self.height = height
+        self.pixel_rate = pixel_rate  # max sensor readout, pixels/s
+        self.binnings = binnings
+        self.frame_rates = frame_rates  # None if any frame rate may be set, else the discrete rates allowed
+        self.roi_align = roi_align  # None if ROI must be cropped in software, else the on-sensor ROI increment
+
+
+# FireFly MV: fixed 640x480 Y8 video mode at discrete frame rates
+# Mini Microscope: Ximea MU9, 2592x1944 at 5.7fps full frame
+CMR_SENSORS = {
+    FIREFLY_CAMERA: SensorSpec(width=640, height=480, pixel_rate=640 * 480 * 60, frame_rates=(15, 30, 60)),
+    MINIMIC_CAMERA: SensorSpec(width=2592, height=1944, pixel_rate=2592 * 1944 * 5.7, binnings=(1, 2, 4),
+                               roi_align=4)
+}
+
+
+class CameraProfile(DefaultsOnUnpickle):
+    """Acquisition parameters of one camera; parameters left as None are chosen from the sensor's limits"""
+    def __init__(self, fps=30, min_width=None, min_height=None, binning=None, exposure_us=None, roi=None):
+        self.fps = fps
+        self.min_width = min_width  # lowest acceptable output resolution
+        self.min_height = min_height
+        self.binning = binning
+        self.exposure_us = exposure_us
+        self.roi = roi  # (x, y, width, height) in binned sensor pixels, or None for the full frame
+        # Output size and whether the sensor crops the ROI itself, set once resolved
+        self.width = None
+        self.height = None
+        self.roi_on_sensor = False
+
+    def resolve(self, cmr_type):
+        """Returns a copy with every parameter set to a value the camera type supports"""
+        sensor = CMR_SENSORS[cmr_type]
+        profile = CameraProfile(self.fps, self.min_width, self.min_height, self.binning, self.exposure_us, self.roi)
+        # Snap to the nearest supported frame rate at or above the one requested
+        if sensor.frame_rates:
+            faster = [rate for rate in sensor.frame_rates if rate >= profile.fps]
+            profile.fps = min(faster) if faster else max(sensor.frame_rates)
+        if profile.binning not in sensor.binnings:
+            profile.binning = profile.auto_binning(sensor)
+        profile.width = sensor.width // profile.binning
+        profile.height = sensor.height // profile.binning
+        if profile.roi:
+            profile.roi = profile.clamp_roi(sensor.roi_align or 1)
+            profile.roi_on_sensor = sensor.roi_align is not None
+            profile.width, profile.height = profile.roi[2:]
+        # Exposure can never be longer than one frame
+        frame_us = 1e6 / profile.fps
+        profile.exposure_us = min(profile.exposure_us or frame_us, frame_us)
+        return profile
+
+    def clamp_roi(self, align):
+        """ROI aligned to the sensor's increment and kept inside the binned frame"""
+        x, y, width, height = (int(value) // align * align for value in self.roi)
+        x, y = min(max(x, 0), self.width - align), min(max(y, 0), self.height - align)
+        width = max(min(width, (self.width - x) // align * align), align)
+        height = max(min(height, (self.height - y) // align * align), align)
+        return x, y, width, height
+
+    def auto_binning(self, sensor):
+        """Largest binning that still meets the minimum resolution, increased until the sensor sustains fps"""
+        min_width, min_height = self.min_width or sensor.width, self.min_height or sensor.height
+        binnings = sorted(sensor.binnings)
+        meets_resolution = [b for b in binnings if sensor.width // b >= min_width and sensor.height // b >= min_height]
+        binning = max(meets_resolution) if meets_resolution else binnings[0]
+        for faster in binnings[binnings.index(binning):]:
+            binning = faster
+            if (sensor.width // binning) * (sensor.height // binning) * self.fps <= sensor.pixel_rate:
+                break
+        return binning
+
+
+class PreviewPolicy(DefaultsOnUnpickle):
+    """When a camera sends preview frames to its display tile"""
+    def __init__(self, mode=PREVIEW_FULL, fps=10):
+        self.mode = mode
+        self.fps = fps  # used by PREVIEW_FPS
+
+
+# Preview policies offered on each camera tile, in menu order
+PREVIEW_POLICIES = [PreviewPolicy(PREVIEW_FULL), PreviewPolicy(PREVIEW_FPS, fps=10), PreviewPolicy(PREVIEW_FPS, fps=2),
+                    PreviewPolicy(PREVIEW_HOVER), PreviewPolicy(PREVIEW_NOT_RECORDING)]
+
+
+class TrackingSettings(DefaultsOnUnpickle):
+    """Animal tracking parameters of one camera"""
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.threshold = -50  # animal pixels are at least this much darker than the background
+        self.target_area = 550.0  # px; the contour closest to this area is the animal
+        self.open_radius = 4  # px; morphological opening removes specks smaller than this
+        self.bg_frames = 5  # the background starts as the mean of these frames
+        self.bg_model = 'running median'  # or 'exponential mean'; see Tracking.Background
+        self.bg_update_every = 5  # frames between background updates
+        self.bg_step = 0.5  # running median: gray levels moved per update
+        self.bg_alpha = 0.01  # exponential mean: fraction of the difference moved per update
+        self.roi = None  # (x, y, width, height) in frame pixels, or None for the whole frame
+
+
+class ClosedLoopSettings(DefaultsOnUnpickle):
+    """Output pin driven by the Arduino while the tracked animal is inside any of the trigger zones"""
+    def __init__(self):
+        self.enabled = False
+        self.camera = None  # 'type #id' of the camera to follow, or None for the first camera that tracks
+        self.zones = []  # [(x, y, width, height)] in frame pixels
+        self.pin = OUTP_PIN[-1]
+
+
+class HealthSettings(object):
+    """Warning and alarm thresholds of device health counters, per run"""
+    def __init__(self):
+        self.thresholds = {}
+        self.load_default()
+
+    def load_default(self):
+        """Default Config; preview skips are harmless so they never alarm"""
+        self.thresholds = {HLTH_MISSED: (1, 100),
+                           HLTH_DROPPED: (1, 30),
+                           HLTH_SKIPPED: (None, None),
+                           HLTH_BACKLOG: (5, 30),
+                           HLTH_USB_ERR: (1, 1)}
+
+
 class PhotometrySettings(object):
     """Container for Photometry Configs - mainly for Hardware Lock-In and Wave Generator"""
     # todo: consider some coupling between this module and ljkSettings - labjack note which channels for fp?
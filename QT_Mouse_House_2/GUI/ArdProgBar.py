@@ -2,43 +2,160 @@
 
 """Custom Widget for viewing and editing Arduino stimuli"""
 
+import time
+import numpy as np
 from Misc.Names import *
 from Misc.CustomFunctions import format_secs
+from DirsSettings.SegmentModel import SegmentModel
+from Tracking.Tracker import TRK_TIME, TRK_FOUND, records_in_zones
 from GUI.MiscWidgets import *
 
 
-class GuiArdBar(qg.QGraphicsRectItem):
-    """A Rectangle Item with custom implementation for deletable arduino segments"""
-    def __init__(self, x, y, w, h, tooltip, data):
-        super(GuiArdBar, self).__init__(x, y, w, h)
-        self.setBrush(qYellow)
-        self.setPen(qBlue)
-        self.setToolTip(tooltip)
-        self.setFlag(qSelectable, enabled=True)
-        self.data = data
-        self.visual_warning_stage = 0
+# Layout, in pixels; the bar spans BAR_WIDTH, with pin labels to its right
+PROGBAR_SIZE = (1056, 300)
+BAR_WIDTH = 1000
+ROW_HEIGHT = 20
+TONE_ROW_Y = 20
+OUTP_ROW_Y = 40
+PWM_ROW_Y = 160
+BAR_BOTTOM = 260
+TRACK_Y = 262  # tracking lane, under the rows
+TRACK_HEIGHT = 10
+AXIS_Y = 274
+TIME_TEXT_WIDTH = 80
+# Rows top to bottom: (row label, pin)
+PROGBAR_ROWS = [(u'\u266b', TONE_PIN)] + list(zip('SIMPLE', OUTP_PIN)) + list(zip(' PWM ', PWM_PINS))
+# Spacers are placed at the first of these steps (in seconds) that gives at most MAX_SPACERS in view
+SPACER_STEPS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 14400, 28800, 86400)
+MAX_SPACERS = 40
+# The cursor is advanced from a monotonic clock at display rate
+PROGBAR_REFRESH_HZ = 60
+# Zooming stops at this much time in view; shift+wheel pans by a fraction of it
+MIN_VIEW_MS = 1000
+ZOOM_STEP = 1.25
+PAN_STEP = 0.1
+# Rows with more segments in view than fit at this width are drawn as glyphs of the time on in each pixel
+MIN_SEGMENT_PX = 3
+GLYPH_LEVELS = 4
+# Tracking history grows in blocks of records; pixels between records show the last record this recent
+TRACK_HISTORY_BLOCK = 4096
+TRACK_HOLD_MS = 1000
+# Tracking lane states of a pixel, and their colors
+TRK_NONE, TRK_LOST, TRK_SEEN, TRK_IN_ZONE = range(4)
+TRACK_COLORS = {TRK_LOST: qDarkRed, TRK_SEEN: qGrey, TRK_IN_ZONE: qGreen}
 
-    def visual_warning(self, times_to_flash=6):
-        """Deploys a visual warning to indicate error to user"""
-        # First we grab the correct base color depending if object is selected or not
-        base_color = qBlue if self.isSelected() else qYellow
-        # If we've reached the end of the sequence, return to base color and exit
-        if self.visual_warning_stage == times_to_flash:
-            self.setBrush(base_color)
-            self.visual_warning_stage = 0
-            return
-        # Else we change colors depending on stage
-        if self.visual_warning_stage % 2 == 0:
-            self.setBrush(qRed)
-        else:
-            self.setBrush(base_color)
-        # We then increment the stage and run the function again in 150ms
-        self.visual_warning_stage += 1
-        qc.QTimer.singleShot(150, lambda t=times_to_flash: self.visual_warning(t))
+
+def pin_row(pin):
+    """Index of the row a pin is drawn in"""
+    return [row_pin for _, row_pin in PROGBAR_ROWS].index(pin)
+
+
+def segment_tooltip(segment):
+    """Times and stimulus of a segment"""
+    tooltip = '{} - {}\n'.format(format_secs(segment.on_ms / 1000), format_secs(segment.off_ms / 1000))
+    if segment.types == TONE:
+        tooltip += '{} Hz'.format(segment.freq)
+    elif segment.types == OUTP:
+        tooltip += 'Pin {}'.format(segment.pin)
+    elif segment.types == PWM:
+        tooltip += 'Pin {}\nFreq: {}Hz\nDuty Cycle: {}%\nPhase Shift: {}{}' \
+                   ''.format(segment.pin, segment.freq, segment.duty_cycle, segment.phast_shift, u'\u00b0')
+    return tooltip
+
+
+def runs(values):
+    """(start, end, value) of each run of equal values in a 1d array"""
+    change = np.flatnonzero(np.diff(values)) + 1
+    starts = np.concatenate(([0], change))
+    ends = np.concatenate((change, [len(values)]))
+    return zip(starts, ends, values[starts])
+
+
+class RowIndex(object):
+    """Segments of one row as arrays sorted by start time; segments on one pin never overlap,
+    so the segments in a time range and the time on before any time are found by binary search"""
+    def __init__(self, segments):
+        self.segments = list(segments)
+        self.on = np.array([segment.on_ms for segment in self.segments], dtype=np.float64)
+        self.off = np.array([segment.off_ms for segment in self.segments], dtype=np.float64)
+        self.cum_on = np.concatenate(([0.0], np.cumsum(self.off - self.on)))
+
+    def span(self, start_ms, end_ms):
+        """(first, last + 1) indices of the segments overlapping or touching [start_ms, end_ms]"""
+        return int(np.searchsorted(self.off, start_ms, 'left')), int(np.searchsorted(self.on, end_ms, 'right'))
+
+    def on_time_before(self, times):
+        """Total time on before each of times"""
+        if not len(self.segments):
+            return np.zeros(len(times))
+        started = np.searchsorted(self.on, times, 'right')
+        # The last segment started may still be on
+        still_on = np.maximum(self.off[np.maximum(started - 1, 0)] - times, 0)
+        return self.cum_on[started] - np.where(started > 0, still_on, 0)
+
+    def coverage(self, edges):
+        """Fraction of the time on between consecutive edges"""
+        return np.diff(self.on_time_before(edges)) / np.diff(edges)
 
 
-class GuiProgressBar(qg.QGraphicsView):
-    """Main Progress Bar Widget for Monitoring Experiment and Arduino Status"""
+class TrackHistory(object):
+    """Tracking records of one run, in ms since the run started, with running totals
+    so that the records between any two times are counted by binary search"""
+    def __init__(self, track_records, zones):
+        self.track_records = track_records
+        self.zones = zones
+        self.reset(0)
+
+    def reset(self, run_start):
+        """Starts an empty history; records written before now are ignored"""
+        self.run_start = run_start
+        self.last_count = self.track_records.count
+        self.size = 0
+        self.times = np.empty(TRACK_HISTORY_BLOCK)
+        self.cum_found = np.zeros(TRACK_HISTORY_BLOCK + 1)
+        self.cum_zone = np.zeros(TRACK_HISTORY_BLOCK + 1)
+
+    def update(self):
+        """Adds records written since the last update. Returns the (first, last) of their times, or None"""
+        records, self.last_count = self.track_records.read_since(self.last_count)
+        if not len(records):
+            return None
+        end = self.size + len(records)
+        if end > len(self.times):
+            capacity = max(end, 2 * len(self.times))
+            self.times = np.concatenate((self.times[:self.size], np.empty(capacity - self.size)))
+            self.cum_found = np.concatenate((self.cum_found[:self.size + 1], np.zeros(capacity - self.size)))
+            self.cum_zone = np.concatenate((self.cum_zone[:self.size + 1], np.zeros(capacity - self.size)))
+        self.times[self.size:end] = (records[:, TRK_TIME] - self.run_start) * 1000.0
+        self.cum_found[self.size + 1:end + 1] = self.cum_found[self.size] + np.cumsum(records[:, TRK_FOUND] > 0)
+        self.cum_zone[self.size + 1:end + 1] = self.cum_zone[self.size] + np.cumsum(
+            records_in_zones(records, self.zones))
+        self.size = end
+        return self.times[end - len(records)], self.times[end - 1]
+
+    def states(self, edges):
+        """Tracking lane state between consecutive edges, by majority of the records
+        Without records in between, the last record before holds for up to TRACK_HOLD_MS"""
+        index = np.searchsorted(self.times[:self.size], edges)
+        first, last = index[:-1], index[1:]
+        held = (first == last) & (first > 0)
+        held &= edges[:-1] - self.times[np.maximum(first - 1, 0)] <= TRACK_HOLD_MS
+        first = np.where(held, first - 1, first)
+        counts = last - first
+        found = self.cum_found[last] - self.cum_found[first]
+        in_zone = self.cum_zone[last] - self.cum_zone[first]
+        states = np.where(found * 2 >= counts, TRK_SEEN, TRK_LOST)
+        states[in_zone * 2 >= np.maximum(counts, 1)] = TRK_IN_ZONE
+        states[counts == 0] = TRK_NONE
+        return states
+
+
+class GuiProgressBar(qg.QWidget):
+    """Main Progress Bar Widget for Monitoring Experiment and Arduino Status
+    Painted from a cached pixmap of the background and the segments in view; only the cursor is repainted as it runs
+    Rows too dense to draw every segment are drawn per pixel, so painting costs at most one rect per pixel and row
+    The mouse wheel zooms in on the time under the mouse, shift+wheel or dragging with the right button pans,
+    and double clicking shows the whole experiment. The view pages forward with the cursor during a run"""
     # Since we'll only have one instance of GuiProgressBar running, it's okay to make this signal a class variable
     # pyqtSignal for some reason does not work as an instance variable
     new_highlight_signal = qc.pyqtSignal(object, name='HighlightChangedSignal')
@@ -48,272 +165,393 @@ class GuiProgressBar(qg.QGraphicsView):
         super(GuiProgressBar, self).__init__()
         self.dirs = dirs
         self.parent = parent
-        self.exp_start_time = qc.QTime()
+        self.segments = SegmentModel()
+        self.rows = []
+        # Selection and visual warnings
+        self.selectable = True
+        self.selected = []
+        self.warned = []
+        self.visual_warning_stage = 0
+        # Time in view, in ms
+        self.view_start = 0
+        self.view_end = 0
+        self.drag_origin = None
+        # Live tracking of one camera, and the closed loop output row it drives
+        self.track = None
+        self.track_states = np.zeros(BAR_WIDTH, dtype=np.int8)
+        self.closed_loop_row = None
+        # Cached layers
+        self.static_bg = None
+        self.background = None
+        # Cursor
+        self.run_start = None
+        self.cursor_ms = 0
+        self.cursor_timer = qc.QTimer(self)
+        self.cursor_timer.timeout.connect(self.advance_cursor)
         self.initialize()
 
     def initialize(self):
         """Sets up all required objects and containers"""
-        self.init_scene()
-        self.init_static_bg()
-        self.init_dynamic_bg()
-        self.init_anim_gfx_objects()
+        self.load_segments()
         self.set_progbar_scene()
-        self.setScene(self.scene)
-        self.setRenderHint(qg.QPainter.Antialiasing)
-        self.setMinimumSize(1056, 288)
-        self.setMaximumSize(1056, 288)
+        self.setAttribute(qc.Qt.WA_OpaquePaintEvent)
+        self.setFocusPolicy(qc.Qt.StrongFocus)
+        self.setFixedSize(*PROGBAR_SIZE)
+
+    # -- Time and Pixel Conversions -- #
+    def x_of(self, time_ms):
+        """Pixel position of a time"""
+        return (time_ms - self.view_start) * float(BAR_WIDTH) / (self.view_end - self.view_start)
+
+    def ms_of(self, x):
+        """Time at a pixel position"""
+        return self.view_start + x * float(self.view_end - self.view_start) / BAR_WIDTH
+
+    def pixel_edges(self, first=0, last=BAR_WIDTH):
+        """Times at the edges of pixels first to last"""
+        return self.ms_of(np.arange(first, last + 1, dtype=np.float64))
+
+    def segment_at(self, pos):
+        """Segment under a point, or None; segments narrower than a pixel can still be picked"""
+        row = int(pos.y() - TONE_ROW_Y) // ROW_HEIGHT
+        if pos.x() >= BAR_WIDTH or pos.y() < TONE_ROW_Y or row >= len(PROGBAR_ROWS):
+            return None
+        time_ms = self.ms_of(pos.x())
+        tolerance = self.ms_of(1) - self.view_start
+        found = self.segments.overlapping(PROGBAR_ROWS[row][1], time_ms - tolerance, time_ms + tolerance)
+        return min(found, key=lambda segment: abs((segment.on_ms + segment.off_ms) / 2.0 - time_ms)) \
+            if found else None
 
     # -- User Manipulatable Objects -- #
-    @property
-    def ard_stim_bars(self):
-        """Returns a list of arduino stimulation prog bar segments currently on scene"""
-        return (item for item in self.scene.items() if isinstance(item, GuiArdBar))
-
-    def init_scene(self):
-        """Sets up the Prog Bar Scene object"""
-        def highlight_selected():
-            """Highlights a selected ard_segment within the prog bar scene"""
-            # Reset any previous highlights
-            for item in self.ard_stim_bars:
-                item.setBrush(qYellow)
-            # Highlight any currently selected items
-            selected = self.scene.selectedItems()
-            for item in selected:
-                item.setBrush(qBlue)
-            # If we selected exactly 1 bar, we can emit a signal with the bar's attributes to other widgets
-            if len(selected) == 1:
-                self.new_highlight_signal.emit(selected[0].data)
-            # If we selected any other number of bars, we need to reset the signal
+    def set_selection(self, segments):
+        """Selects segments; emits the selected segment if exactly one is selected, else None"""
+        if segments == self.selected:
+            return
+        self.selected = segments
+        self.invalidate()
+        self.new_highlight_signal.emit(segments[0] if len(segments) == 1 else None)
+
+    def mousePressEvent(self, event):
+        """Selects the segment clicked; control click adds or removes it from the selection
+        The right button starts panning"""
+        if event.button() == qc.Qt.RightButton:
+            self.drag_origin = (event.pos().x(), self.view_start)
+            return
+        if not self.selectable or event.button() != qc.Qt.LeftButton:
+            return
+        segment = self.segment_at(event.pos())
+        if event.modifiers() & qMod_cntrl:
+            if segment in self.selected:
+                self.set_selection([other for other in self.selected if other is not segment])
+            elif segment:
+                self.set_selection(self.selected + [segment])
+        else:
+            self.set_selection([segment] if segment else [])
+
+    def mouseMoveEvent(self, event):
+        """Pans while the right button is held"""
+        if self.drag_origin is not None:
+            x_pos, view_start = self.drag_origin
+            span = self.view_end - self.view_start
+            view_start -= (event.pos().x() - x_pos) * float(span) / BAR_WIDTH
+            self.set_view(view_start, view_start + span)
+
+    def mouseReleaseEvent(self, event):
+        """Stops panning"""
+        if event.button() == qc.Qt.RightButton:
+            self.drag_origin = None
+
+    def mouseDoubleClickEvent(self, event):
+        """Shows the whole experiment"""
+        self.set_view(0, self.dirs.settings.ttl_time)
+
+    def wheelEvent(self, event):
+        """Zooms in or out on the time under the mouse; pans with shift held"""
+        if event.pos().x() >= BAR_WIDTH:
+            return
+        if event.modifiers() & qMod_shift:
+            shift = (self.view_end - self.view_start) * PAN_STEP * (-1 if event.delta() > 0 else 1)
+            self.set_view(self.view_start + shift, self.view_end + shift)
+            return
+        time_ms = self.ms_of(event.pos().x())
+        scale = 1 / ZOOM_STEP if event.delta() > 0 else ZOOM_STEP
+        self.set_view(time_ms - (time_ms - self.view_start) * scale, time_ms + (self.view_end - time_ms) * scale)
+
+    def event(self, event):
+        """Shows the tooltip of the segment under the mouse"""
+        if event.type() == qc.QEvent.ToolTip:
+            segment = self.segment_at(event.pos())
+            if segment:
+                qg.QToolTip.showText(event.globalPos(), segment_tooltip(segment))
             else:
-                self.new_highlight_signal.emit(None)
-        self.scene = qg.QGraphicsScene(self)
-        self.scene.selectionChanged.connect(highlight_selected)
+                qg.QToolTip.hideText()
+            return True
+        return super(GuiProgressBar, self).event(event)
 
     def keyPressEvent(self, event):
         """Defines some keyboard commands for the progbar GUI"""
         # Delete or Backspace buttons will delete a selected progbar segment
-        def delete_selection():
-            """Checks if the selected items can be deleted, and deletes them"""
-            configs = self.dirs.settings.last_ard.configs
-            # We will visually remove an item from the GUI, ONLY IF we can remove its associated data first
-            for item in self.scene.selectedItems():
-                if item.data in configs:
-                    configs.remove(item.data)  # Removes backend data associated with GUI object
-            # We then use the updated configs to completely reset the progbar and its elements
+        if event.key() in (qKey_del, qKey_backspace) and self.selectable:
+            for segment in self.selected:
+                self.segments.remove(segment)  # Removes backend data associated with GUI object
+            self.dirs.settings.last_ard.configs = self.segments.configs
+            # We then use the updated configs to completely reset the progbar
             # This way, we ensure that what we show on the GUI is 100% representative of backend configurations
             self.set_progbar_scene()
-        if event.key() in (qKey_del, qKey_backspace):
-            delete_selection()
 
     def set_ard_bars_selectable(self, selectable):
         """Changes whether user is able to interact with arduino bars or not
         @selectable: boolean"""
-        for bar in self.ard_stim_bars:
-            bar.setFlag(qSelectable, enabled=selectable)
+        self.selectable = selectable
+        if not selectable:
+            self.set_selection([])
 
     def reset_selection(self):
         """Resets all selected objects to be unselected"""
-        self.set_ard_bars_selectable(selectable=False)
-        self.set_ard_bars_selectable(selectable=True)
-
-    # -- Static Background -- #
-    def init_static_bg(self):
-        """Sets up the static backdrop"""
-        group = GuiSimpleGroup()
-        # Main background Shapes
-        group.add(qg.QGraphicsRectItem(0, 0, 1052, 284), brush=qBlack)
-        group.add(qg.QGraphicsLineItem(0, 20, 1052, 20), pen=qWhite)
-        group.add(qg.QGraphicsLineItem(0, 40, 1052, 40), pen=qWhite)
-        group.add(qg.QGraphicsLineItem(0, 160, 1052, 160), pen=qWhite)
-        group.add(qg.QGraphicsLineItem(0, 260, 1052, 260), pen=qWhite)
-        # Row Label - Backdrops
-        group.add(qg.QGraphicsRectItem(1000, 20, 15, 20), brush=qWhite)
-        group.add(qg.QGraphicsRectItem(1000, 40, 15, 120), brush=qWhite)
-        group.add(qg.QGraphicsRectItem(1000, 160, 15, 100), brush=qWhite)
-        # Row Label - Names
-        group.add(qg.QGraphicsTextItem(u'\u266b'), pos_x=997, pos_y=13)
-        group.add(qg.QGraphicsTextItem('S'), pos_x=999, pos_y=41)
-        group.add(qg.QGraphicsTextItem('I'), pos_x=1002, pos_y=61)
-        group.add(qg.QGraphicsTextItem('M'), pos_x=998, pos_y=81)
-        group.add(qg.QGraphicsTextItem('P'), pos_x=999, pos_y=101)
-        group.add(qg.QGraphicsTextItem('L'), pos_x=1000, pos_y=121)
-        group.add(qg.QGraphicsTextItem('E'), pos_x=999, pos_y=141)
-        group.add(qg.QGraphicsTextItem('P'), pos_x=999, pos_y=181)
-        group.add(qg.QGraphicsTextItem('W'), pos_x=997, pos_y=201)
-        group.add(qg.QGraphicsTextItem('M'), pos_x=998, pos_y=221)
-        # Arduino Label - Pins
-        group.add(qg.QGraphicsTextItem('PIN #'), color=qWhite, pos_x=1011, pos_y=1)
-        group.add(qg.QGraphicsTextItem('10'), color=qWhite, pos_x=1021, pos_y=21)
-        group.add(qg.QGraphicsTextItem('02'), color=qWhite, pos_x=1021, pos_y=41)
-        group.add(qg.QGraphicsTextItem('03'), color=qWhite, pos_x=1021, pos_y=61)
-        group.add(qg.QGraphicsTextItem('04'), color=qWhite, pos_x=1021, pos_y=81)
-        group.add(qg.QGraphicsTextItem('05'), color=qWhite, pos_x=1021, pos_y=101)
-        group.add(qg.QGraphicsTextItem('06'), color=qWhite, pos_x=1021, pos_y=121)
-        group.add(qg.QGraphicsTextItem('07'), color=qWhite, pos_x=1021, pos_y=141)
-        group.add(qg.QGraphicsTextItem('08'), color=qWhite, pos_x=1021, pos_y=161)
-        group.add(qg.QGraphicsTextItem('09'), color=qWhite, pos_x=1021, pos_y=181)
-        group.add(qg.QGraphicsTextItem('11'), color=qWhite, pos_x=1021, pos_y=201)
-        group.add(qg.QGraphicsTextItem('12'), color=qWhite, pos_x=1021, pos_y=221)
-        group.add(qg.QGraphicsTextItem('13'), color=qWhite, pos_x=1021, pos_y=241)
-        # Add Background to Progress Bar Scene
-        self.scene.addItem(group)
-
-    # -- Dynamic Background -- #
-    def init_dynamic_bg(self):
-        """Sets up dynamic background objects"""
-        self.vertical_spacers = GuiSimpleGroup()
-        self.time_stamps = GuiSimpleGroup()
-        self.dynamic_bg_groups = [self.vertical_spacers, self.time_stamps]
-        for group in self.dynamic_bg_groups:
-            self.scene.addItem(group)
-
-    def set_dynamic_bg(self):
-        """Renders dynamic background objects based on arduino settings"""
-        ms_time = self.dirs.settings.ttl_time
-        gap_size = 5 + 5 * int(ms_time / 300000)  # Factors into size of gaps between vertical spacers
-        num_spacers = float(ms_time / 1000) / gap_size  # Number of vertical spacers
-        raw_pos = 1000.0 / num_spacers  # Position of 1st spacer and real inter-spacer gap size
-        # Generating Spacers
-        # General Spacer Y1 and Y2 Params
-        tiny_line = (260, 265)  # e.g. Line of length 5, y1=260, y2=265
-        short_line = (20, 260)
-        long_line = (20, 265)
-        for i in range(int(round(num_spacers))):  # for each spacer i
-            i += 1  # such that i is in [1, ..., num_spacers] instead of [0, ..., num_spacers - 1]
-            # Reset Line Params and time stamp
-            line_params = None
-            time_stamp = None
-            # -- Creation Rules -- #
-            odd_spacer = (i % 2 != 0)
-            even_spacer = (i % 2 == 0)
-            final_spacer = (i == int(round(num_spacers)))
-            undershoot = (i * raw_pos < 1000)
-            at_end_of_bar = (i * raw_pos == 1000)
-            # Get specific object parameters
-            if odd_spacer:
-                time_stamp = False
-                if (not final_spacer) or (final_spacer and undershoot):
-                    line_params = short_line
-                elif final_spacer and at_end_of_bar:
-                    line_params = tiny_line
-            elif even_spacer:
-                time_stamp = True
-                if (not final_spacer) or (final_spacer and undershoot):
-                    line_params = long_line
-                elif final_spacer and at_end_of_bar:
-                    line_params = tiny_line
-            # Generate Dynamic Background based on creation params
-            if line_params:
-                vertical_spacer = qg.QGraphicsLineItem(i * raw_pos, line_params[0], i * raw_pos, line_params[1])
-                self.vertical_spacers.add(vertical_spacer, pen=qWhite)
-                if time_stamp:
-                    time_text = qg.QGraphicsTextItem(format_secs(gap_size * i))
-                    self.time_stamps.add(time_text, pos_x=(i * raw_pos - 20), pos_y=262, color=qWhite)
+        self.set_selection([])
+
+    def visual_warning(self, segments=None, times_to_flash=6):
+        """Flashes segments red to indicate error to user"""
+        if segments is not None:
+            self.warned = segments
+            self.visual_warning_stage = 0
+        # If we've reached the end of the sequence, return to base color and exit
+        if self.visual_warning_stage == times_to_flash:
+            self.warned = []
+            self.visual_warning_stage = 0
+            self.invalidate()
+            return
+        # We then increment the stage and run the function again in 150ms
+        self.visual_warning_stage += 1
+        self.invalidate()
+        qc.QTimer.singleShot(150, lambda t=times_to_flash: self.visual_warning(times_to_flash=t))
 
     # Interactable Arduino Stim Segments
-    def set_ard_bars(self):
-        """Creates visual indicators on progress bar for arduino stimuli"""
-        ms_time = self.dirs.settings.ttl_time
-        configs = self.dirs.settings.last_ard.configs
-        def ard_bar(cfg, ms):
-            """Reads one set of arduino instructions and generates a visual segment for progbar"""
-            # Dimensions
-            start_pt = (float(cfg.on_ms) / ms) * 1000.0
-            on_duration = (float(cfg.off_ms) / ms) * 1000.0 - start_pt
-            # Time Tooltips
-            tltp_start_time = format_secs(cfg.on_ms / 1000)
-            tltp_off_time = format_secs(cfg.off_ms / 1000)
-            tooltip = '{} - {}\n'.format(tltp_start_time, tltp_off_time)
-            # Type specific tooltips
-            if cfg.types == TONE:
-                y_pos = 20
-                tooltip += '{} Hz'.format(cfg.freq)
-            elif cfg.types == OUTP:
-                y_pos = 40 + (OUTP_PIN.index(cfg.pin)) * 20
-                tooltip += 'Pin {}'.format(cfg.pin)
-            elif cfg.types == PWM:
-                y_pos = 160 + (PWM_PINS.index(cfg.pin)) * 20
-                tooltip += 'Pin {}\nFreq: {}Hz\nDuty Cycle: {}%\nPhase Shift: {}{}' \
-                           ''.format(cfg.pin, cfg.freq, cfg.duty_cycle, cfg.phase_shift, u'\u00b0')
-            return GuiArdBar(x=start_pt, y=y_pos, w=on_duration, h=20, tooltip=tooltip, data=cfg)
-        # Generate Bars
-        for config in configs:
-            self.scene.addItem(ard_bar(cfg=config, ms=ms_time))
-
-    # Animation Objects, Timers, Functions
-    def init_anim_gfx_objects(self):
-        """Sets up animated progress bar and timer text"""
-        self.time_gfx = GuiTextWithAnim('00:00.000', qWhite, z_stack=1)
-        self.bar_gfx = GuiLineWithAnim((0, 22, 0, 258), qRed, z_stack=1)
-        self.scene.addItem(self.time_gfx)
-        self.scene.addItem(self.bar_gfx)
-
-    def set_timers_and_anims(self):
-        """Sets duration and frames of progress bar animation"""
-        self.duration = self.dirs.settings.ttl_time
-        # Set up timers and animation objects
-        self.time_gfx.reset_timers_anims(self.duration)
-        self.bar_gfx.reset_timers_anims(self.duration)
-        # Create animation frames
-        self.bar_gfx.timer.frameChanged[int].connect(self.advance_frame)
-        for i in range(1000):
-            self.time_gfx.anim.setPosAt(i / 1000.0, qc.QPointF(i, 0))
-            self.bar_gfx.anim.setPosAt(i / 1000.0, qc.QPointF(i, 0))
-
-    def advance_frame(self):
-        """Advances one frame of the animation each time the bar_gfx.timer increments"""
-        # Update time
-        ms_elapsed = self.exp_start_time.elapsed() / 1000.0
-        ms_elapsed = format_secs(ms_elapsed, option='with_ms')
-        self.time_gfx.setPlainText(ms_elapsed)
-        # Make sure Progress Bar booleans are set correctly
-        if not self.bar_gfx.running:  # Bar runs entire duration, text does not. use bar as running marker.
-            self.bar_gfx.running = True
-        if abs(self.bar_gfx.timer.currentFrame()) >= self.duration * 1000:
-            self.bar_gfx.running = False
-        # Animate by 1 frame
-        if not self.time_gfx.running \
-            and abs(self.bar_gfx.timer.currentFrame()) > self.duration * 31 \
-                and not abs(self.bar_gfx.timer.currentFrame()) >= self.duration * 934:
-            self.time_gfx.running = True
-            self.time_gfx.timer.start()
-        if abs(self.time_gfx.timer.currentFrame()) >= self.duration * 940:
-            self.time_gfx.running = False
-            self.time_gfx.timer.stop()
-
-    def reset_progbar_scene(self):
-        """Clears dynamic bg items and any remaining progbar segments"""
-        # For non-selectable items, we can just clear out the groups they belong to
-        for group in self.dynamic_bg_groups:
-            for item in group.childItems():
-                group.removeFromGroup(item)
-        # Selectable items have individual identifiers, so we need to remove them one by one
-        for item in self.ard_stim_bars:
-            self.scene.removeItem(item)
+    def load_segments(self):
+        """Rebuilds the segment model from the arduino configs; conflicting segments are dropped"""
+        self.segments = SegmentModel()
+        refused = self.segments.load(self.dirs.settings.last_ard.configs)
+        self.dirs.settings.last_ard.configs = self.segments.configs
+        if refused:
+            GuiMessage(self, msg='{} Arduino segment(s) conflicted with others and were removed.'.format(len(refused)))
+
+    def add_segment(self, segment):
+        """Adds a segment, merged with any adjacent one of the same stimulus. Returns False if it conflicts,
+        after flashing the segments it conflicts with"""
+        try:
+            self.segments.add(segment)
+        except ValueError as error:
+            self.visual_warning(self.segments.conflicts(segment))
+            GuiMessage(self, msg=str(error))
+            return False
+        self.dirs.settings.last_ard.configs = self.segments.configs
+        self.set_progbar_scene()
+        return True
+
+    # -- Painting -- #
+    def set_view(self, view_start, view_end):
+        """Shows the time between view_start and view_end, kept within the experiment"""
+        ttl_time = self.dirs.settings.ttl_time
+        span = min(max(view_end - view_start, MIN_VIEW_MS), max(ttl_time, 1))
+        view_start = min(max(view_start, 0), ttl_time - span)
+        self.view_start, self.view_end = view_start, view_start + span
+        if self.track:
+            self.track_states = self.track.states(self.pixel_edges())
+        self.invalidate()
+
+    def invalidate(self):
+        """Repaints the background and segments on the next paint"""
+        self.background = None
+        self.update()
+
+    def render_static_bg(self):
+        """The backdrop and row labels, which never change"""
+        pixmap = qg.QPixmap(*PROGBAR_SIZE)
+        painter = qg.QPainter(pixmap)
+        painter.fillRect(pixmap.rect(), qBlack)
+        painter.setPen(qWhite)
+        for y_pos in (TONE_ROW_Y, OUTP_ROW_Y, PWM_ROW_Y, BAR_BOTTOM, AXIS_Y):
+            painter.drawLine(0, y_pos, PROGBAR_SIZE[0], y_pos)
+        # Row Label - Backdrops
+        painter.fillRect(BAR_WIDTH, TONE_ROW_Y, 15, BAR_BOTTOM - TONE_ROW_Y, qWhite)
+        painter.drawText(qc.QRect(BAR_WIDTH, 0, PROGBAR_SIZE[0] - BAR_WIDTH, ROW_HEIGHT), qAlignCenter, 'PIN #')
+        # Row Label - Names and Pins
+        for row, (label, pin) in enumerate(PROGBAR_ROWS):
+            y_pos = TONE_ROW_Y + row * ROW_HEIGHT
+            painter.setPen(qBlack)
+            painter.drawText(qc.QRect(BAR_WIDTH, y_pos, 15, ROW_HEIGHT), qAlignCenter, label)
+            painter.setPen(qWhite)
+            painter.drawText(qc.QRect(BAR_WIDTH + 15, y_pos, 37, ROW_HEIGHT), qAlignCenter, '{:0>2}'.format(pin))
+        painter.drawText(qc.QRect(BAR_WIDTH, BAR_BOTTOM, PROGBAR_SIZE[0] - BAR_WIDTH, AXIS_Y - BAR_BOTTOM),
+                         qAlignCenter, 'TRACK')
+        painter.end()
+        return pixmap
+
+    def render_background(self):
+        """The static backdrop, time spacers and the segments in view"""
+        if self.static_bg is None:
+            self.static_bg = self.render_static_bg()
+        pixmap = qg.QPixmap(self.static_bg)
+        painter = qg.QPainter(pixmap)
+        painter.setClipRect(0, 0, BAR_WIDTH, PROGBAR_SIZE[1])
+        self.paint_spacers(painter)
+        self.paint_segments(painter)
+        painter.end()
+        return pixmap
+
+    def paint_spacers(self, painter):
+        """Vertical spacers, with every other one time stamped"""
+        span_secs = (self.view_end - self.view_start) / 1000.0
+        step = next((step for step in SPACER_STEPS if span_secs / step <= MAX_SPACERS), SPACER_STEPS[-1])
+        option = 'with_ms' if step < 1 else 'norm'
+        painter.setPen(qWhite)
+        index = int(self.view_start / 1000.0 / step) + 1
+        while index * step * 1000 <= self.view_end:
+            x_pos = int(round(self.x_of(index * step * 1000)))
+            if x_pos >= BAR_WIDTH:
+                painter.drawLine(BAR_WIDTH - 1, AXIS_Y, BAR_WIDTH - 1, AXIS_Y + 5)
+            elif index % 2:
+                painter.drawLine(x_pos, TONE_ROW_Y, x_pos, BAR_BOTTOM)
+            else:
+                painter.drawLine(x_pos, TONE_ROW_Y, x_pos, AXIS_Y + 5)
+                painter.drawText(qc.QRect(x_pos - 40, AXIS_Y + 5, 80, 20), qAlignCenter,
+                                 format_secs(index * step, option=option))
+            index += 1
+
+    def paint_segments(self, painter):
+        """Segments in view, or glyphs where a row is too dense; selected segments are blue, flashing warnings red"""
+        edges = None
+        painter.setPen(qBlue)
+        painter.setBrush(qYellow)
+        for row, index in enumerate(self.rows):
+            first, last = index.span(self.view_start, self.view_end)
+            if (last - first) * MIN_SEGMENT_PX <= BAR_WIDTH:
+                for segment in index.segments[first:last]:
+                    self.paint_segment(painter, segment, row)
+            else:
+                edges = self.pixel_edges() if edges is None else edges
+                self.paint_glyphs(painter, index.coverage(edges), row)
+        # Selected and flashing segments are drawn on their own, over any glyphs
+        painter.setBrush(qBlue)
+        for segment in self.selected:
+            self.paint_segment(painter, segment, pin_row(segment.pin))
+        if self.visual_warning_stage % 2 == 1:
+            painter.setBrush(qRed)
+            for segment in self.warned:
+                self.paint_segment(painter, segment, pin_row(segment.pin))
+
+    def paint_segment(self, painter, segment, row):
+        """One segment, with the painter's brush"""
+        x_pos = self.x_of(segment.on_ms)
+        painter.drawRect(qc.QRectF(x_pos, TONE_ROW_Y + row * ROW_HEIGHT, self.x_of(segment.off_ms) - x_pos, ROW_HEIGHT))
+
+    def paint_glyphs(self, painter, coverage, row):
+        """A row from the fraction of each pixel it is on: pixels fully on are drawn like segments,
+        partly on pixels as glyphs as tall as the time on; equal neighbours are drawn as one rect"""
+        y_pos = TONE_ROW_Y + row * ROW_HEIGHT
+        levels = np.ceil(np.round(coverage, 6) * GLYPH_LEVELS).astype(int)
+        for start, end, level in runs(levels):
+            if level >= GLYPH_LEVELS:
+                painter.fillRect(int(start), y_pos, int(end - start), ROW_HEIGHT, qYellow)
+            elif level > 0:
+                height = ROW_HEIGHT * level // GLYPH_LEVELS
+                painter.fillRect(int(start), y_pos + ROW_HEIGHT - height, int(end - start), height, qOrange)
+
+    def paint_track(self, painter):
+        """Tracking lane, and the closed loop output row while the animal is in a trigger zone"""
+        for start, end, state in runs(self.track_states):
+            if state == TRK_NONE:
+                continue
+            painter.fillRect(int(start), TRACK_Y, int(end - start), TRACK_HEIGHT, TRACK_COLORS[state])
+            if state == TRK_IN_ZONE and self.closed_loop_row is not None:
+                painter.fillRect(int(start), TONE_ROW_Y + (self.closed_loop_row + 1) * ROW_HEIGHT - 5,
+                                 int(end - start), 4, qGreen)
+
+    def time_text_rect(self, time_ms):
+        """Area of the time shown above the cursor; it stays within the bar"""
+        text_x = min(max(int(self.x_of(time_ms)) - TIME_TEXT_WIDTH // 2, 0), BAR_WIDTH - TIME_TEXT_WIDTH)
+        return qc.QRect(text_x, 0, TIME_TEXT_WIDTH, ROW_HEIGHT)
+
+    def cursor_rect(self, time_ms):
+        """Area painted by the cursor and its time"""
+        line = qc.QRect(int(self.x_of(time_ms)) - 1, TONE_ROW_Y, 3, BAR_BOTTOM - TONE_ROW_Y)
+        return line.united(self.time_text_rect(time_ms))
+
+    def paintEvent(self, event):
+        """Draws the cached background, then the cursor over it"""
+        if self.background is None:
+            self.background = self.render_background()
+        painter = qg.QPainter(self)
+        painter.drawPixmap(event.rect(), self.background, event.rect())
+        if self.track:
+            self.paint_track(painter)
+        if self.run_start is not None and self.view_start <= self.cursor_ms <= self.view_end:
+            x_pos = int(self.x_of(self.cursor_ms))
+            painter.setPen(qRed)
+            painter.drawLine(x_pos, TONE_ROW_Y + 2, x_pos, BAR_BOTTOM - 2)
+            painter.setPen(qWhite)
+            painter.drawText(self.time_text_rect(self.cursor_ms), qAlignCenter,
+                             format_secs(self.cursor_ms / 1000.0, option='with_ms'))
+        painter.end()
 
     def set_progbar_scene(self):
-        """Sets the background objects, arduino segments, and animations using arduino configs"""
+        """Sets the total time, time in view and segments using arduino configs"""
         # First we check if we need to update the total time depending on new ard_bars added
         ttl_time = max([self.dirs.settings.ttl_time]
                        + [cfg.off_ms for cfg in self.dirs.settings.last_ard.configs])
         self.dirs.settings.ttl_time = ttl_time
         self.ttl_time_updated_signal.emit()  # We let other widgets know that we have updated total time
-        # Then we set the scene
-        self.reset_progbar_scene()
-        self.set_dynamic_bg()
-        self.set_ard_bars()
-        self.set_timers_and_anims()
+        # Segments that were merged or deleted are no longer selected
+        configs = set(id(segment) for segment in self.segments.configs)
+        self.set_selection([segment for segment in self.selected if id(segment) in configs])
+        self.rows = [RowIndex(self.segments.trees[pin] if pin in self.segments.trees else [])
+                     for _, pin in PROGBAR_ROWS]
+        self.set_view(0, ttl_time)
+
+    def follow_tracking(self, track_records, closed_loop):
+        """Shows the tracking records of one camera live, and the closed loop trigger zones they enter"""
+        self.track = TrackHistory(track_records, closed_loop.zones)
+        self.closed_loop_row = pin_row(closed_loop.pin) if closed_loop.enabled else None
+
+    # -- Cursor -- #
+    def advance_cursor(self):
+        """Moves the cursor to the time elapsed, repainting only where it was and where it is"""
+        elapsed_ms = (time.perf_counter() - self.run_start) * 1000.0
+        if elapsed_ms >= self.dirs.settings.ttl_time:
+            elapsed_ms = self.dirs.settings.ttl_time
+            self.cursor_timer.stop()
+        # A view following the cursor turns to the next page when the cursor reaches its end
+        if self.view_start <= self.cursor_ms <= self.view_end < elapsed_ms:
+            self.cursor_ms = elapsed_ms
+            self.set_view(elapsed_ms, elapsed_ms + self.view_end - self.view_start)
+        else:
+            self.update(self.cursor_rect(self.cursor_ms).united(self.cursor_rect(elapsed_ms)))
+            self.cursor_ms = elapsed_ms
+        if self.track:
+            self.update_track()
+
+    def update_track(self):
+        """Adds new tracking records to the pixels they fall in"""
+        new = self.track.update()
+        if new is None:
+            return
+        first = min(max(int(self.x_of(new[0])) - 1, 0), BAR_WIDTH)
+        last = min(max(int(self.x_of(new[1])) + 2, 0), BAR_WIDTH)
+        if first < last:
+            self.track_states[first:last] = self.track.states(self.pixel_edges(first, last))
+            self.update(first, TONE_ROW_Y, last - first, TRACK_Y + TRACK_HEIGHT - TONE_ROW_Y)
 
     # On/Off Operations
     def start(self):
         """Starts Progress Bar"""
-        self.time_gfx.setPos(0, 0)
-        self.bar_gfx.timer.start()
-        self.exp_start_time.start()
+        self.run_start = time.perf_counter()
+        self.cursor_ms = 0
+        if self.track:
+            self.track.reset(self.run_start)
+            self.track_states[:] = TRK_NONE
+        self.cursor_timer.start(1000 // PROGBAR_REFRESH_HZ)
+        self.update()
 
     def stop(self):
         """Stops Progress Bar"""
-        self.time_gfx.timer.stop()
-        self.bar_gfx.timer.stop()
-        self.bar_gfx.running = False
-        self.time_gfx.running = False
+        self.cursor_timer.stop()
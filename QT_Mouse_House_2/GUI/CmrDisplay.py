@@ -9,37 +9,173 @@ import numpy as np
 from Misc.Names import *
 import multiprocessing as mp
 from Concurrency.CameraProcs import CameraHandler
+from Concurrency.Channels import GUI, PROC_HANDLER, CAMERA_PROC, CHANNEL_DROPS
+from Misc.Profiling import ProcessStats
+from Misc.Health import DeviceHealth
+from Tracking.Tracker import TrackingBuffer
+from Tracking.TrackingPool import FrameSlot, TrackedCamera, TrackingPool
+from DirsSettings.Settings import CMR_SENSORS, PREVIEW_POLICIES, PreviewPolicy
+from Misc.CustomFunctions import fit_size
+from Misc.CustomClasses import NewMessage
 from Misc.Names import FIREFLY_CAMERA, MINIMIC_CAMERA
 import pyximea as xi
 import flycapture2a as fc
 from GUI.MiscWidgets import qw
 import PyQt4.QtGui as qg
 import PyQt4.QtCore as qc
+import PyQt4.QtOpenGL as qgl
 
 
-# Size of one camera stream display
+# Size of the shared buffer of one camera stream; streams are scaled to fit, keeping their aspect ratio
 CMR_IMG_SIZE = (240, 320)
+# Tiles are checked for new frames once per display refresh; Qt paints all scheduled tiles in one pass
+DISPLAY_REFRESH_HZ = 60
+
+
+class TileMixin(object):
+    """Paints a camera stream straight from its shared memory QImage, with no per frame pixmap conversion
+    An ROI can be drawn by dragging, and reset to full frame by right clicking"""
+    def setup_tile(self, stats):
+        """Initializes tile state; called by the Qt class' constructor"""
+        self.stats = stats
+        self.image = None
+        self.error_text = ''
+        self.sync_event = None
+        self.painting_frame = False  # a new frame was scheduled for painting; released to the camera once painted
+        self.rubber_band = qg.QRubberBand(qg.QRubberBand.Rectangle, self)
+        self.origin = None
+        # We paint every pixel ourselves
+        self.setAttribute(qc.Qt.WA_OpaquePaintEvent)
+
+    def set_image(self, image, sync_event):
+        """Sets the shared memory QImage to paint; the tile is sized to it"""
+        self.image = image
+        self.sync_event = sync_event
+        self.setFixedSize(image.width(), image.height())
+        self.update()
+
+    def show_error(self, text):
+        """Replaces the stream with a message"""
+        self.error_text = text
+        self.update()
+
+    def schedule_frame(self):
+        """Requests a repaint for a new frame; Qt merges repaints of all tiles into one pass per refresh"""
+        if not self.painting_frame:
+            self.painting_frame = True
+            self.update()
+
+    def paintEvent(self, event):
+        """Draws the image, then lets the camera write its next frame"""
+        with self.stats.timer('paint'):
+            painter = qg.QPainter(self)
+            if self.error_text or self.image is None:
+                painter.fillRect(self.rect(), qWhite)
+                painter.drawText(self.rect(), qAlignCenter, self.error_text)
+            else:
+                painter.drawImage(event.rect(), self.image, event.rect())
+            painter.end()
+        if self.painting_frame:
+            self.painting_frame = False
+            self.sync_event.clear()
+
+    def mousePressEvent(self, event):
+        """Starts drawing an ROI, or resets it"""
+        if event.button() == qc.Qt.RightButton:
+            self.roi_drawn_signal.emit(None)
+        elif event.button() == qc.Qt.LeftButton:
+            self.origin = event.pos()
+            self.rubber_band.setGeometry(qc.QRect(self.origin, qc.QSize()))
+            self.rubber_band.show()
+
+    def mouseMoveEvent(self, event):
+        """Resizes the ROI being drawn"""
+        if self.origin is not None:
+            self.rubber_band.setGeometry(qc.QRect(self.origin, event.pos()).normalized())
+
+    def mouseReleaseEvent(self, event):
+        """Finishes drawing an ROI"""
+        if self.origin is not None and event.button() == qc.Qt.LeftButton:
+            self.rubber_band.hide()
+            rect = qc.QRect(self.origin, event.pos()).normalized()
+            self.origin = None
+            # Ignore clicks that did not drag out an area
+            if rect.width() > 2 and rect.height() > 2:
+                self.roi_drawn_signal.emit(rect)
+
+
+class CameraTile(TileMixin, qg.QWidget):
+    """Camera stream painted by the raster engine"""
+    roi_drawn_signal = qc.pyqtSignal(object, name='RoiDrawnSignal')
+
+    def __init__(self, stats, parent=None):
+        super(CameraTile, self).__init__(parent)
+        self.setup_tile(stats)
+
+
+class GLCameraTile(TileMixin, qgl.QGLWidget):
+    """Camera stream uploaded as an OpenGL texture; buffer swaps wait for vertical sync"""
+    roi_drawn_signal = qc.pyqtSignal(object, name='RoiDrawnSignal')
+
+    def __init__(self, stats, parent=None):
+        gl_format = qgl.QGLFormat()
+        gl_format.setSwapInterval(1)
+        super(GLCameraTile, self).__init__(gl_format, parent)
+        self.setAutoFillBackground(False)
+        self.setup_tile(stats)
+
+
+def create_tile(stats, use_gl):
+    """OpenGL tile if requested and available, else a raster tile"""
+    if use_gl and qgl.QGLFormat.hasOpenGL():
+        return GLCameraTile(stats)
+    return CameraTile(stats)
 
 
 class SingleCameraWidget(qw):
     """A single qPixMap that streams video feed from a single connected camera process"""
-    def __init__(self, dirs, stream_index, cmr_type, cmr_id):
+    def __init__(self, dirs, stream_index, cmr_type, cmr_id, display_stats, topology):
         super(SingleCameraWidget, self).__init__()
         self.dirs = dirs
         self.stream_index = stream_index
         self.type = cmr_type
         self.id = cmr_id
+        # Acquisition profile; frame counts, video fps and the displayed region all derive from it
+        self.profile = self.dirs.settings.cmr_profile(cmr_type, cmr_id)
+        self.img_size = fit_size(self.profile.width, self.profile.height, CMR_IMG_SIZE)
         # Image Data Holders
         self.array = None
         self.image = None
-        self.label = None
+        self.tile = None
+        self.display_stats = display_stats
         self.proc = None
         # Sync with camera process
         self.sync_event = mp.Event()
         self.sync_event.clear()
-        self.cmr_pipe_main, self.cmr_pipe_end = mp.Pipe()
+        self.cmr_pipe_main, self.cmr_pipe_end = topology.pipe(CAMERA_PROC.format(stream_index))
+        self.cmr_channel = topology.channel(CAMERA_PROC.format(stream_index), PROC_HANDLER)
+        self.exp_start_event = topology.exp_start_event
+        # Commands to proc_handler; every GUI widget shares this channel, all from the GUI thread
+        self.proc_handler_queue = topology.channel(GUI, PROC_HANDLER)
+        # Instrumentation of the camera process
+        self.stats = ProcessStats(name='cmr #{} [{} {}]'.format(stream_index, cmr_type, cmr_id),
+                                  stages=('get_frames', 'acquire', 'submit_frames', 'publish_frame'),
+                                  gauges=('frame_buffer',), counters=('loop', 'frames', CHANNEL_DROPS))
+        topology.instrument(CAMERA_PROC.format(stream_index), self.stats)
+        self.health = DeviceHealth(name='{} #{}'.format(cmr_type, cmr_id))
+        # Animal tracking; the camera publishes frames to frame_slot, the tracking pool publishes track_records
+        self.tracking = self.dirs.settings.tracking_settings(cmr_type, cmr_id)
+        self.track_records = TrackingBuffer()
+        sensor = CMR_SENSORS[cmr_type]
+        self.frame_slot = FrameSlot((sensor.height, sensor.width)) if self.tracking.enabled else None
+        self.track_stats = ProcessStats(name='track #{} [{} {}]'.format(stream_index, cmr_type, cmr_id),
+                                        stages=('track',), counters=('tracked', 'skipped'))
+        # Preview policy, and whether the GUI currently wants frames; written here, read by the camera process
+        self.preview = self.dirs.settings.preview_policy(cmr_type, cmr_id)
+        self.preview_demand = mp.RawValue('b', 1)
         # Initialize
         self.create_data_container()
+        self.create_preview_menu()
         self.create_process()
 
     def create_data_container(self):
@@ -48,35 +184,91 @@ class SingleCameraWidget(qw):
         # mpArray can be sent between processes; npArray is a readable format
         m_array = mp.Array('I', int(np.prod(CMR_IMG_SIZE)), lock=mp.Lock())
         self.array = (m_array, np.frombuffer(m_array.get_obj(), dtype='I').reshape(CMR_IMG_SIZE))
-        # self.image containes image data; self.label displays it
+        # self.image containes image data; self.tile paints it
+        self.tile = create_tile(self.display_stats, use_gl=self.dirs.settings.gl_preview)
+        self.tile.roi_drawn_signal.connect(self.set_roi)
+        self.create_image()
+
+    def create_preview_menu(self):
+        """Drop down of preview policies"""
+        self.preview_menu = qg.QComboBox()
+        for policy in PREVIEW_POLICIES:
+            label = '{} ({})'.format(policy.mode, policy.fps) if policy.mode == PREVIEW_FPS else policy.mode
+            self.preview_menu.addItem(label)
+        choices = [(policy.mode, policy.fps) for policy in PREVIEW_POLICIES]
+        current = (self.preview.mode, self.preview.fps)
+        self.preview_menu.setCurrentIndex(choices.index(current) if current in choices else 0)
+        self.preview_menu.currentIndexChanged.connect(self.set_preview)
+
+    def create_image(self):
+        """Image over the top left img_size region of the shared buffer"""
         n_array = self.array[1]
-        self.image = qg.QImage(n_array.data, n_array.shape[1], n_array.shape[0], qg.QImage.Format_RGB32)
-        self.label = qg.QLabel(self)
+        self.image = qg.QImage(n_array.data, self.img_size[1], self.img_size[0], n_array.strides[0],
+                               qg.QImage.Format_RGB32)
+        self.tile.set_image(self.image, self.sync_event)
 
     def create_process(self):
         """Generates a connected camera process"""
         self.proc = CameraHandler(self.dirs, self.stream_index, self.array[0], CMR_IMG_SIZE, self.sync_event,
-                                  self.cmr_pipe_end, self.type, self.id)
+                                  self.cmr_pipe_end, self.cmr_channel, self.exp_start_event, self.type, self.id,
+                                  self.profile, self.stats, self.health, self.tracking, self.track_records,
+                                  self.frame_slot, self.preview, self.preview_demand)
         self.proc.name = 'cmr_stream_proc_#{} - [type {} id {}]'.format(self.stream_index, self.type,
                                                                         self.id)
 
+    def set_roi(self, rect):
+        """Converts a rect drawn on the display to sensor pixels and sends it to the camera; None resets the ROI"""
+        if self.exp_start_event.is_set():
+            return  # ROI cannot change while recording
+        if rect is None:
+            roi = None
+        else:
+            # The drawn rect is relative to the region currently displayed
+            scale = float(self.profile.width) / self.img_size[1]
+            offset_x, offset_y = self.profile.roi[:2] if self.profile.roi else (0, 0)
+            roi = (offset_x + int(rect.x() * scale), offset_y + int(rect.y() * scale),
+                   int(rect.width() * scale), int(rect.height() * scale))
+        self.profile = self.dirs.settings.set_cmr_roi(self.type, self.id, roi)
+        self.img_size = fit_size(self.profile.width, self.profile.height, CMR_IMG_SIZE)
+        self.create_image()
+        msg = NewMessage(dev=CAMERAS, cmd=CMD_SET_ROI, val=(self.stream_index, self.profile))
+        self.proc_handler_queue.put_nowait(msg)
+
+    def set_preview(self, index):
+        """Sends the preview policy chosen from the menu to the camera"""
+        policy = PREVIEW_POLICIES[index]
+        self.preview = self.dirs.settings.cmr_previews['{} #{}'.format(self.type, self.id)] = \
+            PreviewPolicy(policy.mode, policy.fps)
+        msg = NewMessage(dev=CAMERAS, cmd=CMD_SET_PREVIEW, val=(self.stream_index, self.preview))
+        self.proc_handler_queue.put_nowait(msg)
+
+    def update_demand(self):
+        """Tells the camera whether preview frames are wanted: the tile must be visible, and hovered if required"""
+        visible = self.tile.isVisible() and not self.tile.window().isMinimized()
+        demand = visible and (self.preview.mode != PREVIEW_HOVER or self.tile.underMouse())
+        if demand != bool(self.preview_demand.value):
+            self.preview_demand.value = demand
+
     def update_display(self):
-        """Updates the image pixel map label"""
+        """Schedules a repaint if the camera wrote a new frame"""
+        self.update_demand()
         if self.sync_event.is_set():
-            self.label.setPixmap(qg.QPixmap.fromImage(self.image))
-            self.sync_event.clear()
+            self.tile.schedule_frame()
 
 
 class CameraDisplay(qw):
     """Creates a variable array of SingleCameraWidget to display any number of camera streams"""
-    def __init__(self, dirs):
+    def __init__(self, dirs, topology):
         super(CameraDisplay, self).__init__()
         self.dirs = dirs
+        self.topology = topology
         # Display Configs
         self.num_cmrs = 0
+        self.stats = ProcessStats(name='gui cameras', stages=('refresh_frames', 'paint'))
         # GUI Organization
         self.cameras = {}
         self.groupboxes = {}
+        self.tracking_pool = None
         # Setup Displays
         self.setMinimumWidth(366)
         self.initialize()
@@ -91,6 +283,8 @@ class CameraDisplay(qw):
 
     def cleanup(self):
         """Terminate any old processes"""
+        if self.tracking_pool:
+            self.tracking_pool.stop()
         if len(self.cameras) > 0:
             for _, camera in self.cameras.items():
                 camera.proc.stop()
@@ -138,7 +332,8 @@ class CameraDisplay(qw):
         self.num_cmrs = len(cameras)
         # Create Cameras
         for stream_index, (cmr_type, cmr_id) in enumerate(cameras):
-            self.cameras[stream_index] = SingleCameraWidget(self.dirs, stream_index, cmr_type, cmr_id)
+            self.cameras[stream_index] = SingleCameraWidget(self.dirs, stream_index, cmr_type, cmr_id, self.stats,
+                                                          self.topology)
 
     def setup_groupboxes(self):
         """Creates individually labelled boxes for each camera"""
@@ -155,28 +350,44 @@ class CameraDisplay(qw):
                 self.groupboxes[stream_index].setTitle('No Camera Available')
             else:
                 grid = qg.QGridLayout()
-                grid.addWidget(camera.label)
+                grid.addWidget(camera.tile, 0, 0)
+                grid.addWidget(camera.preview_menu, 1, 0)
                 self.groupboxes[stream_index].setTitle('{} - {} #{}'.format(stream_index, camera.type, camera.id))
                 self.groupboxes[stream_index].setLayout(grid)
             self.grid.addWidget(self.groupboxes[stream_index], row, col)
 
     def start_cmr_procs(self):
-        """Starts camera processses"""
+        """Starts camera processses, and the tracking pool shared by the tracked cameras"""
         [camera.proc.start() for _, camera in self.cameras.items()]
+        closed_loop_camera = self.closed_loop_camera()
+        tracked = [TrackedCamera(camera.tracking, camera.frame_slot, camera.track_records, camera.track_stats,
+                                 priority=(camera is closed_loop_camera))
+                   for _, camera in sorted(self.cameras.items()) if camera.frame_slot]
+        self.tracking_pool = TrackingPool(tracked, num_cameras=self.num_cmrs)
+        self.tracking_pool.start()
+
+    def closed_loop_camera(self):
+        """The tracked camera closed loop follows, or None if closed loop is off or has no camera to follow"""
+        closed_loop = self.dirs.settings.closed_loop
+        if not closed_loop.enabled:
+            return None
+        for _, camera in sorted(self.cameras.items()):
+            if camera.frame_slot and closed_loop.camera in (None, '{} #{}'.format(camera.type, camera.id)):
+                return camera
+        return None
 
     def display_error_notif(self, stream_index):
         """Shows an error if the camera at stream_index is unresponsive"""
-        self.cameras[stream_index].label.setText('Camera Closed due to API Error')
-        self.cameras[stream_index].label.setAlignment(qAlignCenter)
-        self.cameras[stream_index].label.setFrameStyle(qStyleSunken | qStylePanel)
+        self.cameras[stream_index].tile.show_error('Camera Closed due to API Error')
 
     def set_update_timer(self):
         """Creates a timer that periodically updates camera streams"""
         update_timer = qc.QTimer(self)
         update_timer.timeout.connect(self.refresh_camera_frames)
-        update_timer.start(5)
+        update_timer.start(1000 // DISPLAY_REFRESH_HZ)
 
     def refresh_camera_frames(self):
         """Get a new frame from camera"""
-        for _, camera in self.cameras.items():
-            camera.update_display()
+        with self.stats.timer('refresh_frames'):
+            for _, camera in self.cameras.items():
+                camera.update_display()
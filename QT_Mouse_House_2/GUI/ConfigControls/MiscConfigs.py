@@ -12,10 +12,10 @@ from Concurrency.MainHandler import NewMessage
 
 class StartStopBtns(qw):
     """Buttons with associated signals/slots, and entry field"""
-    def __init__(self, dirs):
+    def __init__(self, dirs, proc_handler_queue):
         super(StartStopBtns, self).__init__()
         self.dirs = dirs
-        self.proc_handler_queue = PROC_HANDLER_QUEUE
+        self.proc_handler_queue = proc_handler_queue
         # Setup
         self.setMinimumWidth(200)
         self.setMaximumWidth(200)
@@ -71,6 +71,9 @@ class StartStopBtns(qw):
             self.dirs.create_date_stamped_dir()
             msg = NewMessage(cmd=CMD_SET_DIRS, val=self.dirs.date_stamped_dir)
             self.proc_handler_queue.put_nowait(msg)
+        # The Arduino plays back the outputs as currently configured
+        msg = NewMessage(cmd=CMD_SET_ARD, val=self.dirs.settings.last_ard)
+        self.proc_handler_queue.put_nowait(msg)
         # Send Start Signal to ProcHandler
         msg = NewMessage(cmd=CMD_START, val=name)
         self.proc_handler_queue.put_nowait(msg)
@@ -85,10 +88,10 @@ class TimeConfig(qw):
     """Entries and Buttons for setting total experiment time"""
     set_time_signal = qc.pyqtSignal(name="SetTimeSignal")
 
-    def __init__(self, dirs):
+    def __init__(self, dirs, proc_handler_queue):
         super(TimeConfig, self).__init__()
         self.dirs = dirs
-        self.proc_handler_queue = PROC_HANDLER_QUEUE
+        self.proc_handler_queue = proc_handler_queue
         self.init_entries()
         self.grid.addWidget(self.time_entry_frame)
 
@@ -0,0 +1,42 @@
+# coding=utf-8
+
+"""Live display of hot path latencies, rates and queue depths of every process"""
+
+import PyQt4.QtCore as qc
+import PyQt4.QtGui as qg
+from Misc.Names import *
+from GUI.MiscWidgets import qw
+
+
+# Refresh interval of the panel, ms
+DIAGNOSTICS_REFRESH = 500
+
+
+class DiagnosticsPanel(qw):
+    """Read-only table of the instrumentation summary aggregated by proc_handler"""
+    def __init__(self, stats_summary):
+        super(DiagnosticsPanel, self).__init__()
+        self.stats_summary = stats_summary
+        # Monospaced text so that columns line up
+        self.text = qg.QPlainTextEdit()
+        self.text.setReadOnly(True)
+        self.text.setLineWrapMode(qg.QPlainTextEdit.NoWrap)
+        font = qg.QFont('Courier New')
+        font.setStyleHint(qg.QFont.TypeWriter)
+        self.text.setFont(font)
+        self.groupbox = qg.QGroupBox('Diagnostics')
+        grid = qg.QGridLayout()
+        grid.addWidget(self.text)
+        self.groupbox.setLayout(grid)
+        self.grid.addWidget(self.groupbox)
+        self.set_update_timer()
+
+    def set_update_timer(self):
+        """Creates a timer that periodically refreshes the table"""
+        update_timer = qc.QTimer(self)
+        update_timer.timeout.connect(self.refresh)
+        update_timer.start(DIAGNOSTICS_REFRESH)
+
+    def refresh(self):
+        """Redraws the table from the shared summary"""
+        self.text.setPlainText('\n'.join(self.stats_summary.table()))
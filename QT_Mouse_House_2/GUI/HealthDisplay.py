@@ -0,0 +1,70 @@
+# coding=utf-8
+
+"""Live status badges of device health, with an alarm when thresholds are crossed"""
+
+import PyQt4.QtCore as qc
+import PyQt4.QtGui as qg
+from Misc.Names import *
+from Misc.Health import HEALTH_OK, HEALTH_WARN, HEALTH_ALARM, HEALTH_STALLED
+from GUI.MiscWidgets import qw, ql
+
+
+# Refresh interval of the badges, ms
+HEALTH_REFRESH = 250
+# Badge colour of each status
+HEALTH_STYLES = {HEALTH_OK: qBgGreen, HEALTH_WARN: qBgOrange, HEALTH_ALARM: qBgRed, HEALTH_STALLED: qBgRed}
+
+
+class HealthBadges(qw):
+    """One status badge per device; emits alarm_signal once per run when any device crosses its alarm threshold"""
+    alarm_signal = qc.pyqtSignal(str, name='HealthAlarmSignal')
+
+    def __init__(self, dirs, devices):
+        super(HealthBadges, self).__init__()
+        self.dirs = dirs
+        self.devices = devices
+        self.badges = []
+        self.alarm_tripped = False
+        self.monitoring = False
+        self.initialize()
+        self.set_update_timer()
+
+    def initialize(self):
+        """Creates a labelled badge for each device"""
+        groupbox = qg.QGroupBox('Device Health')
+        grid = qg.QGridLayout()
+        for row, device in enumerate(self.devices):
+            badge = ql('', align=qAlignCenter, style=qStyleSunken | qStylePanel)
+            grid.addWidget(ql(device.name), row, 0)
+            grid.addWidget(badge, row, 1)
+            self.badges.append(badge)
+        if not self.devices:
+            grid.addWidget(ql('No Devices Available'), 0, 0)
+        groupbox.setLayout(grid)
+        self.grid.addWidget(groupbox)
+
+    def set_update_timer(self):
+        """Creates a timer that periodically refreshes the badges"""
+        update_timer = qc.QTimer(self)
+        update_timer.timeout.connect(self.refresh)
+        update_timer.start(HEALTH_REFRESH)
+
+    def set_monitoring(self, monitoring):
+        """Alarms are only raised while an experiment is running; each run can trip the alarm once"""
+        self.monitoring = monitoring
+        if monitoring:
+            self.alarm_tripped = False
+
+    def refresh(self):
+        """Updates badges from shared health counters"""
+        alarms = []
+        thresholds = self.dirs.settings.health.thresholds
+        for device, badge in zip(self.devices, self.badges):
+            status, description = device.status(thresholds)
+            badge.setText(description)
+            badge.setStyleSheet(HEALTH_STYLES[status])
+            if status in (HEALTH_ALARM, HEALTH_STALLED):
+                alarms.append('{} - {}'.format(device.name, description))
+        if alarms and self.monitoring and not self.alarm_tripped:
+            self.alarm_tripped = True
+            self.alarm_signal.emit('\n'.join(alarms))
@@ -172,40 +172,3 @@ class GuiMessage(qg.QMessageBox):
         self.setStandardButtons(btns)
         self.exec_()
 
-
-# Custom Animation Objects
-class GuiObjectWithAnim(object):
-    """Object with Qt Animation Properties"""
-    def __init__(self, parent_obj):
-        self.parent_obj = parent_obj
-        # Animation Boolean
-        self.running = False
-
-    def reset_timers_anims(self, duration):
-        """Resets timers and animations with new durations"""
-        # Timer
-        self.timer = qc.QTimeLine(duration)
-        self.timer.setCurveShape(qc.QTimeLine.LinearCurve)
-        self.timer.setFrameRange(0, duration * 1000)
-        # Animation Object
-        self.anim = qg.QGraphicsItemAnimation()
-        self.anim.setItem(self.parent_obj)
-        self.anim.setTimeLine(self.timer)
-
-
-class GuiTextWithAnim(qg.QGraphicsTextItem, GuiObjectWithAnim):
-    """Qt Text Object with Animation Properties"""
-    def __init__(self, text, color, z_stack):
-        qg.QGraphicsTextItem.__init__(self, text)
-        GuiObjectWithAnim.__init__(self, parent_obj=self)
-        self.setDefaultTextColor(color)
-        self.setZValue(z_stack)
-
-
-class GuiLineWithAnim(qg.QGraphicsLineItem, GuiObjectWithAnim):
-    """Qt Line Object with Animation Properties"""
-    def __init__(self, dimensions, color, z_stack):
-        qg.QGraphicsLineItem.__init__(self, *dimensions)  # @dimensions: x, y, w, h
-        GuiObjectWithAnim.__init__(self, parent_obj=self)
-        self.setPen(color)
-        self.setZValue(z_stack)
@@ -10,11 +10,18 @@ import multiprocessing as mp
 import PyQt4.QtCore as qc
 import PyQt4.QtGui as qg
 from Concurrency.MainHandler import ProcessHandler
+from Concurrency.PostProcessing import PostProcessHandler
+from Concurrency.ArduinoProcs import ArduinoHandler
+from Concurrency.Channels import Topology, GUI, PROC_HANDLER, POST_PROC, ARDUINO_PROC, CHANNEL_DROPS
 from Misc.CustomClasses import ReadMessage, NewMessage
 from GUI.MiscWidgets import qw, GuiMessage
 from GUI.CmrDisplay import CameraDisplay
 from GUI.ArdProgBar import GuiProgressBar
+from GUI.Diagnostics import DiagnosticsPanel
+from GUI.HealthDisplay import HealthBadges
+from Misc.Profiling import ProcessStats, StatsSummary
 from DirsSettings.Directories import Directories
+from DirsSettings.ResourceBudget import camera_cost_model
 if sys.version[0] == '2':
     import Queue as Queue
 else:
@@ -28,13 +35,25 @@ class MasterGui(qw):
         self.dirs = dirs
         # Main Window Configs
         self.setWindowTitle('Mouse House')
+        # Instrumentation
+        self.stats = ProcessStats(name='gui', stages=('check_messages',), counters=(CHANNEL_DROPS,))
+        self.proc_handler_stats = ProcessStats(name='proc_handler', stages=('loop',), counters=(CHANNEL_DROPS,))
+        self.ard_stats = ProcessStats(name='closed loop', stages=('frame_to_write', 'frame_to_ack'),
+                                      counters=('triggers', 'late_triggers', CHANNEL_DROPS))
+        # Every channel, pipe and event between processes; the GUI's own channels are declared first
+        self.topology = Topology()
+        self.topology.instrument(GUI, self.stats)
+        self.topology.instrument(PROC_HANDLER, self.proc_handler_stats)
+        self.topology.instrument(ARDUINO_PROC, self.ard_stats)
+        self.proc_handler_queue = self.topology.channel(GUI, PROC_HANDLER)
+        self.topology.channel(PROC_HANDLER, GUI)
+        self.topology.channel(POST_PROC, GUI)
+        self.master_dump_queue = self.topology.inbox(GUI)
         # Layout
         self.render_widgets()
         self.set_window_size()
         # Concurrency
         self.create_message_parser()
-        self.proc_handler_queue = PROC_HANDLER_QUEUE
-        self.master_dump_queue = MASTER_DUMP_QUEUE
         self.set_update_timer()
         self.setup_proc_handler()
         # Experiment running?
@@ -68,12 +87,26 @@ class MasterGui(qw):
         """Render the interactable GUI objects in our main window"""
         # Create Widget Objects
         self.progbar = GuiProgressBar(dirs=self.dirs, parent=self)
-        self.camera_display = CameraDisplay(dirs=self.dirs)
+        self.camera_display = CameraDisplay(dirs=self.dirs, topology=self.topology)
         self.controls = None
+        cameras = [cmr for _, cmr in sorted(self.camera_display.cameras.items())]
+        self.stats_summary = StatsSummary([self.stats, self.camera_display.stats, self.proc_handler_stats,
+                                           self.ard_stats] + [cmr.stats for cmr in cameras] +
+                                          [cmr.track_stats for cmr in cameras if cmr.frame_slot])
+        self.diagnostics = DiagnosticsPanel(stats_summary=self.stats_summary)
+        self.health_badges = HealthBadges(dirs=self.dirs, devices=[cmr.health for cmr in cameras])
+        # The progress bar follows the closed loop camera, else the first tracked camera
+        tracked = [self.camera_display.closed_loop_camera()] + [cmr for cmr in cameras if cmr.frame_slot]
+        if any(tracked):
+            self.progbar.follow_tracking(next(cmr for cmr in tracked if cmr).track_records,
+                                         self.dirs.settings.closed_loop)
         # Add Widgets to Grid
         self.grid.addWidget(self.progbar, 0, 1)
+        self.grid.addWidget(self.diagnostics, 1, 1)
+        self.grid.addWidget(self.health_badges, 2, 1)
         self.grid.addWidget(self.camera_display, 0, 0, 4, 1)
         # Connect Widget Signals to Slots
+        self.health_badges.alarm_signal.connect(self.health_alarm)
         # todo: remove comment
         #self.connect_signals()
 
@@ -103,7 +136,25 @@ class MasterGui(qw):
     def setup_proc_handler(self):
         """Pass necessary objects to generate a ProcessHandler instance"""
         cmr_pipe_mains = [cmr.cmr_pipe_main for _, cmr in self.camera_display.cameras.items()]
-        self.proc_handler = ProcessHandler(cmr_pipe_mains)
+        cmr_models = [camera_cost_model(cmr.type, cmr.profile) for _, cmr in self.camera_display.cameras.items()]
+        # Post processing runs on its own (non-daemonic) process; proc_handler sends it finished runs
+        topology = self.topology
+        post_proc_queue = topology.channel(PROC_HANDLER, POST_PROC)
+        self.post_proc_handler = PostProcessHandler(post_proc_queue, topology.channel(POST_PROC, GUI),
+                                                    topology.exp_start_event)
+        self.post_proc_handler.start()
+        # The Arduino handler follows the tracking records of one camera if closed loop is enabled
+        ard_pipe_main, ard_pipe_end = topology.pipe(ARDUINO_PROC)
+        cmr = self.camera_display.closed_loop_camera()
+        self.ard_handler = ArduinoHandler(self.dirs, ard_pipe_end, topology.channel(ARDUINO_PROC, PROC_HANDLER),
+                                          topology.exp_start_event, self.ard_stats,
+                                          track_records=cmr.track_records if cmr else None,
+                                          frame_period=1.0 / cmr.profile.fps if cmr else None)
+        self.ard_handler.start()
+        # Every producer into proc_handler is declared by now, so its inbox is complete
+        self.proc_handler = ProcessHandler(self.dirs, topology.inbox(PROC_HANDLER), topology.channel(PROC_HANDLER, GUI),
+                                           post_proc_queue, topology.exp_start_event, cmr_pipe_mains, cmr_models,
+                                           ard_pipe_main, self.proc_handler_stats, self.stats_summary)
         self.proc_handler.start()
 
     def set_update_timer(self):
@@ -118,18 +169,20 @@ class MasterGui(qw):
             MSG_STARTED: lambda dev, val: self.cfg_widgets_started(exp_running=True),
             MSG_FINISHED: lambda dev, val: self.cfg_widgets_started(exp_running=False),
             MSG_ERROR: lambda dev, val: self.process_error_msg(dev=dev, val=val),
+            MSG_WARNING: lambda dev, val: GuiMessage(self, msg=val),
             CMD_EXIT: lambda dev, val: self.exit_program()
         }
 
     def check_messages(self):
         """Periodically checks queue for messages"""
-        try:
-            msg = self.master_dump_queue.get_nowait()
-        except Queue.Empty:
-            pass
-        else:
-            msg = ReadMessage(msg)
-            self.process_queue_message(msg)
+        with self.stats.timer('check_messages'):
+            try:
+                msg = self.master_dump_queue.get_nowait()
+            except Queue.Empty:
+                pass
+            else:
+                msg = ReadMessage(msg)
+                self.process_queue_message(msg)
 
     def process_queue_message(self, msg):
         """Processes Queued message and performs instructions"""
@@ -143,6 +196,16 @@ class MasterGui(qw):
         else:
             self.progbar.stop()
         self.progbar.set_ard_bars_selectable(selectable=(not exp_running))
+        self.health_badges.set_monitoring(monitoring=exp_running)
+
+    def health_alarm(self, description):
+        """A device crossed its alarm threshold during a run; the operator may abort"""
+        if not self.exp_running:
+            return
+        msg = 'Device health alarm:\n\n{}\n\nAbort the experiment?'.format(description)
+        abort = qg.QMessageBox.warning(self, 'Health Alarm', msg, qBtnNo | qBtnYes, qBtnNo)
+        if abort == qBtnYes and self.exp_running:
+            self.proc_handler_queue.put_nowait(NewMessage(cmd=CMD_STOP))
 
     def process_error_msg(self, dev, val):
         """Processes the message MSG_ERROR, depending on associated device"""
@@ -156,6 +219,7 @@ class MasterGui(qw):
     def exit_program(self):
         """Attempt to close child processes before fully exiting program"""
         self.ready_to_exit = True
+        self.camera_display.tracking_pool.stop()
         self.close()
 
     def closeEvent(self, event):
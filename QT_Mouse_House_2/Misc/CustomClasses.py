@@ -2,7 +2,20 @@
 
 """Usefl reimplementations of many classes"""
 
+import struct
+import pickle
 import multiprocessing as mp
+from Misc.Names import ARDUINO, CAMERAS
+
+
+# Packaged Messages; opcodes are the CMD_ and MSG_ names, devices are sent as their index in MSG_DEVICES
+MSG_HEADER = struct.Struct('<BBB')  # opcode, device, payload kind
+MSG_DEVICES = (None, ARDUINO, CAMERAS)
+# Payload kinds; anything that is not a plain value (tuples, settings objects) is pickled
+PAYLOAD_NONE, PAYLOAD_BOOL, PAYLOAD_INT, PAYLOAD_FLOAT, PAYLOAD_TEXT, PAYLOAD_OBJECT = range(6)
+PAYLOAD_BOOL_FMT = struct.Struct('<?')
+PAYLOAD_INT_FMT = struct.Struct('<q')
+PAYLOAD_FLOAT_FMT = struct.Struct('<d')
 
 
 class HHMMSS(object):
@@ -26,6 +39,19 @@ class HHMMSS(object):
             self.ss = (secs - self.hh * 3600 - self.mm * 60)
 
 
+class SharedViews(object):
+    """Base of objects passed to other processes with views into shared memory, cached in the attributes
+    named by _cached_views; the views are dropped when pickled and rebuilt on first use by the receiving side"""
+    _cached_views = ('_view',)
+
+    def __getstate__(self):
+        """Numpy views would be pickled as copies, and memoryviews cannot be pickled at all"""
+        state = self.__dict__.copy()
+        for name in self._cached_views:
+            state[name] = None
+        return state
+
+
 class StoppableProcess(mp.Process):
     """Multiprocessing Process with stop() method"""
     def __init__(self):
@@ -45,6 +71,8 @@ class StoppableProcess(mp.Process):
 
 class ProcessMessage(object):
     """A Message Container"""
+    __slots__ = ('device', 'command', 'value')
+
     def __init__(self, device, command, value):
         self.device = device
         self.command = command
@@ -52,11 +80,36 @@ class ProcessMessage(object):
 
 
 def NewMessage(dev=None, cmd=None, val=None):
-    """Returns a Packaged ProcessMessage Tuple"""
-    msg = ProcessMessage(device=dev, command=cmd, value=val)
-    return msg.device, msg.command, msg.value
+    """Returns a Packaged Message: header of opcode, device and payload kind, followed by the payload"""
+    if val is None:
+        kind, payload = PAYLOAD_NONE, b''
+    elif isinstance(val, bool):
+        kind, payload = PAYLOAD_BOOL, PAYLOAD_BOOL_FMT.pack(val)
+    elif isinstance(val, int):
+        kind, payload = PAYLOAD_INT, PAYLOAD_INT_FMT.pack(val)
+    elif isinstance(val, float):
+        kind, payload = PAYLOAD_FLOAT, PAYLOAD_FLOAT_FMT.pack(val)
+    elif isinstance(val, str):
+        kind, payload = PAYLOAD_TEXT, val.encode('utf-8')
+    else:
+        kind, payload = PAYLOAD_OBJECT, pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+    return MSG_HEADER.pack(cmd or 0, MSG_DEVICES.index(dev), kind) + payload
 
 
-def ReadMessage(process_message_tuple):
-    """Converts a packaged ProcessMessage tuple into a ProcessMessage object"""
-    return ProcessMessage(*process_message_tuple)
+def ReadMessage(packaged_message):
+    """Converts a Packaged Message into a ProcessMessage object"""
+    cmd, dev, kind = MSG_HEADER.unpack_from(packaged_message)
+    payload = packaged_message[MSG_HEADER.size:]
+    if kind == PAYLOAD_NONE:
+        val = None
+    elif kind == PAYLOAD_BOOL:
+        val = PAYLOAD_BOOL_FMT.unpack(payload)[0]
+    elif kind == PAYLOAD_INT:
+        val = PAYLOAD_INT_FMT.unpack(payload)[0]
+    elif kind == PAYLOAD_FLOAT:
+        val = PAYLOAD_FLOAT_FMT.unpack(payload)[0]
+    elif kind == PAYLOAD_TEXT:
+        val = bytes(payload).decode('utf-8')
+    else:
+        val = pickle.loads(payload)
+    return ProcessMessage(MSG_DEVICES[dev], cmd or None, val)
@@ -51,3 +51,9 @@ def format_secs(time_in_secs, option='norm'):
         output = '{:0>2}'.format(s)
     # Finish
     return output
+
+
+def fit_size(width, height, max_size):
+    """(rows, cols) of an image of width x height scaled to fit within max_size, keeping its aspect ratio"""
+    scale = min(float(max_size[0]) / height, float(max_size[1]) / width)
+    return max(int(round(height * scale)), 1), max(int(round(width * scale)), 1)
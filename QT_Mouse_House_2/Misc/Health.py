@@ -0,0 +1,77 @@
+# coding=utf-8
+
+"""Device health counters published through shared memory, and alarm evaluation of those counters"""
+
+import time
+import multiprocessing as mp
+from Misc.Names import *
+
+
+# Devices publish their counters to shared memory at this interval, seconds
+HEALTH_PUBLISH_INTERVAL = 0.25
+# A device whose heartbeat is older than this is reported as stalled, seconds
+HEALTH_STALL_TIMEOUT = 2.0
+# Counters every device publishes; devices leave those that do not apply at 0
+HEALTH_COUNTERS = (HLTH_MISSED, HLTH_DROPPED, HLTH_SKIPPED, HLTH_BACKLOG, HLTH_USB_ERR)
+# Status of a device, in increasing severity
+HEALTH_OK, HEALTH_WARN, HEALTH_ALARM, HEALTH_STALLED = 'ok', 'warn', 'alarm', 'stalled'
+
+
+class DeviceHealth(object):
+    """Health counters of one device process
+    Counters are accumulated locally and copied to shared memory at a fixed rate, with a heartbeat"""
+    def __init__(self, name):
+        self.name = name
+        # Layout: [counter_0, ..., counter_n, heartbeat]
+        self.mp_array = mp.RawArray('d', len(HEALTH_COUNTERS) + 1)
+        self.counts = dict.fromkeys(HEALTH_COUNTERS, 0)
+        self.last_publish = 0
+
+    # -- Writing; called from the device process -- #
+    def add(self, counter, num=1):
+        """Increments a cumulative counter, e.g. dropped frames"""
+        self.counts[counter] += num
+        self.publish()
+
+    def set(self, counter, value):
+        """Sets an instantaneous counter, e.g. writer backlog"""
+        self.counts[counter] = value
+        self.publish()
+
+    def reset(self):
+        """Zeroes all counters; called at the start of each run"""
+        self.counts = dict.fromkeys(HEALTH_COUNTERS, 0)
+        self.publish(force=True)
+
+    def publish(self, force=False):
+        """Copies counters to shared memory if the publish interval has elapsed"""
+        now = time.time()
+        if force or now - self.last_publish >= HEALTH_PUBLISH_INTERVAL:
+            for index, counter in enumerate(HEALTH_COUNTERS):
+                self.mp_array[index] = self.counts[counter]
+            self.mp_array[len(HEALTH_COUNTERS)] = now
+            self.last_publish = now
+
+    # -- Reading; called from the GUI -- #
+    def read(self):
+        """Returns ({counter: value}, seconds since last heartbeat)"""
+        values = {counter: self.mp_array[index] for index, counter in enumerate(HEALTH_COUNTERS)}
+        heartbeat = self.mp_array[len(HEALTH_COUNTERS)]
+        return values, (time.time() - heartbeat) if heartbeat else None
+
+    def status(self, thresholds):
+        """Returns (status, description) of this device against {counter: (warn, alarm)} thresholds"""
+        values, age = self.read()
+        if age is not None and age > HEALTH_STALL_TIMEOUT:
+            return HEALTH_STALLED, 'No heartbeat for {:.0f}s'.format(age)
+        status, problems = HEALTH_OK, []
+        for counter in HEALTH_COUNTERS:
+            warn, alarm = thresholds.get(counter, (None, None))
+            if alarm is not None and values[counter] >= alarm:
+                status = HEALTH_ALARM
+            elif warn is not None and values[counter] >= warn:
+                status = HEALTH_ALARM if status == HEALTH_ALARM else HEALTH_WARN
+            else:
+                continue
+            problems.append('{}: {:.0f}'.format(counter, values[counter]))
+        return status, ', '.join(problems) or 'OK'
@@ -5,7 +5,6 @@
 import os
 import PyQt4.QtGui as qg
 import PyQt4.QtCore as qc
-import multiprocessing as mp
 
 
 # Forbidden Chars that cannot be used in file naming
@@ -40,22 +39,35 @@ PWM_PINS.remove(10)
 HOME_DIR = os.path.expanduser('~')
 
 # Concurrency
-# Multiprocessing
-MASTER_DUMP_QUEUE = mp.Queue()
-PROC_HANDLER_QUEUE = mp.Queue()
-EXP_START_EVENT = mp.Event()
-# Queue Commands
-CMD_START = 'cmd_start'
-CMD_STOP = 'cmd_stop'
-CMD_EXIT = 'cmd_exit'
-CMD_SET_TIME = 'cmd_set_time'
-CMD_SET_DIRS = 'cmd_set_dirs'
-CMD_CHECK_CONN = 'cmd_check_connection'
+# Channels, pipes and the experiment start event are created by Concurrency.Channels.Topology
+# Queue Commands; integer opcodes, packed into one byte of each message header
+CMD_START = 1
+CMD_STOP = 2
+CMD_EXIT = 3
+CMD_SET_TIME = 4
+CMD_SET_DIRS = 5
+CMD_CHECK_CONN = 6
+CMD_POSTPROC = 7
+CMD_SET_ROI = 8
+CMD_SET_PREVIEW = 9
+CMD_SET_ARD = 10
 # Queue Messages
-MSG_RECEIVED = 'msg_received'
-MSG_STARTED = 'msg_started'
-MSG_FINISHED = 'msg_finished'
-MSG_ERROR = 'msg_error'
+MSG_RECEIVED = 101
+MSG_STARTED = 102
+MSG_FINISHED = 103
+MSG_ERROR = 104
+MSG_WARNING = 105
+# Device Health Counters
+HLTH_MISSED = 'missed samples'
+HLTH_DROPPED = 'dropped frames'
+HLTH_SKIPPED = 'preview skipped'
+HLTH_BACKLOG = 'writer backlog'
+HLTH_USB_ERR = 'usb errors'
+# Camera Preview Policies
+PREVIEW_FULL = 'Full rate'
+PREVIEW_FPS = 'Limited fps'
+PREVIEW_HOVER = 'On hover'
+PREVIEW_NOT_RECORDING = 'Off while recording'
 
 # PyQt
 # Layout
@@ -68,11 +80,16 @@ qWhite = qg.QColor(255, 255, 255)
 qYellow = qg.QColor(255, 255, 0)
 qBlue = qg.QColor(0, 0, 255)
 qRed = qg.QColor(255, 0, 0)
+qOrange = qg.QColor(255, 165, 0)
+qGreen = qg.QColor(0, 255, 0)
+qGrey = qg.QColor(128, 128, 128)
+qDarkRed = qg.QColor(128, 0, 0)
 # Background Colors
 qBgRed = 'background-color: rgb(255, 0, 0)'
 qBgWhite = 'background-color: rgb(255, 255, 255)'
 qBgCyan = 'background-color: cyan'
 qBgOrange = 'background-color: orange'
+qBgGreen = 'background-color: rgb(0, 255, 0)'
 # Keypresses
 qKey_k = qc.Qt.Key_K
 qKey_del = qc.Qt.Key_Delete
@@ -0,0 +1,196 @@
+# coding=utf-8
+
+"""Always-on, fixed memory instrumentation of hot paths, shared between processes"""
+
+import time
+import numpy as np
+import multiprocessing as mp
+from Misc.CustomClasses import SharedViews
+
+
+# Histogram layout: values in microseconds, 16 linear sub-buckets per power of 2 (~6% resolution)
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS
+MAX_MAGNITUDE = 30  # 2^30 us ~ 18 minutes; anything longer lands in the last bucket
+HIST_BUCKETS = SUB_BUCKETS + (MAX_MAGNITUDE - SUB_BITS) * SUB_BUCKETS
+# Per stage: histogram, then count, total seconds, max seconds
+STAGE_SIZE = HIST_BUCKETS + 3
+# Columns of a summary row
+SUMMARY_COLS = ('rate', 'p50', 'p99', 'max', 'value')
+# Seconds between summaries
+STATS_INTERVAL = 1.0
+
+
+def bucket_index(micros):
+    """HDR style bucket for a latency in integer microseconds"""
+    if micros < SUB_BUCKETS:
+        return micros
+    magnitude = micros.bit_length() - 1
+    if magnitude >= MAX_MAGNITUDE:
+        return HIST_BUCKETS - 1
+    shift = magnitude - SUB_BITS
+    return SUB_BUCKETS + shift * SUB_BUCKETS + (micros >> shift) - SUB_BUCKETS
+
+
+def bucket_lower_bounds():
+    """Lowest latency (us) that falls in each bucket"""
+    bounds = list(range(SUB_BUCKETS))
+    for shift in range(MAX_MAGNITUDE - SUB_BITS):
+        bounds += [(SUB_BUCKETS + sub) << shift for sub in range(SUB_BUCKETS)]
+    return np.array(bounds, dtype=np.float64)
+
+
+BUCKET_BOUNDS = bucket_lower_bounds()
+
+
+def percentile(hist, fraction):
+    """Latency in seconds below which fraction of the samples in hist fall"""
+    total = hist.sum()
+    if not total:
+        return 0.0
+    index = np.searchsorted(np.cumsum(hist), fraction * total)
+    return BUCKET_BOUNDS[min(index, HIST_BUCKETS - 1)] / 1e6
+
+
+class StageTimer(object):
+    """Reusable context manager that records the time spent inside it into one stage"""
+    __slots__ = ('stats', 'stage', 'start')
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.record(self.stage, time.perf_counter() - self.start)
+
+
+class ProcessStats(SharedViews):
+    """Latency histograms, gauges and counters of one process, in a shared buffer
+    Create in the main process, then pass to the process being instrumented"""
+    _cached_views = ('_views', '_stage_rows')
+
+    def __init__(self, name, stages=(), gauges=(), counters=()):
+        self.name = name
+        self.stages = tuple(stages)
+        self.gauges = tuple(gauges)
+        self.counters = tuple(counters)
+        # Layout: [stage_0, ..., stage_n, gauge_0, ..., gauge_n, counter_0, ..., counter_n]
+        size = len(self.stages) * STAGE_SIZE + len(self.gauges) + len(self.counters)
+        self.mp_array = mp.RawArray('d', max(size, 1))
+        self._views = None
+        self._stage_rows = None
+
+    def _build_views(self):
+        """Creates the numpy views into the shared buffer, and the stage rows keyed by name"""
+        array = np.frombuffer(self.mp_array, dtype=np.float64)
+        stage_end = len(self.stages) * STAGE_SIZE
+        gauge_end = stage_end + len(self.gauges)
+        self._views = (array[:stage_end].reshape(len(self.stages), STAGE_SIZE),
+                       array[stage_end:gauge_end],
+                       array[gauge_end:gauge_end + len(self.counters)])
+        self._stage_rows = {stage: self._views[0][i] for i, stage in enumerate(self.stages)}
+
+    @property
+    def views(self):
+        """(stage rows, gauges, counters) as numpy views into the shared buffer"""
+        if self._views is None:
+            self._build_views()
+        return self._views
+
+    # -- Writing; called from the instrumented process -- #
+    def timer(self, stage):
+        """Returns a context manager timing one stage"""
+        return StageTimer(self, stage)
+
+    def record(self, stage, seconds):
+        """Adds one latency sample to a stage"""
+        if self._stage_rows is None:
+            self._build_views()
+        row = self._stage_rows[stage]
+        row[bucket_index(int(seconds * 1e6))] += 1
+        row[HIST_BUCKETS] += 1
+        row[HIST_BUCKETS + 1] += seconds
+        if seconds > row[HIST_BUCKETS + 2]:
+            row[HIST_BUCKETS + 2] = seconds
+
+    def set_gauge(self, gauge, value):
+        """Sets the current value of a gauge, e.g. a queue depth"""
+        self.views[1][self.gauges.index(gauge)] = value
+
+    def count(self, counter, num=1):
+        """Increments a counter, e.g. loop iterations"""
+        self.views[2][self.counters.index(counter)] += num
+
+    # -- Reading; called from the aggregating process -- #
+    def row_names(self):
+        """Names of each summary row this block produces"""
+        return [(self.name, item) for item in self.stages + self.gauges + self.counters]
+
+    def summarize(self, elapsed, last_counts):
+        """Returns summary rows of [rate, p50, p99, max, value] and the counts used for rates"""
+        stages, gauges, counters = self.views
+        rows, counts = [], []
+        for row in stages:
+            hist = row[:HIST_BUCKETS].copy()
+            count = row[HIST_BUCKETS]
+            counts.append(count)
+            rows.append([0.0, percentile(hist, 0.5), percentile(hist, 0.99), row[HIST_BUCKETS + 2], count])
+        rows += [[0.0, 0.0, 0.0, 0.0, value] for value in gauges]
+        for value in counters:
+            counts.append(value)
+            rows.append([0.0, 0.0, 0.0, 0.0, value])
+        # Rates of stages and counters from the change in counts since the last summary
+        rate_rows = [row for i, row in enumerate(rows) if i < len(stages) or i >= len(stages) + len(gauges)]
+        if last_counts is not None and elapsed > 0:
+            for row, count, last in zip(rate_rows, counts, last_counts):
+                row[0] = (count - last) / elapsed
+        return rows, counts
+
+
+class StatsSummary(SharedViews):
+    """Aggregated summary of several ProcessStats blocks, shared with the GUI"""
+    def __init__(self, process_stats):
+        self.process_stats = process_stats
+        self.row_names = [name for stats in process_stats for name in stats.row_names()]
+        self.mp_array = mp.RawArray('d', max(len(self.row_names), 1) * len(SUMMARY_COLS))
+        self.last_counts = [None] * len(process_stats)
+        self.last_time = None
+        self._view = None
+
+    @property
+    def view(self):
+        """Summary rows as a numpy view into the shared buffer"""
+        if self._view is None:
+            self._view = np.frombuffer(self.mp_array, dtype=np.float64).reshape(-1, len(SUMMARY_COLS))
+        return self._view
+
+    def aggregate(self):
+        """Summarizes every block into the shared summary"""
+        now = time.perf_counter()
+        elapsed = (now - self.last_time) if self.last_time else 0
+        rows = []
+        for i, stats in enumerate(self.process_stats):
+            stats_rows, self.last_counts[i] = stats.summarize(elapsed, self.last_counts[i])
+            rows += stats_rows
+        if rows:
+            self.view[:len(rows)] = rows
+        self.last_time = now
+
+    def table(self):
+        """Summary formatted as text lines"""
+        lines = ['{:<28}{:<18}{:>10}{:>10}{:>10}{:>10}{:>12}'.format('Process', 'Item', 'Rate(Hz)', 'p50(ms)',
+                                                                     'p99(ms)', 'Max(ms)', 'Value')]
+        for (proc, item), (rate, p50, p99, maximum, value) in zip(self.row_names, self.view):
+            lines.append('{:<28}{:<18}{:>10.1f}{:>10.2f}{:>10.2f}{:>10.2f}{:>12.0f}'
+                         ''.format(proc[:27], item[:17], rate, p50 * 1e3, p99 * 1e3, maximum * 1e3, value))
+        return lines
+
+    def dump(self, path):
+        """Writes the current summary to a file"""
+        with open(path, 'w') as file:
+            file.write('\n'.join(self.table()) + '\n')
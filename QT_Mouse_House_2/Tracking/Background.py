@@ -0,0 +1,47 @@
+# coding=utf-8
+
+"""Incremental background models for tracking; constant memory and O(pixels) per update"""
+
+import numpy as np
+
+
+# Background models
+BG_MEDIAN = 'running median'
+BG_EWMA = 'exponential mean'
+BG_MODELS = (BG_MEDIAN, BG_EWMA)
+
+
+class BackgroundModel(object):
+    """Background of a grayscale region, bootstrapped from the mean of the first frames then kept up to date
+    Running median: moves each pixel a fixed step towards the frame, converging on the median without history
+    Exponential mean: moves each pixel a fraction of its difference from the frame
+    Pixels under the animal are never updated, so a resting animal is not absorbed into the background"""
+    def __init__(self, settings, shape):
+        self.settings = settings
+        self.background = np.zeros(shape, dtype=np.float32)
+        self.work = np.empty(shape, dtype=np.float32)
+        self.count = 0
+
+    @property
+    def ready(self):
+        """True once the bootstrap frames have been averaged"""
+        return self.count >= self.settings.bg_frames
+
+    def update(self, region, foreground=None):
+        """Adds one frame; after bootstrap only every bg_update_every frames are used
+        foreground is a nonzero mask of pixels to leave unchanged"""
+        self.count += 1
+        if self.count <= self.settings.bg_frames:
+            self.background += (region - self.background) / self.count
+            return
+        if (self.count - self.settings.bg_frames) % max(self.settings.bg_update_every, 1):
+            return
+        np.subtract(region, self.background, out=self.work)
+        if self.settings.bg_model == BG_MEDIAN:
+            np.sign(self.work, out=self.work)
+            self.work *= self.settings.bg_step
+        else:
+            self.work *= self.settings.bg_alpha
+        if foreground is not None:
+            self.work[foreground.view(np.bool_)] = 0
+        self.background += self.work
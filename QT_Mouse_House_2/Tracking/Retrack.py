@@ -0,0 +1,194 @@
+# coding=utf-8
+
+"""Offline re-tracking of recorded videos in parallel chunks; interrupted jobs resume where they stopped
+Run from the QT_Mouse_House_2 directory: python -m Tracking.Retrack [options] <run directories or video files>"""
+
+import os
+import sys
+import hashlib
+import argparse
+import imageio
+import multiprocessing as mp
+from Tracking.Tracker import Tracker
+from DirsSettings.Settings import TrackingSettings
+from Concurrency.PostProcessing import lower_priority, count_video_frames, CMR_FILE_FMTS, PARTIAL_FMT
+
+
+DEFAULT_CHUNK_FRAMES = 6000
+# Each chunk after the first decodes this many frames before its start to build its background
+WARMUP_FRAMES = 50
+# Output files, next to the video: {video}_retrack_{settings tag}.csv; chunks are kept in a folder until stitched,
+# each named by the frames it covers so a resumed job only reuses chunks of its own length
+RETRACK_SUFFIX = '_retrack'
+CHUNKS_SUFFIX = '.chunks'
+# Tracking parameters that can be changed from the command line
+RETRACK_PARAMS = ('threshold', 'target_area', 'open_radius', 'bg_frames', 'bg_model', 'bg_update_every',
+                  'bg_step', 'bg_alpha', 'roi')
+
+
+class RecordList(object):
+    """Collects tracking records in memory; stands in for the shared TrackingBuffer offline"""
+    def __init__(self):
+        self.rows = []
+
+    def write(self, frame, timestamp, x, y, area, found):
+        """Keeps one record"""
+        self.rows.append((frame, timestamp, x, y, area, found))
+
+
+class RetrackJob(object):
+    """Re-tracking of one video with one set of tracking parameters"""
+    def __init__(self, video_path, settings, chunk_frames=DEFAULT_CHUNK_FRAMES):
+        self.video_path = video_path
+        self.settings = settings
+        self.chunk_frames = max(1, chunk_frames)
+        self.tag = settings_tag(settings)
+        stem = os.path.splitext(video_path)[0]
+        self.output_path = '{}{}_{}.csv'.format(stem, RETRACK_SUFFIX, self.tag)
+        self.chunks_dir = '{}{}_{}{}'.format(stem, RETRACK_SUFFIX, self.tag, CHUNKS_SUFFIX)
+        self.num_frames = None
+
+    @property
+    def done(self):
+        """True if this video was already re-tracked with these parameters"""
+        return os.path.isfile(self.output_path)
+
+    def chunk_path(self, first, end):
+        """Result file of the chunk of frames [first, end)"""
+        return '{}\\{:09d}-{:09d}.csv'.format(self.chunks_dir, first, end)
+
+    def bounds(self):
+        """(first frame, end frame) of every chunk, in frame order"""
+        return [(first, min(first + self.chunk_frames, self.num_frames))
+                for first in range(0, self.num_frames, self.chunk_frames)]
+
+    def chunks(self):
+        """(first frame, end frame) of every chunk not finished by a previous attempt"""
+        if self.num_frames is None:
+            self.num_frames = count_video_frames(self.video_path)
+        if not self.num_frames:
+            return []
+        if not os.path.isdir(self.chunks_dir):
+            os.makedirs(self.chunks_dir)
+        return [chunk for chunk in self.bounds() if not os.path.isfile(self.chunk_path(*chunk))]
+
+    def stitch(self):
+        """Joins all chunk results in frame order into the output file, then removes the chunks folder
+        along with chunks of other lengths left by earlier attempts"""
+        partial_path = self.output_path + PARTIAL_FMT
+        with open(partial_path, 'w') as output:
+            output.write('# {}\n'.format(' '.join('{}={}'.format(param, getattr(self.settings, param))
+                                                  for param in RETRACK_PARAMS)))
+            output.write('frame,time,x,y,area\n')
+            for first, end in self.bounds():
+                with open(self.chunk_path(first, end)) as chunk:
+                    output.write(chunk.read())
+        os.replace(partial_path, self.output_path)
+        for name in os.listdir(self.chunks_dir):
+            os.remove('{}\\{}'.format(self.chunks_dir, name))
+        os.rmdir(self.chunks_dir)
+
+
+def settings_tag(settings):
+    """Short tag identifying a set of tracking parameters; chunks are only reused with identical parameters"""
+    values = repr(tuple(getattr(settings, param) for param in RETRACK_PARAMS))
+    return hashlib.sha1(values.encode('utf-8')).hexdigest()[:8]
+
+
+# -- Pool Workers -- #
+# Module level function such that it can be pickled and sent to pool workers
+def track_chunk(job, first, end):
+    """Tracks frames [first, end) of a video and saves them as the chunk's result
+    The background is built from warm up frames before the chunk, so chunks do not depend on each other"""
+    reader = imageio.get_reader(job.video_path)
+    fps = reader.get_meta_data().get('fps') or 1.0
+    start = max(first - max(WARMUP_FRAMES, job.settings.bg_frames), 0)
+    records = RecordList()
+    tracker = None
+    frame = reader.get_data(start)
+    for frame_index in range(start, end):
+        if frame_index > start:
+            frame = reader.get_next_data()
+        if tracker is None:
+            tracker = Tracker(job.settings, frame.shape, records)
+        tracker.track(frame, frame_index, frame_index / fps)
+    reader.close()
+    # Written to a partial file first so an interrupted chunk is never mistaken for a finished one
+    partial_path = job.chunk_path(first, end) + PARTIAL_FMT
+    with open(partial_path, 'w') as file:
+        for frame_index, timestamp, x, y, area, found in records.rows:
+            if frame_index >= first:
+                position = '{:.2f},{:.2f},{:.0f}'.format(x, y, area) if found else ',,'
+                file.write('{:.0f},{:.6f},{}\n'.format(frame_index, timestamp, position))
+    os.replace(partial_path, job.chunk_path(first, end))
+    return first
+
+
+def find_videos(paths):
+    """Video files in the given run directories, or the given video files themselves"""
+    videos = []
+    for path in paths:
+        if os.path.isdir(path):
+            videos += ['{}\\{}'.format(path, name) for name in sorted(os.listdir(path))
+                       if name.endswith(CMR_FILE_FMTS)]
+        elif path.endswith(CMR_FILE_FMTS):
+            videos.append(path)
+    return videos
+
+
+def retrack(paths, settings, num_workers=None, chunk_frames=DEFAULT_CHUNK_FRAMES):
+    """Re-tracks every video under paths on a low priority process pool; returns the output files written"""
+    jobs = [RetrackJob(video, settings, chunk_frames) for video in find_videos(paths)]
+    jobs = [job for job in jobs if not job.done]
+    tasks = [(job, chunk) for job in jobs for chunk in job.chunks()]
+    remaining = {job.output_path: len([task for task in tasks if task[0] is job]) for job in jobs}
+    written = []
+    pool = mp.Pool(num_workers or mp.cpu_count(), initializer=lower_priority)
+    try:
+        results = [(job, pool.apply_async(track_chunk, (job,) + chunk)) for job, chunk in tasks]
+        # Videos whose chunks were all finished by a previous attempt only need stitching
+        for job in jobs:
+            if job.num_frames and not remaining[job.output_path]:
+                job.stitch()
+                written.append(job.output_path)
+        for job, result in results:
+            result.get()
+            remaining[job.output_path] -= 1
+            if not remaining[job.output_path]:
+                job.stitch()
+                written.append(job.output_path)
+                print('Re-tracked {}'.format(job.video_path))
+    finally:
+        pool.terminate()
+        pool.join()
+    return written
+
+
+def parse_args(argv):
+    """Command line options; tracking parameters default to those of a new camera"""
+    defaults = TrackingSettings(enabled=True)
+    parser = argparse.ArgumentParser(description='Re-track recorded videos with new tracking parameters.')
+    parser.add_argument('paths', nargs='+', help='run directories or video files')
+    parser.add_argument('--threshold', type=float, default=defaults.threshold)
+    parser.add_argument('--target-area', type=float, default=defaults.target_area)
+    parser.add_argument('--open-radius', type=int, default=defaults.open_radius)
+    parser.add_argument('--bg-frames', type=int, default=defaults.bg_frames)
+    parser.add_argument('--bg-model', default=defaults.bg_model)
+    parser.add_argument('--bg-update-every', type=int, default=defaults.bg_update_every)
+    parser.add_argument('--bg-step', type=float, default=defaults.bg_step)
+    parser.add_argument('--bg-alpha', type=float, default=defaults.bg_alpha)
+    parser.add_argument('--roi', type=int, nargs=4, default=None, metavar=('X', 'Y', 'WIDTH', 'HEIGHT'))
+    parser.add_argument('--workers', type=int, default=None, help='default: one per core')
+    parser.add_argument('--chunk-frames', type=int, default=DEFAULT_CHUNK_FRAMES)
+    args = parser.parse_args(argv)
+    settings = TrackingSettings(enabled=True)
+    for param in RETRACK_PARAMS:
+        setattr(settings, param, getattr(args, param))
+    settings.roi = tuple(args.roi) if args.roi else None
+    return args, settings
+
+
+if __name__ == '__main__':
+    mp.freeze_support()
+    ARGS, SETTINGS = parse_args(sys.argv[1:])
+    retrack(ARGS.paths, SETTINGS, num_workers=ARGS.workers, chunk_frames=ARGS.chunk_frames)
@@ -0,0 +1,166 @@
+# coding=utf-8
+
+"""Real-time animal tracking by background subtraction"""
+
+import cv2
+import numpy as np
+import multiprocessing as mp
+from Misc.CustomClasses import SharedViews
+from Tracking.Background import BackgroundModel
+
+
+# Fields of one tracking record
+TRK_FRAME, TRK_TIME, TRK_X, TRK_Y, TRK_AREA, TRK_FOUND = range(6)
+TRK_NUM_FIELDS = 6
+# Records kept in shared memory; readers further behind than this lose the oldest records
+TRK_CAPACITY = 1024
+# Overlay colours on the RGB32 display buffer
+TRK_MARKER_COLOR = 0xFF0000
+TRK_ROI_COLOR = 0x00FF00
+
+
+class TrackingBuffer(SharedViews):
+    """Single producer ring buffer of tracking records in shared memory
+    Create in the main process, then pass to the camera process"""
+    def __init__(self, capacity=TRK_CAPACITY):
+        self.capacity = capacity
+        self.mp_array = mp.RawArray('d', capacity * TRK_NUM_FIELDS)
+        self.mp_count = mp.RawValue('L', 0)  # total records written; the writer only ever increments this
+        self._view = None
+
+    @property
+    def view(self):
+        """Records as a (capacity, fields) numpy view into the shared buffer"""
+        if self._view is None:
+            self._view = np.frombuffer(self.mp_array, dtype=np.float64).reshape(self.capacity, TRK_NUM_FIELDS)
+        return self._view
+
+    @property
+    def count(self):
+        """Total number of records written"""
+        return self.mp_count.value
+
+    def write(self, frame, timestamp, x, y, area, found):
+        """Publishes one record; the slot is filled before the count is advanced"""
+        self.view[self.mp_count.value % self.capacity] = (frame, timestamp, x, y, area, found)
+        self.mp_count.value += 1
+
+    def latest(self):
+        """Most recent record, or None if nothing was written yet"""
+        count = self.mp_count.value
+        if not count:
+            return None
+        return self.view[(count - 1) % self.capacity].copy()
+
+    def read_since(self, last_count):
+        """Records written after last_count, and the new count to pass next time"""
+        count = self.mp_count.value
+        first = max(last_count, count - self.capacity + 1)
+        indices = np.arange(first, count) % self.capacity
+        return self.view[indices].copy(), count
+
+
+class Tracker(object):
+    """Tracks the contour closest to a target area in frames darker than the background
+    All work arrays are allocated once per frame shape and tracking ROI"""
+    def __init__(self, settings, frame_shape, records):
+        self.settings = settings
+        self.records = records
+        # Processing is limited to the tracking ROI, in frame pixels
+        self.frame_shape = tuple(frame_shape[:2])
+        height, width = self.frame_shape
+        x, y, roi_width, roi_height = settings.roi or (0, 0, width, height)
+        x, y = min(max(int(x), 0), width - 1), min(max(int(y), 0), height - 1)
+        roi_width, roi_height = min(int(roi_width), width - x), min(int(roi_height), height - y)
+        self.roi = x, y, roi_width, roi_height
+        self.region = (slice(y, y + roi_height), slice(x, x + roi_width))
+        # Work arrays
+        self.background = BackgroundModel(settings, (roi_height, roi_width))
+        self.diff = np.empty((roi_height, roi_width), dtype=np.float32)
+        self.mask = np.empty((roi_height, roi_width), dtype=np.bool_)
+        self.segmented = np.empty((roi_height, roi_width), dtype=np.uint8)
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (settings.open_radius, settings.open_radius))
+        # Latest result
+        self.centroid = None
+
+    @property
+    def ready(self):
+        """True once the background has been built"""
+        return self.background.ready
+
+    def region_of(self, frame):
+        """Grayscale view of the tracking ROI of a frame; colour frames use their green channel"""
+        if frame.ndim == 3:
+            frame = frame[..., 1]
+        return frame[self.region]
+
+    def track(self, frame, frame_index, timestamp):
+        """Tracks one frame and publishes its record. Returns (x, y) in frame pixels, or None"""
+        region = self.region_of(frame)
+        if not self.ready:
+            self.background.update(region)
+            return None
+        np.subtract(region, self.background.background, out=self.diff)
+        np.less(self.diff, self.settings.threshold, out=self.mask)
+        cv2.morphologyEx(self.mask.view(np.uint8), cv2.MORPH_OPEN, self.kernel, dst=self.segmented)
+        # OpenCV 3 returns (image, contours, hierarchy), OpenCV 2 and 4 return (contours, hierarchy)
+        contours = cv2.findContours(self.segmented, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        self.centroid, area = self.select_contour(contours)
+        # The background keeps adapting to lighting and bedding changes everywhere but under the animal
+        self.background.update(region, foreground=self.segmented)
+        if self.centroid:
+            self.records.write(frame_index, timestamp, self.centroid[0], self.centroid[1], area, 1)
+        else:
+            self.records.write(frame_index, timestamp, 0, 0, 0, 0)
+        return self.centroid
+
+    def select_contour(self, contours):
+        """Centroid (in frame pixels) and area of the contour closest to the target area"""
+        best, best_area, best_error = None, 0, None
+        for contour in contours:
+            area = cv2.contourArea(contour)
+            error = abs(area - self.settings.target_area)
+            if best_error is None or error < best_error:
+                best, best_area, best_error = contour, area, error
+        if best is None:
+            return None, 0
+        moments = cv2.moments(best)
+        if not moments['m00']:
+            return None, 0
+        return (self.roi[0] + moments['m10'] / moments['m00'],
+                self.roi[1] + moments['m01'] / moments['m00']), best_area
+
+
+def records_in_zones(records, zones):
+    """True for each record that found the animal inside any of the (x, y, width, height) zones"""
+    x, y = records[:, TRK_X], records[:, TRK_Y]
+    inside = np.zeros(len(records), dtype=bool)
+    for zx, zy, width, height in zones:
+        inside |= (zx <= x) & (x < zx + width) & (zy <= y) & (y < zy + height)
+    return inside & (records[:, TRK_FOUND] > 0)
+
+
+def draw_overlay(array, scale, roi, record):
+    """Draws the tracking ROI and the position in a tracking record onto a downscaled RGB32 display array"""
+    if roi:
+        draw_rect(array, [int(value * scale) for value in roi], TRK_ROI_COLOR)
+    if record is not None and record[TRK_FOUND]:
+        draw_marker(array, int(record[TRK_X] * scale), int(record[TRK_Y] * scale), TRK_MARKER_COLOR)
+
+
+def draw_rect(array, rect, color):
+    """Draws a 1px rectangle outline of (x, y, width, height) on a 2d array"""
+    x, y, width, height = rect
+    x, y = min(max(x, 0), array.shape[1] - 1), min(max(y, 0), array.shape[0] - 1)
+    right, bottom = min(x + width, array.shape[1] - 1), min(y + height, array.shape[0] - 1)
+    array[y, x:right + 1] = color
+    array[bottom, x:right + 1] = color
+    array[y:bottom + 1, x] = color
+    array[y:bottom + 1, right] = color
+
+
+def draw_marker(array, x, y, color, radius=3):
+    """Draws a small cross centred at (x, y) on a 2d array"""
+    if 0 <= x < array.shape[1] and 0 <= y < array.shape[0]:
+        array[y, max(x - radius, 0):x + radius + 1] = color
+        array[max(y - radius, 0):y + radius + 1, x] = color
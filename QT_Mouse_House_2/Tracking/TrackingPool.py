@@ -0,0 +1,179 @@
+# coding=utf-8
+
+"""Pool of tracking processes shared by all cameras, sized to the cores left free by acquisition"""
+
+import time
+import numpy as np
+import multiprocessing as mp
+from Misc.CustomClasses import StoppableProcess, SharedViews
+from Tracking.Tracker import Tracker
+
+
+# Cores kept free for the GUI and proc_handler; each camera process needs one more
+TRK_RESERVED_CORES = 2
+TRK_IDLE_SLEEP = 1.0 / 1000.0
+# Fields of the frame slot header
+SLOT_SEQ, SLOT_FRAME, SLOT_TIME, SLOT_HEIGHT, SLOT_WIDTH = range(5)
+SLOT_HEADER_SIZE = 5
+
+
+class FrameSlot(SharedViews):
+    """Latest grayscale frame of one camera in shared memory; written by the camera process only
+    The sequence number is odd while a frame is being written, so readers can detect frames torn by an overwrite
+    Create in the main process, then pass to the camera process and its tracking worker"""
+    _cached_views = ('_view', '_header')
+
+    def __init__(self, max_shape):
+        self.max_size = int(np.prod(max_shape))
+        self.mp_array = mp.RawArray('B', self.max_size)
+        self.mp_header = mp.RawArray('d', SLOT_HEADER_SIZE)
+        self._view = None
+        self._header = None
+
+    @property
+    def view(self):
+        """Flat numpy view of the frame buffer"""
+        if self._view is None:
+            self._view = np.frombuffer(self.mp_array, dtype=np.uint8)
+        return self._view
+
+    @property
+    def header(self):
+        """Numpy view of the header fields"""
+        if self._header is None:
+            self._header = np.frombuffer(self.mp_header, dtype=np.float64)
+        return self._header
+
+    @property
+    def seq(self):
+        """Sequence number of the latest frame; advances by 2 per frame"""
+        return int(self.header[SLOT_SEQ])
+
+    def write(self, frame, frame_index, timestamp):
+        """Publishes a frame; colour frames are tracked on their green channel"""
+        if frame.ndim == 3:
+            frame = frame[..., 1]
+        height, width = frame.shape
+        header = self.header
+        header[SLOT_SEQ] += 1
+        self.view[:height * width].reshape(height, width)[:] = frame
+        header[SLOT_FRAME:] = (frame_index, timestamp, height, width)
+        header[SLOT_SEQ] += 1
+
+    def read(self, last_seq, out=None):
+        """Copies the latest frame if it is newer than last_seq
+        Returns (seq, frame, frame_index, timestamp), or None if there is no new complete frame"""
+        header = self.header
+        seq = int(header[SLOT_SEQ])
+        if seq == last_seq or seq % 2:
+            return None
+        frame_index, timestamp, height, width = header[SLOT_FRAME:]
+        shape = int(height), int(width)
+        if out is None or out.shape != shape:
+            out = np.empty(shape, dtype=np.uint8)
+        out[:] = self.view[:out.size].reshape(shape)
+        if int(header[SLOT_SEQ]) != seq:
+            return None  # overwritten while copying; the next frame will do
+        return seq, out, int(frame_index), timestamp
+
+
+class TrackedCamera(object):
+    """Tracking state of one camera, owned by the worker it is assigned to"""
+    def __init__(self, settings, frame_slot, records, stats, priority=False):
+        self.settings = settings
+        self.frame_slot = frame_slot
+        self.records = records
+        self.stats = stats  # 'tracked' rate is the effective tracking fps
+        self.priority = priority  # closed loop cameras are always served first
+        self.tracker = None
+        self.frame = None
+        self.last_seq = 0
+
+    @property
+    def has_new_frame(self):
+        """True if the camera published a frame we have not tracked"""
+        seq = self.frame_slot.seq
+        return seq != self.last_seq and not seq % 2
+
+    def track_latest(self):
+        """Tracks the latest frame; frames published in between are skipped. Returns True if a frame was tracked"""
+        result = self.frame_slot.read(self.last_seq, self.frame)
+        if result is None:
+            return False
+        seq, self.frame, frame_index, timestamp = result
+        if self.last_seq:
+            skipped = (seq - self.last_seq) // 2 - 1
+            if skipped > 0:
+                self.stats.count('skipped', skipped)
+        self.last_seq = seq
+        # Frame size changes with the camera ROI
+        if self.tracker is None or self.tracker.frame_shape != self.frame.shape:
+            self.tracker = Tracker(self.settings, self.frame.shape, self.records)
+        with self.stats.timer('track'):
+            self.tracker.track(self.frame, frame_index, timestamp)
+        self.stats.count('tracked')
+        return True
+
+
+class TrackingWorker(StoppableProcess):
+    """Tracks the latest frame of each assigned camera in turn; closed loop cameras first, the rest round robin"""
+    def __init__(self, cameras):
+        super(TrackingWorker, self).__init__()
+        self.priority = [camera for camera in cameras if camera.priority]
+        self.others = [camera for camera in cameras if not camera.priority]
+        self.turn = 0
+
+    def run(self):
+        """Tracks until stopped; sleeps only when no camera has a new frame"""
+        while not self.stopped():
+            camera = self.next_camera()
+            if not (camera and camera.track_latest()):
+                time.sleep(TRK_IDLE_SLEEP)
+
+    def next_camera(self):
+        """Next camera with a new frame, or None"""
+        for camera in self.priority:
+            if camera.has_new_frame:
+                return camera
+        for i in range(len(self.others)):
+            camera = self.others[(self.turn + i) % len(self.others)]
+            if camera.has_new_frame:
+                self.turn = (self.turn + i + 1) % len(self.others)
+                return camera
+        return None
+
+
+def num_tracking_workers(num_tracked, num_cameras):
+    """Workers for the cores not used by camera processes, the GUI and proc_handler; at least one"""
+    free_cores = mp.cpu_count() - num_cameras - TRK_RESERVED_CORES
+    return min(num_tracked, max(free_cores, 1))
+
+
+class TrackingPool(object):
+    """Assigns tracked cameras to workers; each closed loop camera gets a worker of its own if cores allow"""
+    def __init__(self, cameras, num_cameras):
+        self.workers = []
+        if not cameras:
+            return
+        num_workers = num_tracking_workers(len(cameras), num_cameras)
+        priority = [camera for camera in cameras if camera.priority]
+        others = [camera for camera in cameras if not camera.priority]
+        groups = [[] for _ in range(num_workers)]
+        # Priority cameras take a worker each, leaving at least one for the rest
+        dedicated = min(len(priority), num_workers - 1 if others else num_workers)
+        for i, camera in enumerate(priority[:dedicated]):
+            groups[i].append(camera)
+        shared = list(range(dedicated, num_workers)) or list(range(num_workers))
+        for i, camera in enumerate(priority[dedicated:] + others):
+            groups[shared[i % len(shared)]].append(camera)
+        self.workers = [TrackingWorker(group) for group in groups if group]
+        for index, worker in enumerate(self.workers):
+            worker.name = 'tracking_worker_#{}'.format(index)
+
+    def start(self):
+        """Starts all workers"""
+        [worker.start() for worker in self.workers]
+
+    def stop(self):
+        """Stops all workers"""
+        [worker.stop() for worker in self.workers]